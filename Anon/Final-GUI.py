@@ -9,54 +9,122 @@ de plano correspondiente dentro de cada paciente.
 """
 
 import os
+import queue
 import sys
 import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
 
 try:
     import pydicom
-    import numpy as np
+
+    from comun_dicom import (PLANTILLAS_MASCARA, Manifiesto, clasificar_plano, escribir_pixeles,
+                             hash_archivo, indexar_entrada, leer_cabecera, recortar_frames,
+                             tiene_pixeles, vista_pixeles)
 except ImportError:
     messagebox.showerror("Error de Dependencias",
-                         "Por favor, instala las dependencias requeridas con:\n\npip install pydicom numpy")
+                         "Por favor, instala las dependencias requeridas con:\n\n"
+                         "pip install pydicom numpy")
     sys.exit(1)
 
-
-def aplicar_mascara(imagen, mascara):
-    """Aplica una máscara a la imagen."""
-    return np.where(mascara, imagen, 0)
-
-
-def generar_mascara_personalizada(filas, cols):
-    """Genera una máscara que elimina la región inferior-izquierda."""
-    m = np.ones((filas, cols), dtype=np.uint8)
-    for y in range(filas):
-        if y > 150:
-            m[y, :y // 2] = 0
-    return m
-
-
-def clasificar_plano(ds, umbral=0.8):
-    """Clasifica el plano de la imagen (sagital, coronal, axial, etc.)."""
-    iop = getattr(ds, 'ImageOrientationPatient', None)
-    if iop is None:
-        return "desconocido"
-    row = np.array(iop[0:3], float)
-    col = np.array(iop[3:6], float)
-    normal = np.cross(row, col)
-    norm = np.linalg.norm(normal)
-    if norm == 0:
-        return "desconocido"
-    normal /= norm
-    ax, ay, az = abs(normal[0]), abs(normal[1]), abs(normal[2])
-    if ax > umbral and ax > ay and ax > az:
-        return "sagital"
-    if ay > umbral and ay > ax and ay > az:
-        return "coronal"
-    if az > umbral and az > ax and az > ay:
-        return "axial"
-    return "oblicuo"
+LOG_ARCHIVO = "anonimizacion.log"  # registro completo de la ejecución, en la carpeta de salida
+LOG_MAX_LINEAS = 1000              # líneas que conserva el área de registro
+INTERVALO_UI_MS = 100              # cada cuánto vacía la interfaz la cola de eventos
+MAX_EVENTOS_POR_CICLO = 20000
+
+
+def leer_descripcion_serie(root, dicoms):
+    """Lee la descripción de la serie a partir de la cabecera del primer archivo."""
+    try:
+        ds0 = pydicom.dcmread(os.path.join(root, dicoms[0]), force=True,
+                              stop_before_pixels=True)
+        return ds0.get("SeriesDescription", "SinDescripcion").replace(" ", "_")
+    except Exception:
+        return "SinDescripcion"
+
+
+def procesar_archivo(ruta, serie, tag_p, out_p, lectura_rapida=False, plantilla="clasica"):
+    """
+    Anonimiza un DICOM, lo recorta si es sagital y lo guarda. Devuelve el plano.
+    El plano se decide por la cabecera, igual que en el script (ver
+    comun_dicom.tiene_pixeles y, con lectura_rapida, comun_dicom.leer_cabecera),
+    y solo se decodifican los sagitales.
+    """
+    plano = None
+    if lectura_rapida:
+        with open(ruta, "rb") as fp:
+            cabecera, con_pixeles = leer_cabecera(fp, os.fstat(fp.fileno()).st_size)
+        if con_pixeles is not None:
+            plano = clasificar_plano(cabecera) if con_pixeles else "sin_pixel"
+        ds = pydicom.dcmread(ruta, force=True, defer_size="64 KB")
+    else:
+        ds = pydicom.dcmread(ruta, force=True)
+
+    # 1) Anonimizar
+    ds.PatientName = tag_p
+    ds.PatientID = tag_p
+    ds.OtherPatientIDs = None
+    ds.PatientBirthDate = ""
+    ds.PatientSex = ""
+
+    # 2) Detectar plano
+    if plano is None:
+        plano = clasificar_plano(ds) if tiene_pixeles(ds) else "sin_pixel"
+
+    # 3) Aplicar máscara solo en sagitales (o en los frames sagitales)
+    if plano in ("sagital", "mixto"):
+        img = vista_pixeles(ds)
+        if img is None:
+            img = ds.pixel_array
+        rec = recortar_frames(ds, img, plano, PLANTILLAS_MASCARA[plantilla])
+        escribir_pixeles(ds, rec)
+
+    # 4) Construir carpeta de destino:
+    #    OUTPUT/Paciente_XXXX/plano/SerieDescription/
+    plano_dir = os.path.join(out_p, plano)
+    serie_dir = os.path.join(plano_dir, serie)
+    os.makedirs(serie_dir, exist_ok=True)
+
+    # 5) Guardar el DICOM procesado
+    destino = os.path.join(serie_dir, os.path.basename(ruta))
+    ds.save_as(destino)
+    return plano
+
+
+def registro_manifiesto(ruta, out_p, serie, plano, estado):
+    """Fila del Manifiesto para un archivo de entrada ya procesado."""
+    st = os.stat(ruta)
+    destino = os.path.join(out_p, plano, serie, os.path.basename(ruta)) if plano else None
+    return (os.path.abspath(ruta), st.st_size, st.st_mtime, hash_archivo(ruta),
+            destino, plano, estado)
+
+
+def procesar_directorio(root, dicoms, tag_p, out_p, lectura_rapida=False, registrar=False,
+                        plantilla="clasica"):
+    """
+    Procesa una carpeta de serie dentro de un proceso del pool.
+    Devuelve (pid, mensajes, segundos, registros) para que la interfaz registre
+    el resultado; registros solo se rellena con registrar (filas del Manifiesto).
+    """
+    inicio = time.perf_counter()
+    serie = leer_descripcion_serie(root, dicoms)
+    mensajes = []
+    registros = []
+    for f in dicoms:
+        ruta = os.path.join(root, f)
+        try:
+            plano = procesar_archivo(ruta, serie, tag_p, out_p, lectura_rapida, plantilla)
+            mensajes.append(f"[{plano}] {serie}/{f} → guardado en {plano}/{serie}")
+            estado = "ok"
+        except Exception as e:
+            mensajes.append(f"⚠️ Error procesando '{ruta}': {e}")
+            plano, estado = None, "error"
+        if registrar:
+            registros.append(registro_manifiesto(ruta, out_p, serie, plano, estado))
+    return os.getpid(), mensajes, time.perf_counter() - inicio, registros
 
 
 class AnonimizadorDicomApp:
@@ -69,6 +137,10 @@ class AnonimizadorDicomApp:
         # Variables para las rutas
         self.input_path = tk.StringVar()
         self.output_path = tk.StringVar()
+        self.workers = tk.IntVar(value=1)
+        self.fast_read = tk.BooleanVar(value=False)
+        self.resume = tk.BooleanVar(value=False)
+        self.mask_template = tk.StringVar(value="clasica")
 
         # Variables para el progreso
         self.current_operation = tk.StringVar(value="Esperando inicio...")
@@ -76,12 +148,19 @@ class AnonimizadorDicomApp:
         self.total_files = 0
         self.processed_files = 0
 
+        # Canal de eventos hilo de trabajo → interfaz; solo el bucle de Tk lo vacía
+        self.events = queue.SimpleQueue()
+        self.log_lines = 0
+        self.log_file = None
+
         # Crear la interfaz
         self.create_widgets()
 
         # Configuración de estilos
         self.configure_styles()
 
+        self.root.after(INTERVALO_UI_MS, self.drain_events)
+
     def configure_styles(self):
         """Configura los estilos de la interfaz."""
         self.root.configure(bg="#f5f5f5")
@@ -127,6 +206,32 @@ class AnonimizadorDicomApp:
                                    command=self.browse_output_folder)
         output_button.grid(row=1, column=2, pady=5)
 
+        # Número de procesos en paralelo
+        workers_label = ttk.Label(folders_frame, text="Procesos en paralelo:")
+        workers_label.grid(row=2, column=0, sticky=tk.W, pady=5)
+
+        workers_spin = ttk.Spinbox(folders_frame, from_=1, to=os.cpu_count() or 1,
+                                   textvariable=self.workers, width=5)
+        workers_spin.grid(row=2, column=1, sticky=tk.W, padx=5, pady=5)
+
+        # Lectura rápida: clasificar por cabecera sin decodificar píxeles
+        fast_check = ttk.Checkbutton(folders_frame, variable=self.fast_read,
+                                     text="Lectura rápida (decodificar solo sagitales)")
+        fast_check.grid(row=3, column=1, sticky=tk.W, padx=5, pady=5)
+
+        # Reanudar: omitir los archivos que ya constan en el manifiesto de salida
+        resume_check = ttk.Checkbutton(folders_frame, variable=self.resume,
+                                       text="Reanudar (omitir archivos ya procesados)")
+        resume_check.grid(row=4, column=1, sticky=tk.W, padx=5, pady=5)
+
+        # Plantilla de la máscara facial (en mm, según PixelSpacing y orientación)
+        template_label = ttk.Label(folders_frame, text="Plantilla de máscara:")
+        template_label.grid(row=5, column=0, sticky=tk.W, pady=5)
+
+        template_combo = ttk.Combobox(folders_frame, textvariable=self.mask_template,
+                                      values=list(PLANTILLAS_MASCARA), state="readonly", width=15)
+        template_combo.grid(row=5, column=1, sticky=tk.W, padx=5, pady=5)
+
         # Botones de acción
         buttons_frame = ttk.Frame(main_frame)
         buttons_frame.pack(fill=tk.X, pady=20)
@@ -161,8 +266,10 @@ class AnonimizadorDicomApp:
         self.log_text.config(yscrollcommand=scrollbar.set)
 
         # Estado inicial
-        self.log_text.insert(tk.END, "Aplicación iniciada. Seleccione las carpetas de entrada y salida.\n")
+        self.log_text.insert(tk.END, "Aplicación iniciada. "
+                                     "Seleccione las carpetas de entrada y salida.\n")
         self.log_text.config(state=tk.DISABLED)
+        self.log_lines = 1
 
     def browse_input_folder(self):
         """Abre un diálogo para seleccionar la carpeta de entrada."""
@@ -179,28 +286,78 @@ class AnonimizadorDicomApp:
             self.update_log(f"Carpeta de salida seleccionada: {folder}")
 
     def update_log(self, message):
-        """Actualiza el área de registro con un nuevo mensaje."""
-        self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state=tk.DISABLED)
+        """Encola un mensaje para el área de registro. Se puede llamar desde cualquier hilo."""
+        self.events.put(("log", message))
 
     def update_progress(self, message, increment=False):
-        """Actualiza la información de progreso."""
-        self.current_operation.set(message)
+        """
+        Encola una actualización de progreso (increment puede ser un número de
+        archivos). Se puede llamar desde cualquier hilo y nunca bloquea.
+        """
+        self.events.put(("progress", message, int(increment)))
+
+    def drain_events(self):
+        """
+        Vacía la cola de eventos desde el bucle de Tk, agrupando en una sola
+        actualización de la interfaz todos los mensajes llegados desde el ciclo anterior.
+        """
+        lines, message, increment, dialogs = [], None, 0, []
+        try:
+            for _ in range(MAX_EVENTOS_POR_CICLO):
+                event = self.events.get_nowait()
+                if event[0] == "log":
+                    lines.append(event[1])
+                elif event[0] == "progress":
+                    message = event[1]
+                    increment += event[2]
+                elif event[0] == "total":
+                    self.total_files = event[1]
+                else:
+                    dialogs.append(event)
+        except queue.Empty:
+            pass
+
+        if lines:
+            self.append_log(lines)
+        if message is not None:
+            self.current_operation.set(message)
         if increment and self.total_files > 0:
-            self.processed_files += 1
+            self.processed_files += increment
             self.progress_value.set((self.processed_files / self.total_files) * 100)
-        self.root.update_idletasks()  # Actualizar la interfaz
+        for kind, payload in dialogs:
+            self.close_log_file()
+            if kind == "done":
+                messagebox.showinfo("Proceso Completado",
+                                    f"Se han anonimizado {self.processed_files} archivos DICOM.\n"
+                                    f"Los archivos se han guardado en:\n{payload}")
+            else:
+                messagebox.showerror("Error", payload)
+
+        self.root.after(INTERVALO_UI_MS, self.drain_events)
+
+    def append_log(self, lines):
+        """
+        Añade líneas al área de registro, que actúa como búfer circular de
+        LOG_MAX_LINEAS líneas; el registro completo va al archivo de log, si está abierto.
+        """
+        if self.log_file is not None:
+            self.log_file.write("\n".join(lines) + "\n")
+        lines = lines[-LOG_MAX_LINEAS:]
+        self.log_text.config(state=tk.NORMAL)
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        self.log_lines += len(lines)
+        excess = self.log_lines - LOG_MAX_LINEAS
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_lines = LOG_MAX_LINEAS
+        self.log_text.see(tk.END)
+        self.log_text.config(state=tk.DISABLED)
 
-    def count_total_files(self, input_folder):
-        """Cuenta el número total de archivos DICOM en la carpeta de entrada."""
-        total = 0
-        self.update_log("Contando archivos...")
-        for root, _, files in os.walk(input_folder):
-            dicoms = [f for f in files if not f.startswith('.')]
-            total += len(dicoms)
-        return total
+    def close_log_file(self):
+        """Cierra el archivo de log de la ejecución, si está abierto."""
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
 
     def start_process(self):
         """Inicia el proceso de anonimización en un hilo separado."""
@@ -219,110 +376,146 @@ class AnonimizadorDicomApp:
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
 
-        # Reiniciar variables de progreso
+        # Registro completo de la ejecución; el área de registro solo guarda las últimas líneas
+        self.close_log_file()
+        self.log_file = open(os.path.join(output_folder, LOG_ARCHIVO), "a", encoding="utf-8")
+
+        # Reiniciar variables de progreso (el total llega desde el hilo tras indexar)
         self.processed_files = 0
+        self.total_files = 0
         self.progress_value.set(0)
-        self.update_progress("Contando archivos...")
-        self.total_files = self.count_total_files(input_folder)
-        self.update_log(f"Se encontraron {self.total_files} archivos para procesar.")
 
         # Iniciar proceso en un hilo separado
         thread = threading.Thread(target=self.process_files,
-                                  args=(input_folder, output_folder))
+                                  args=(input_folder, output_folder,
+                                        self.workers.get(), self.fast_read.get(),
+                                        self.resume.get(), self.mask_template.get()))
         thread.daemon = True
         thread.start()
 
-    def process_files(self, input_folder, output_folder):
-        """Procesa los archivos DICOM en la carpeta de entrada."""
+    def process_files(self, input_folder, output_folder, workers=1, fast_read=False,
+                      resume=False, template="clasica"):
+        """
+        Procesa los archivos DICOM en la carpeta de entrada.
+        Con workers > 1 las carpetas de serie se reparten en un pool de procesos.
+        Con resume se omiten los archivos que el Manifiesto da por procesados.
+        template es el nombre de la plantilla de máscara (PLANTILLAS_MASCARA).
+        """
+        manifiesto = None
         try:
             self.update_progress("Iniciando procesamiento...")
             self.update_log("Iniciando procesamiento de archivos DICOM...")
 
-            pacientes = [d for d in os.listdir(input_folder)
-                         if os.path.isdir(os.path.join(input_folder, d))]
-            if not pacientes:
-                pacientes = [""]  # usar la raíz como un único paciente
-
-            for idx_p, pac in enumerate(pacientes, start=1):
+            # Un único recorrido de la entrada para el total y para el reparto
+            self.update_progress("Indexando archivos...")
+            self.update_log("Indexando archivos...")
+            indice = indexar_entrada(input_folder)
+            total = sum(len(serie["archivos"])
+                        for paciente in indice["pacientes"] for serie in paciente["series"])
+            self.events.put(("total", total))
+            self.update_log(f"Se encontraron {total} archivos para procesar.")
+
+            if resume:
+                os.makedirs(output_folder, exist_ok=True)
+                manifiesto = Manifiesto(output_folder)
+
+            trabajos = []
+            for idx_p, paciente in enumerate(indice["pacientes"], start=1):
+                pac = paciente["carpeta"]
                 tag_p = f"Paciente_{idx_p:04d}"
                 in_p = os.path.join(input_folder, pac) if pac else input_folder
+                if manifiesto is not None:
+                    tag_p = manifiesto.etiqueta(in_p, tag_p)
                 out_p = os.path.join(output_folder, tag_p)
                 os.makedirs(out_p, exist_ok=True)
 
                 self.update_progress(f"Procesando {tag_p}: {in_p}")
                 self.update_log(f"Procesando {tag_p}: {in_p}")
 
-                for root, _, files in os.walk(in_p):
-                    dicoms = [f for f in files if not f.startswith('.')]
+                for carpeta_serie in paciente["series"]:
+                    root = (os.path.join(input_folder, carpeta_serie["ruta"])
+                            if carpeta_serie["ruta"] else input_folder)
+                    dicoms = [a[0] for a in carpeta_serie["archivos"]]
+                    if manifiesto is not None:
+                        pendientes = manifiesto.pendientes(root, carpeta_serie["archivos"])
+                        omitidos = len(dicoms) - len(pendientes)
+                        if omitidos:
+                            self.update_log(f"{omitidos} archivos ya procesados en {root}")
+                            self.update_progress(f"Omitidos: {root}", increment=omitidos)
+                        dicoms = pendientes
                     if not dicoms:
                         continue
 
-                    # Leer la serie para usar su descripción
-                    try:
-                        ds0 = pydicom.dcmread(os.path.join(root, dicoms[0]), force=True)
-                        serie = ds0.get("SeriesDescription", "SinDescripcion").replace(" ", "_")
-                    except Exception:
-                        serie = "SinDescripcion"
+                    if workers > 1:
+                        trabajos.append((root, dicoms, tag_p, out_p, fast_read, resume, template))
+                        continue
 
+                    serie = leer_descripcion_serie(root, dicoms)
+                    registros = []
                     for f in dicoms:
                         ruta = os.path.join(root, f)
                         try:
                             self.update_progress(f"Procesando {serie}/{f}", increment=False)
-
-                            ds = pydicom.dcmread(ruta, force=True)
-
-                            # 1) Anonimizar
-                            ds.PatientName = tag_p
-                            ds.PatientID = tag_p
-                            ds.OtherPatientIDs = None
-                            ds.PatientBirthDate = ""
-                            ds.PatientSex = ""
-
-                            # 2) Detectar plano
-                            plano = "sin_pixel"
-                            if hasattr(ds, "pixel_array"):
-                                plano = clasificar_plano(ds)
-
-                            # 3) Aplicar máscara solo en sagitales
-                            if plano == "sagital":
-                                img = ds.pixel_array
-                                m = generar_mascara_personalizada(*img.shape)
-                                rec = aplicar_mascara(img, m)
-                                ds.PixelData = rec.tobytes()
-
-                            # 4) Construir carpeta de destino:
-                            #    OUTPUT/Paciente_XXXX/plano/SerieDescription/
-                            plano_dir = os.path.join(out_p, plano)
-                            serie_dir = os.path.join(plano_dir, serie)
-                            os.makedirs(serie_dir, exist_ok=True)
-
-                            # 5) Guardar el DICOM procesado
-                            destino = os.path.join(serie_dir, f)
-                            ds.save_as(destino)
-
+                            plano = procesar_archivo(ruta, serie, tag_p, out_p, fast_read,
+                                                     template)
                             self.update_log(f"[{plano}] {serie}/{f} → guardado en {plano}/{serie}")
                             self.update_progress(f"Procesado: {serie}/{f}", increment=True)
+                            estado = "ok"
 
                         except Exception as e:
                             self.update_log(f"⚠️ Error procesando '{ruta}': {e}")
                             self.update_progress(f"Error: {ruta}", increment=True)
+                            plano, estado = None, "error"
+
+                        if manifiesto is not None:
+                            registros.append(registro_manifiesto(ruta, out_p, serie, plano, estado))
+
+                    if manifiesto is not None:
+                        manifiesto.registrar(registros)
+
+            if trabajos:
+                self.process_in_pool(trabajos, workers, manifiesto)
 
             # Proceso completado
             self.update_progress("Proceso completado", increment=False)
             self.update_log("¡Proceso de anonimización completado con éxito!")
 
-            # Mostrar mensaje de finalización
-            messagebox.showinfo("Proceso Completado",
-                                f"Se han anonimizado {self.processed_files} archivos DICOM.\n"
-                                f"Los archivos se han guardado en:\n{output_folder}")
+            # Mostrar mensaje de finalización (desde el bucle de Tk)
+            self.events.put(("done", output_folder))
 
         except Exception as e:
             self.update_log(f"Error general: {e}")
-            messagebox.showerror("Error", f"Ha ocurrido un error durante el procesamiento:\n{e}")
             self.update_progress("Error en el proceso", increment=False)
+            self.events.put(("error", f"Ha ocurrido un error durante el procesamiento:\n{e}"))
+
+        finally:
+            if manifiesto is not None:
+                manifiesto.cerrar()
+
+    def process_in_pool(self, trabajos, workers, manifiesto=None):
+        """Reparte las carpetas de serie entre procesos y registra el rendimiento por proceso."""
+        resumen = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futuros = [pool.submit(procesar_directorio, *t) for t in trabajos]
+            for fut in as_completed(futuros):
+                pid, mensajes, segundos, registros = fut.result()
+                if manifiesto is not None:
+                    manifiesto.registrar(registros)
+                for mensaje in mensajes:
+                    self.update_log(mensaje)
+                    self.update_progress(mensaje, increment=True)
+                r = resumen.setdefault(pid, [0, 0.0])
+                r[0] += len(mensajes)
+                r[1] += segundos
+
+        for pid, (archivos, segundos) in sorted(resumen.items()):
+            velocidad = archivos / segundos if segundos else 0.0
+            self.update_log(f"[proceso {pid}] {archivos} archivos en {segundos:.1f} s "
+                            f"({velocidad:.1f} archivos/s)")
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # necesario para el pool en el ejecutable empaquetado
     root = tk.Tk()
     app = AnonimizadorDicomApp(root)
     root.mainloop()
\ No newline at end of file
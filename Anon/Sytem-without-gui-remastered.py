@@ -3,131 +3,1042 @@
 """
 anonimizar_y_recortar_por_plano.py
 
-Recorre las subcarpetas de pacientes en INPUT_FOLDER,
+Recorre las subcarpetas de pacientes de cada carpeta de entrada,
 anonimiza todos los DICOMs y aplica un recorte facial solamente
 en los cortes sagitales, clasificando cada archivo en su carpeta
 de plano correspondiente dentro de cada paciente.
+
+    python Sytem-without-gui-remastered.py ESTUDIO [ESTUDIO ...] --salida SALIDA
+    python Sytem-without-gui-remastered.py --lista estudios.txt --workers 8 --resumen-json r.json
+
+Códigos de salida: 0 todo correcto, 1 algún archivo con error, 2 uso
+incorrecto, 3 alguna entrada no se pudo procesar, 130 interrumpido.
+
+Este script reparte el trabajo y reúne los resultados; el resto va en los
+módulos de su carpeta: procesado (procesado de cada carpeta de serie),
+anonimizacion (perfiles), escritura (pipeline y empaquetado), telemetria,
+cola_trabajo (modo distribuido), inventario y comun_dicom.
 """
 
+import argparse
+import glob
+import hashlib
+import hmac
+import json
 import os
+import pstats
+import shutil
+import socket
+import sqlite3
 import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed, wait)
+from concurrent.futures.process import BrokenProcessPool
 
 try:
     import pydicom
-    import numpy as np
+
+    from anonimizacion import (PERFILES_ANONIMIZACION, cargar_perfil_anonimizacion,
+                               preparar_anonimizacion)
+    from cola_trabajo import abrir_cola
+    from comun_dicom import (MANIFIESTO, PLANTILLAS_MASCARA, Manifiesto, cargar_o_indexar,
+                             hash_archivo, totales_indice)
+    from escritura import EXTENSIONES_EMPAQUETADO
+    from inventario import inventariar
+    from procesado import (FACTOR_MEMORIA, MAX_LECTURA_ANTICIPADA, leer_descripcion_serie,
+                           procesar_directorio, procesar_empaquetado, tamano_decodificado)
+    from telemetria import Telemetria, imprimir_telemetria
 except ImportError:
     print("Instala primero las dependencias con:\n    pip install pydicom numpy")
     sys.exit(1)
 
 
-# ←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←
-INPUT_FOLDER  = "/Users/patricksext/PycharmProjects/PythonProject/18380000"
-OUTPUT_FOLDER = "salida"
-# ←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←
+OUTPUT_FOLDER = "salida"  # carpeta de salida por defecto
+
+# códigos de salida del script
+SALIDA_OK       = 0
+SALIDA_ERRORES  = 1    # algún archivo no se pudo procesar
+SALIDA_USO      = 2    # argumentos incorrectos (argparse)
+SALIDA_FALLO    = 3    # alguna entrada no existe o falló por completo
+SALIDA_INTERRUMPIDO = 130
 
+HILOS_DUPLICADOS = 8  # hilos para leer cabeceras o calcular hashes al buscar duplicados
 
-def aplicar_mascara(imagen, mascara):
-    return np.where(mascara, imagen, 0)
 
+def cargar_plantilla(nombre):
+    """
+    Parámetros de la máscara para un nombre de PLANTILLAS_MASCARA o un JSON
+    con {"plantilla": nombre} y/o los parámetros a cambiar sobre ella (por
+    defecto "clasica"). ValueError si no existe o trae claves desconocidas.
+    """
+    if nombre in PLANTILLAS_MASCARA:
+        return dict(PLANTILLAS_MASCARA[nombre])
+    if not os.path.isfile(nombre):
+        raise ValueError(f"plantilla de máscara desconocida: '{nombre}' "
+                         f"(disponibles: {', '.join(PLANTILLAS_MASCARA)})")
+    with open(nombre, encoding="utf-8") as fp:
+        config = json.load(fp)
+    base = config.pop("plantilla", "clasica")
+    if base not in PLANTILLAS_MASCARA:
+        raise ValueError(f"{nombre}: plantilla base desconocida '{base}'")
+    plantilla = dict(PLANTILLAS_MASCARA[base])
+    sobrantes = set(config) - set(plantilla)
+    if sobrantes:
+        raise ValueError(f"{nombre}: parámetros desconocidos {sorted(sobrantes)}")
+    plantilla.update({k: float(v) for k, v in config.items()})
+    return plantilla
 
-def generar_mascara_personalizada(filas, cols):
-    # máscara que elimina la región inferior-izquierda
-    m = np.ones((filas, cols), dtype=np.uint8)
-    for y in range(filas):
-        if y > 150:
-            m[y, :y//2] = 0
-    return m
 
+def seudonimo(patient_id, clave):
+    """
+    Identificador Paciente_XXXXXXXXXXXX estable para un PatientID original:
+    HMAC-SHA256 con una clave secreta, de modo que no depende del orden de
+    las carpetas y cualquier proceso o nodo con la misma clave obtiene el
+    mismo resultado sin coordinarse.
+    """
+    h = hmac.new(clave, patient_id.encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"Paciente_{h[:12].upper()}"
+
+
+def patient_id_de_carpeta(in_p, series):
+    # PatientID del primer archivo del paciente (según el índice) que lo tenga
+    for serie in series:
+        for f, _, _ in serie["archivos"]:
+            try:
+                ds = pydicom.dcmread(os.path.join(in_p, serie["ruta"], f), force=True,
+                                     specific_tags=["PatientID"])
+            except Exception:
+                continue
+            pid = str(ds.get("PatientID", "")).strip()
+            if pid:
+                return pid
+    return None
+
+
+def etiqueta_paciente(input_folder, paciente, idx_p, clave=None):
+    """
+    (carpeta, Paciente_XXXX) del paciente idx_p (desde 1) del índice: por
+    posición o, con clave, el seudónimo de su PatientID (ver seudonimo).
+    """
+    pac = paciente["carpeta"]
+    in_p = os.path.join(input_folder, pac) if pac else input_folder
+    if clave is None:
+        return in_p, f"Paciente_{idx_p:04d}"
+    pid = (patient_id_de_carpeta(input_folder, paciente["series"])
+           or os.path.basename(os.path.abspath(in_p)))
+    return in_p, seudonimo(pid, clave)
+
+
+def buscar_duplicados(input_folder, indice, criterio="contenido"):
+    """
+    Duplicados entre los archivos de cada paciente del índice, sin
+    decodificar nada. Con criterio "contenido" son los archivos idénticos
+    byte a byte: solo se calcula el hash de los que coinciden en tamaño con
+    otro. Con "uid" son los que comparten SOPInstanceUID (solo se lee la
+    cabecera). Una copia en la carpeta de otro paciente no es duplicado: su
+    salida lleva el identificador anonimizado de ese paciente. Devuelve
+    {ruta duplicada: ruta del primero en el orden del índice}.
+    """
+    rutas, tamanos, pacientes = [], [], {}
+    for idx_p, paciente in enumerate(indice["pacientes"]):
+        for serie in paciente["series"]:
+            root = os.path.join(input_folder, serie["ruta"]) if serie["ruta"] else input_folder
+            for f, tamano, _ in serie["archivos"]:
+                rutas.append(os.path.join(root, f))
+                tamanos.append(tamano)
+                pacientes[rutas[-1]] = idx_p
+
+    if criterio == "uid":
+        def clave(ruta):
+            try:
+                ds = pydicom.dcmread(ruta, force=True, stop_before_pixels=True,
+                                     specific_tags=["SOPInstanceUID"])
+            except Exception:
+                return None
+            uid = ds.get("SOPInstanceUID")
+            return str(uid) if uid else None
+        candidatas = rutas
+    else:
+        por_tamano = Counter((pacientes[r], t) for r, t in zip(rutas, tamanos))
+        repetidos = {k for k, n in por_tamano.items() if n > 1}
+        candidatas = [r for r, t in zip(rutas, tamanos) if (pacientes[r], t) in repetidos]
+        clave = hash_archivo
+
+    primero, duplicados = {}, {}
+    with ThreadPoolExecutor(max_workers=HILOS_DUPLICADOS) as pool:
+        for ruta, c in zip(candidatas, pool.map(clave, candidatas)):
+            if c is None:
+                continue
+            c = (pacientes[ruta], c)
+            if c in primero:
+                duplicados[ruta] = primero[c]
+            else:
+                primero[c] = ruta
+    return duplicados
 
-def clasificar_plano(ds, umbral=0.8):
-    iop = getattr(ds, 'ImageOrientationPatient', None)
-    if iop is None:
-        return "desconocido"
-    row = np.array(iop[0:3], float)
-    col = np.array(iop[3:6], float)
-    normal = np.cross(row, col)
-    norm = np.linalg.norm(normal)
-    if norm == 0:
-        return "desconocido"
-    normal /= norm
-    ax, ay, az = abs(normal[0]), abs(normal[1]), abs(normal[2])
-    if ax > umbral and ax > ay and ax > az:
-        return "sagital"
-    if ay > umbral and ay > ax and ay > az:
-        return "coronal"
-    if az > umbral and az > ax and az > ay:
-        return "axial"
-    return "oblicuo"
+
+def enlazar_duplicado(origen, destino):
+    """Hardlink de destino a origen (copia si el sistema de archivos no lo admite)."""
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    if os.path.lexists(destino):
+        os.remove(destino)
+    try:
+        os.link(origen, destino)
+    except OSError:
+        shutil.copy2(origen, destino)
+
+
+def enlazar_duplicados(repetidos, ubicacion, primero):
+    """
+    Crea en la salida cada duplicado como hardlink del archivo ya procesado
+    de su primera copia: en el mismo plano y con la descripción de serie de
+    su propia carpeta. ubicacion da (tag_p, out_p, root) de cada archivo y
+    primero, el archivo del que se lee la descripción de serie de cada root.
+    Las copias son siempre del mismo paciente (ver buscar_duplicados).
+    """
+    series = {}
+
+    def serie_de(root):
+        if root not in series:
+            series[root] = leer_descripcion_serie(root, [primero[root]])
+        return series[root]
+
+    n_enlazados = 0
+    sin_enlazar = []
+    for dup, principal in repetidos.items():
+        if dup not in ubicacion or principal not in ubicacion:
+            continue  # no estaba en el trabajo de esta ejecución
+        _, out_d, root_d = ubicacion[dup]
+        _, out_p, root_p = ubicacion[principal]
+        hechos = glob.glob(os.path.join(glob.escape(out_p), "*", glob.escape(serie_de(root_p)),
+                                        glob.escape(os.path.basename(principal))))
+        if len(hechos) != 1:
+            sin_enlazar.append((dup, f"no se encuentra la salida de {principal}"))
+            continue
+        plano = os.path.basename(os.path.dirname(os.path.dirname(hechos[0])))
+        destino = os.path.join(out_d, plano, serie_de(root_d), os.path.basename(dup))
+        if os.path.abspath(destino) != os.path.abspath(hechos[0]):
+            try:
+                enlazar_duplicado(hechos[0], destino)
+            except OSError as e:
+                sin_enlazar.append((dup, str(e)))
+                continue
+        n_enlazados += 1
+    for ruta, motivo in sin_enlazar:
+        print(f"  = Duplicado sin enlazar '{ruta}': {motivo}")
+    print(f"Duplicados: {n_enlazados} enlazados en la salida, {len(sin_enlazar)} sin enlazar")
+
+
+def agrupar_por_paciente(trabajos):
+    """Los trabajos agrupados por su out_p, en el orden en que aparecen."""
+    grupos = {}
+    for t in trabajos:
+        grupos.setdefault(t[3], []).append(t)
+    return list(grupos.values())
+
+
+def resumen_por_worker(resultados):
+    """Agrupa los resultados de procesar_directorio por proceso."""
+    resumen = {}
+    for pid, n_ok, n_bytes, segundos, _, _ in resultados:
+        r = resumen.setdefault(pid, {"archivos": 0, "bytes": 0, "segundos": 0.0})
+        r["archivos"] += n_ok
+        r["bytes"]    += n_bytes
+        r["segundos"] += segundos
+    for r in resumen.values():
+        r["archivos_por_s"] = r["archivos"] / r["segundos"] if r["segundos"] else 0.0
+    return resumen
+
+
+def estimar_memoria(root, dicoms, por_serie=False, pipeline=0, memoria_objeto=0):
+    """
+    Memoria (bytes) que puede ocupar procesar la carpeta de serie root, según
+    la cabecera de su primer archivo: su objeto decodificado por
+    FACTOR_MEMORIA (como mucho memoria_objeto, por encima del cual va en
+    streaming), con por_serie la serie apilada (también acotada por
+    memoria_objeto) y con pipeline los archivos en las colas.
+    """
+    ruta = os.path.join(root, dicoms[0])
+    try:
+        ds = pydicom.dcmread(ruta, force=True, stop_before_pixels=True)
+        tamano = os.path.getsize(ruta)
+    except Exception:
+        return 0
+    pico = FACTOR_MEMORIA * tamano_decodificado(ds)
+    if por_serie:
+        pico *= len(dicoms)
+    if memoria_objeto:
+        pico = min(pico, memoria_objeto)
+    if pipeline:
+        pico += 2 * pipeline * min(tamano, MAX_LECTURA_ANTICIPADA)
+    return pico
+
+
+def ejecutar_trabajos(pool, trabajos, opciones, presupuesto=0, empaquetar=None):
+    """
+    Procesa los trabajos (root, dicoms, tag_p, out_p) en pool con
+    procesar_directorio y devuelve sus resultados según terminan. Con
+    presupuesto (bytes) se envían en orden y solo mientras la memoria
+    estimada de los que están en marcha (ver estimar_memoria) quepa en él;
+    uno que no cabe ni solo se envía cuando no queda ninguno en marcha.
+    Con empaquetar (ver procesar_empaquetado) los trabajos de cada paciente
+    van juntos a un mismo proceso, que escribe sus archivos comprimidos.
+    """
+    def enviar(t):
+        if empaquetar:
+            return pool.submit(procesar_empaquetado, t, empaquetar, **opciones)
+        return pool.submit(procesar_directorio, *t, **opciones)
+
+    def memoria(t):
+        # los trabajos de un paciente empaquetado se procesan uno tras otro
+        return max(estimar_memoria(root, dicoms, opciones.get("por_serie", False),
+                                   opciones.get("pipeline", 0),
+                                   opciones.get("memoria_objeto", 0))
+                   for root, dicoms, _, _ in (t if empaquetar else [t]))
+
+    if empaquetar:
+        trabajos = agrupar_por_paciente(trabajos)
+    if not presupuesto:
+        for fut in as_completed([enviar(t) for t in trabajos]):
+            yield from fut.result() if empaquetar else [fut.result()]
+        return
+    pendientes = deque(trabajos)
+    en_marcha = {}  # futuro -> memoria estimada
+    usado = 0
+    coste = None
+    while pendientes or en_marcha:
+        while pendientes:
+            if coste is None:
+                coste = memoria(pendientes[0])
+            if en_marcha and usado + coste > presupuesto:
+                break
+            fut = enviar(pendientes.popleft())
+            en_marcha[fut] = coste
+            usado += coste
+            coste = None
+        hechos, _ = wait(en_marcha, return_when=FIRST_COMPLETED)
+        for fut in hechos:
+            usado -= en_marcha.pop(fut)
+            yield from fut.result() if empaquetar else [fut.result()]
 
 
-def anonimizar_y_recortar_por_plano(input_folder, output_folder):
+def anonimizar_y_recortar_por_plano(input_folder, output_folder, workers=1,
+                                    lectura_rapida=False, por_serie=False,
+                                    reanudar=False, clave=None, ruta_indice=None,
+                                    telemetria=False, ruta_telemetria=None,
+                                    perfil=None, ruta_perfil=None, decodificador="",
+                                    hilos_codec=1, sintaxis_salida="original",
+                                    plantilla_mascara=None, pool=None, pipeline=0,
+                                    deduplicar=None, duplicados="omitir",
+                                    anonimizacion=None, memoria=0, empaquetar=None):
+    """
+    Con workers > 1 las carpetas de serie se reparten en un pool de procesos;
+    la asignación Paciente_XXXX y los ficheros generados son los mismos que en
+    modo secuencial. lectura_rapida clasifica por cabecera sin decodificar
+    píxeles (ver cargar_archivo) y por_serie recorta los sagitales por pilas
+    (ver procesar_directorio). Con reanudar se lleva un Manifiesto en la
+    carpeta de salida y se omiten los archivos ya procesados y sin cambios.
+    Con clave, Paciente_XXXX se sustituye por un seudónimo derivado del
+    PatientID original (ver seudonimo) en lugar del orden de las carpetas.
+    La entrada se recorre una sola vez (ver indexar_entrada); con ruta_indice
+    el índice se guarda ahí y se reutiliza en las siguientes ejecuciones.
+    Con telemetria (o ruta_telemetria) se mide cada etapa en todos los procesos
+    y se imprime una tabla al final; ruta_telemetria recibe además un registro
+    JSON por archivo y una última línea con el resumen. perfil ("cprofile" o
+    "pyinstrument") vuelca un perfil de la ejecución en ruta_perfil.
+    Los sagitales en sintaxis comprimidas se decodifican una vez con el plugin
+    decodificador (en hilos_codec hilos si son multi-frame) y, tras el
+    recorte, se vuelven a codificar en su sintaxis si es sin pérdida o se
+    guardan en Explicit VR Little Endian (siempre con sintaxis_salida="explicita").
+    plantilla_mascara (ver cargar_plantilla) fija la máscara en mm; por
+    defecto PLANTILLAS_MASCARA["clasica"]. Con pipeline > 0 cada proceso
+    solapa lectura, recorte y escritura (ver procesar_directorio).
+    Con deduplicar ("contenido" o "uid", ver buscar_duplicados) cada
+    instancia repetida se procesa una sola vez; con duplicados="enlazar" las
+    copias se crean en la salida como hardlinks del archivo procesado, si
+    les corresponde el mismo paciente, y con "omitir" no se escriben.
+    anonimizacion es el perfil de anonimización (ver cargar_perfil_anonimizacion
+    y preparar_anonimizacion); por defecto el "minimo".
+    Con memoria (bytes), los trabajos solo se envían al pool mientras su
+    memoria estimada quepa en ella (ver ejecutar_trabajos) y cada proceso
+    tiene como límite por objeto su parte, memoria / workers (ver
+    procesar_directorio).
+    Con empaquetar, (formato, por) con formato "zip", "tar" o "tar.zst" y
+    por "paciente" o "serie", la salida de cada paciente se escribe en
+    archivos comprimidos en lugar de carpetas (ver Empaquetador).
+    pool es un ProcessPoolExecutor ya creado para usar con workers > 1 (para
+    compartirlo entre varias entradas); si no, se crea uno propio.
+    Devuelve un resumen con los archivos procesados, con error y omitidos,
+    bytes, segundos y el rendimiento por proceso ("workers"), o None si no
+    se pudo empezar (la entrada no existe o falta pyinstrument).
+    """
+    inicio = time.perf_counter()
     if not os.path.isdir(input_folder):
         print(f"ERROR: '{input_folder}' no existe o no es carpeta.")
         return
 
-    pacientes = [d for d in os.listdir(input_folder)
-                 if os.path.isdir(os.path.join(input_folder, d))]
-    if not pacientes:
-        pacientes = [""]  # usar la raíz como un único paciente
+    indice = cargar_o_indexar(input_folder, ruta_indice)
+    n_archivos, n_bytes = totales_indice(indice)
+    print(f"Índice: {n_archivos} archivos ({n_bytes / 1e6:.1f} MB) "
+          f"en {len(indice['pacientes'])} carpetas de paciente")
+    if memoria:
+        print(f"Memoria: {memoria / 1e6:.0f} MB entre {workers} workers "
+              f"({memoria // workers / 1e6:.0f} MB por objeto)")
 
-    for idx_p, pac in enumerate(pacientes, start=1):
-        tag_p = f"Paciente_{idx_p:04d}"
-        in_p = os.path.join(input_folder, pac) if pac else input_folder
+    repetidos = {}
+    if deduplicar:
+        repetidos = buscar_duplicados(input_folder, indice, deduplicar)
+        print(f"Duplicados por {deduplicar}: {len(repetidos)} archivos se procesan una sola vez")
+    principales = set(repetidos.values())
+    ubicacion = {}  # ruta de principales y duplicados -> (tag_p, out_p, root)
+    primero = {}    # root -> primer archivo de su unidad de trabajo (descripción de serie)
+
+    # antes de abrir el manifiesto y la telemetría, que no se cerrarían al volver aquí
+    perfilador = None
+    if perfil == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("ERROR: --perfil pyinstrument necesita 'pip install pyinstrument'.")
+            return
+        if workers > 1:
+            print("AVISO: pyinstrument solo perfila el proceso principal; "
+                  "usa --workers 1 o --perfil cprofile.")
+        perfilador = Profiler()
+        perfilador.start()
+
+    manifiesto = None
+    if reanudar:
+        os.makedirs(output_folder, exist_ok=True)
+        manifiesto = Manifiesto(output_folder)
+
+    telemetria = telemetria or ruta_telemetria is not None
+    total = Telemetria() if telemetria else None
+    f_tel = open(ruta_telemetria, "w", encoding="utf-8") if ruta_telemetria else None
+
+    opciones = {"lectura_rapida": lectura_rapida, "por_serie": por_serie,
+                "registrar": reanudar, "telemetria": telemetria,
+                "por_archivo": f_tel is not None,
+                "ruta_perfil": ruta_perfil if perfil == "cprofile" else None,
+                "decodificador": decodificador, "hilos_codec": hilos_codec,
+                "sintaxis_salida": sintaxis_salida, "plantilla_mascara": plantilla_mascara,
+                "pipeline": pipeline, "memoria_objeto": memoria // workers}
+    if anonimizacion is not None:
+        if "sal" not in anonimizacion:
+            anonimizacion = preparar_anonimizacion(anonimizacion, clave)
+        opciones["anonimizacion"] = anonimizacion
+    resultados = []
+
+    def recoger(resultado):
+        if manifiesto is not None:
+            manifiesto.registrar(resultado[4])
+        datos = resultado[5]
+        if datos is not None:
+            total.combinar(datos)
+            if f_tel is not None:
+                for registro in datos["archivos"]:
+                    f_tel.write(json.dumps(registro, ensure_ascii=False) + "\n")
+        resultados.append(resultado[:4] + ([], None))
+
+    trabajos = []
+    de_paciente = []  # sin pool y con empaquetar, las series del paciente actual
+    n_encolados = n_omitidos = n_duplicados = 0
+    for idx_p, paciente in enumerate(indice["pacientes"], start=1):
+        in_p, tag_p = etiqueta_paciente(input_folder, paciente, idx_p, clave)
+        if manifiesto is not None and clave is None:
+            tag_p = manifiesto.etiqueta(in_p, tag_p)
         out_p = os.path.join(output_folder, tag_p)
-        os.makedirs(out_p, exist_ok=True)
+        if not empaquetar:
+            os.makedirs(out_p, exist_ok=True)
         print(f"\nProcesando {tag_p}: {in_p}")
 
-        for root, _, files in os.walk(in_p):
-            dicoms = [f for f in files if not f.startswith('.')]
+        for serie in paciente["series"]:
+            root = os.path.join(input_folder, serie["ruta"]) if serie["ruta"] else input_folder
+            if manifiesto is not None:
+                dicoms = manifiesto.pendientes(root, serie["archivos"])
+                omitidos = len(serie["archivos"]) - len(dicoms)
+                n_omitidos += omitidos
+                if omitidos:
+                    print(f"  = {omitidos} archivos ya procesados en {root}")
+            else:
+                dicoms = [a[0] for a in serie["archivos"]]
+            if repetidos:
+                for f, _, _ in serie["archivos"]:
+                    ruta = os.path.join(root, f)
+                    if ruta in repetidos or ruta in principales:
+                        ubicacion[ruta] = (tag_p, out_p, root)
+                antes = len(dicoms)
+                dicoms = [f for f in dicoms if os.path.join(root, f) not in repetidos]
+                n_duplicados += antes - len(dicoms)
+            primero[root] = (dicoms or [a[0] for a in serie["archivos"]])[0]
             if not dicoms:
                 continue
+            n_encolados += len(dicoms)
+            if workers > 1:
+                trabajos.append((root, dicoms, tag_p, out_p))
+            elif empaquetar:
+                de_paciente.append((root, dicoms, tag_p, out_p))
+            else:
+                recoger(procesar_directorio(root, dicoms, tag_p, out_p, **opciones))
+        if de_paciente:
+            for resultado in procesar_empaquetado(de_paciente, empaquetar, **opciones):
+                recoger(resultado)
+            de_paciente.clear()
+
+    if workers > 1 and trabajos:
+        propio = pool is None
+        if propio:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            for resultado in ejecutar_trabajos(pool, trabajos, opciones, memoria, empaquetar):
+                recoger(resultado)
+        finally:
+            if propio:
+                pool.shutdown()
+
+    if manifiesto is not None:
+        manifiesto.cerrar()
+
+    if repetidos and duplicados == "enlazar":
+        enlazar_duplicados(repetidos, ubicacion, primero)
+
+    if total is not None:
+        resumen_tel = total.resumen()
+        if f_tel is not None:
+            f_tel.write(json.dumps(resumen_tel) + "\n")
+            f_tel.close()
+        imprimir_telemetria(resumen_tel)
+
+    if perfil == "cprofile":
+        partes = glob.glob(glob.escape(ruta_perfil) + ".*")
+        if partes:
+            pstats.Stats(*partes).dump_stats(ruta_perfil)
+            for parte in partes:
+                os.remove(parte)
+            print(f"Perfil cProfile en {ruta_perfil} (python -m pstats {ruta_perfil})")
+    elif perfilador is not None:
+        perfilador.stop()
+        with open(ruta_perfil, "w", encoding="utf-8") as fp:
+            fp.write(perfilador.output_text())
+        print(f"Perfil pyinstrument en {ruta_perfil}")
+
+    resumen = resumen_por_worker(resultados)
+    for pid, r in sorted(resumen.items()):
+        print(f"  [worker {pid}] {r['archivos']} archivos, "
+              f"{r['bytes'] / 1e6:.1f} MB en {r['segundos']:.1f} s "
+              f"({r['archivos_por_s']:.1f} archivos/s)")
+    n_ok = sum(r["archivos"] for r in resumen.values())
+    return {"archivos": n_ok, "errores": n_encolados - n_ok, "omitidos": n_omitidos,
+            "duplicados": n_duplicados, "bytes": sum(r["bytes"] for r in resumen.values()),
+            "segundos": time.perf_counter() - inicio, "workers": resumen}
+
+
+def leer_lista(ruta):
+    """
+    Carpetas de estudio de un archivo de lista: una por línea, ignorando las
+    vacías y los comentarios (#). Las rutas relativas lo son a la carpeta
+    del propio archivo.
+    """
+    base = os.path.dirname(os.path.abspath(ruta))
+    entradas = []
+    with open(ruta, encoding="utf-8") as fp:
+        for linea in fp:
+            linea = linea.strip()
+            if linea and not linea.startswith("#"):
+                entradas.append(os.path.normpath(os.path.join(base, linea)))
+    return entradas
+
+
+def salidas_por_entrada(entradas, output_folder):
+    """
+    Carpeta de salida de cada entrada: output_folder si solo hay una y, si
+    hay varias, output_folder/<nombre de la entrada>, numerando los nombres
+    repetidos para que no se mezclen.
+    """
+    if len(entradas) == 1:
+        return [output_folder]
+    vistos = {}
+    salidas = []
+    for entrada in entradas:
+        nombre = os.path.basename(os.path.normpath(entrada)) or "entrada"
+        vistos[nombre] = vistos.get(nombre, 0) + 1
+        if vistos[nombre] > 1:
+            nombre = f"{nombre}_{vistos[nombre]}"
+        salidas.append(os.path.join(output_folder, nombre))
+    return salidas
+
+
+def ruta_por_entrada(ruta, salida, varias):
+    # con varias entradas, los archivos auxiliares (índice, telemetría,
+    # perfil) llevan el nombre de la carpeta de salida de cada una
+    if ruta is None or not varias:
+        return ruta
+    raiz, ext = os.path.splitext(ruta)
+    return f"{raiz}.{os.path.basename(salida)}{ext}"
 
-            # Leer la serie para usar su descripción
+
+def procesar_entradas(entradas, output_folder, workers=1, ruta_resumen=None, **opciones):
+    """
+    Procesa varias carpetas de entrada una tras otra compartiendo un único
+    pool de workers procesos, de modo que los trabajos de todas pasan por la
+    misma cola acotada. Un fallo en una entrada no detiene las demás.
+    Escribe el resumen de cada entrada y el total en ruta_resumen (JSON) y
+    devuelve el código de salida (SALIDA_OK, SALIDA_ERRORES o SALIDA_FALLO).
+    """
+    inicio = time.perf_counter()
+    salidas = salidas_por_entrada(entradas, output_folder)
+    varias = len(entradas) > 1
+    informes = []
+    pool = None
+    try:
+        for n, (entrada, salida) in enumerate(zip(entradas, salidas), start=1):
+            print(f"\n=== Entrada {n}/{len(entradas)}: {entrada} → {salida}")
+            informe = {"entrada": entrada, "salida": salida}
+            if workers > 1 and pool is None:
+                pool = ProcessPoolExecutor(max_workers=workers)
+            rutas = {k: ruta_por_entrada(opciones.get(k), salida, varias)
+                     for k in ("ruta_indice", "ruta_telemetria", "ruta_perfil")}
             try:
-                ds0 = pydicom.dcmread(os.path.join(root, dicoms[0]), force=True)
-                serie = ds0.get("SeriesDescription", "SinDescripcion").replace(" ", "_")
-            except Exception:
-                serie = "SinDescripcion"
+                r = anonimizar_y_recortar_por_plano(entrada, salida, workers=workers,
+                                                    pool=pool, **{**opciones, **rutas})
+            except Exception as e:
+                print(f"ERROR: la entrada '{entrada}' falló: {e}")
+                informe.update(estado="fallo", error=str(e))
+                if isinstance(e, BrokenProcessPool):
+                    pool = None  # se crea otro para las entradas siguientes
+            else:
+                if r is None:
+                    informe.update(estado="fallo",
+                                   error="no se pudo procesar (ver los mensajes anteriores)")
+                else:
+                    r["workers"] = {str(pid): w for pid, w in r["workers"].items()}
+                    informe.update(r, estado="errores" if r["errores"] else "ok")
+            informes.append(informe)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    estados = [i["estado"] for i in informes]
+    codigo = (SALIDA_FALLO if "fallo" in estados else
+              SALIDA_ERRORES if "errores" in estados else SALIDA_OK)
+    total = {clave: sum(i.get(clave, 0) for i in informes)
+             for clave in ("archivos", "errores", "omitidos", "duplicados", "bytes")}
+    total["segundos"] = time.perf_counter() - inicio
+    print(f"\nResumen: {len(entradas)} entradas, {total['archivos']} archivos, "
+          f"{total['errores']} con error, {total['omitidos']} omitidos, "
+          f"{total['duplicados']} duplicados, "
+          f"{estados.count('fallo')} entradas fallidas en {total['segundos']:.1f} s "
+          f"(código {codigo})")
+    if ruta_resumen:
+        with open(ruta_resumen, "w", encoding="utf-8") as fp:
+            json.dump({"codigo_salida": codigo, "total": total, "entradas": informes},
+                      fp, ensure_ascii=False, indent=2)
+    return codigo
+
+
+def repartir(entradas, output_folder, pacientes_por_unidad=1, clave=None, ruta_indice=None):
+    """
+    Unidades de trabajo del modo distribuido: cada una con la entrada, la
+    salida y pacientes_por_unidad pacientes del índice (con sus series y
+    archivos) y su Paciente_XXXX ya asignado, igual que en una ejecución
+    local, para que los nodos no necesiten la clave de seudónimos.
+    """
+    unidades = []
+    varias = len(entradas) > 1
+    for entrada, salida in zip(entradas, salidas_por_entrada(entradas, output_folder)):
+        if not os.path.isdir(entrada):
+            print(f"ERROR: '{entrada}' no existe o no es carpeta.")
+            continue
+        indice = cargar_o_indexar(entrada, ruta_por_entrada(ruta_indice, salida, varias))
+        pacientes = []
+        for idx_p, paciente in enumerate(indice["pacientes"], start=1):
+            _, tag_p = etiqueta_paciente(entrada, paciente, idx_p, clave)
+            pacientes.append({"tag": tag_p, "series": paciente["series"]})
+        for i in range(0, len(pacientes), pacientes_por_unidad):
+            grupo = pacientes[i:i + pacientes_por_unidad]
+            unidades.append({"entrada": os.path.abspath(entrada),
+                             "salida": os.path.abspath(salida), "pacientes": grupo,
+                             "total": sum(len(s["archivos"]) for p in grupo
+                                          for s in p["series"])})
+    return unidades
+
+
+def procesar_unidad(unidad, opciones, workers=1, pool=None, memoria=0):
+    """
+    Procesa una unidad de trabajo de la cola con procesar_directorio (en pool
+    si workers > 1, dentro de memoria como en ejecutar_trabajos) y devuelve
+    archivos procesados, con error y bytes. Si las opciones incluyen
+    "empaquetar", la salida va en archivos comprimidos (ver
+    procesar_empaquetado).
+    """
+    opciones = dict(opciones)
+    empaquetar = opciones.pop("empaquetar", None)
+    trabajos = []
+    for paciente in unidad["pacientes"]:
+        out_p = os.path.join(unidad["salida"], paciente["tag"])
+        if not empaquetar:
+            os.makedirs(out_p, exist_ok=True)
+        for serie in paciente["series"]:
+            root = (os.path.join(unidad["entrada"], serie["ruta"]) if serie["ruta"]
+                    else unidad["entrada"])
+            dicoms = [a[0] for a in serie["archivos"]]
+            if dicoms:
+                trabajos.append((root, dicoms, paciente["tag"], out_p))
+    if workers > 1:
+        resultados = list(ejecutar_trabajos(pool, trabajos, opciones, memoria, empaquetar))
+    elif empaquetar:
+        resultados = [r for grupo in agrupar_por_paciente(trabajos)
+                      for r in procesar_empaquetado(grupo, empaquetar, **opciones)]
+    else:
+        resultados = [procesar_directorio(*t, **opciones) for t in trabajos]
+    n_ok = sum(r[1] for r in resultados)
+    return {"archivos": n_ok, "errores": unidad["total"] - n_ok,
+            "bytes": sum(r[2] for r in resultados)}
+
+
+def trabajar(ruta_cola, workers=1, nodo=None, memoria=0):
+    """
+    Nodo del modo distribuido: reclama unidades de la cola hasta que no
+    quede ninguna disponible, las procesa con las opciones que publicó el
+    coordinador e informa del resultado. Una unidad que lanza una excepción
+    vuelve a la cola para reintentarse. memoria es la del nodo, como en
+    anonimizar_y_recortar_por_plano. Devuelve el código de salida.
+    """
+    nodo = nodo or f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        cola = abrir_cola(ruta_cola, crear=False)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"ERROR: no se puede abrir la cola {ruta_cola}: {e}")
+        return SALIDA_FALLO
+    opciones = dict(cola.opciones(), memoria_objeto=memoria // workers)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    n_unidades = n_errores = n_fallos = 0
+    try:
+        while True:
+            reclamada = cola.reclamar(nodo)
+            if reclamada is None:
+                break
+            id_unidad, unidad = reclamada
+            print(f"\n=== [{nodo}] Unidad {id_unidad}: "
+                  f"{', '.join(p['tag'] for p in unidad['pacientes'])}")
+            try:
+                resultado = procesar_unidad(unidad, opciones, workers, pool, memoria)
+            except Exception as e:
+                print(f"ERROR: la unidad {id_unidad} falló: {e}")
+                cola.fallar(id_unidad, str(e))
+                n_fallos += 1
+                if isinstance(e, BrokenProcessPool):
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                continue
+            cola.completar(id_unidad, resultado)
+            n_unidades += 1
+            n_errores += resultado["errores"]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        cola.cerrar()
+    print(f"\n[{nodo}] {n_unidades} unidades hechas, {n_errores} archivos con error, "
+          f"{n_fallos} intentos fallidos")
+    return SALIDA_FALLO if n_fallos else SALIDA_ERRORES if n_errores else SALIDA_OK
+
+
+def imprimir_progreso(p):
+    u = p["unidades"]
+    n_unidades = sum(u.values())
+    print(f"Unidades: {u.get('hecha', 0)}/{n_unidades} hechas, {u.get('en_curso', 0)} en curso, "
+          f"{u.get('pendiente', 0)} pendientes, {u.get('fallida', 0)} fallidas")
+    velocidad = p["archivos"] / p["segundos"] if p["segundos"] else 0.0
+    print(f"Archivos: {p['archivos']}/{p['total']} procesados, {p['errores']} con error, "
+          f"{p['bytes'] / 1e6:.1f} MB ({velocidad:.1f} archivos/s en conjunto)")
+    for nodo, n in sorted(p["nodos"].items()):
+        print(f"  [{nodo}] {n['unidades']} unidades, {n['archivos']} archivos, "
+              f"{n['bytes'] / 1e6:.1f} MB")
+    for id_unidad, nodo, intentos, error in p["fallidas"]:
+        print(f"  ⚠️ Unidad {id_unidad} fallida tras {intentos} intentos "
+              f"(último en {nodo}): {error}")
+
 
-            for f in dicoms:
-                ruta = os.path.join(root, f)
-                try:
-                    ds = pydicom.dcmread(ruta, force=True)
+def codigo_progreso(p):
+    if p["unidades"].get("fallida"):
+        return SALIDA_FALLO
+    return SALIDA_ERRORES if p["errores"] else SALIDA_OK
 
-                    # 1) Anonimizar
-                    ds.PatientName      = tag_p
-                    ds.PatientID        = tag_p
-                    ds.OtherPatientIDs  = None
-                    ds.PatientBirthDate = ""
-                    ds.PatientSex       = ""
 
-                    # 2) Detectar plano
-                    plano = "sin_pixel"
-                    if hasattr(ds, "pixel_array"):
-                        plano = clasificar_plano(ds)
+def coordinar(ruta_cola, entradas, output_folder, opciones, pacientes_por_unidad=1,
+              clave=None, ruta_indice=None, max_intentos=3, caducidad=3600, esperar=False):
+    """
+    Coordinador del modo distribuido: indexa las entradas, las reparte en
+    unidades (ver repartir) y las publica en la cola junto con las opciones
+    de procesado. Sin clave, si la cola ya tiene opciones se reutiliza su
+    sal aleatoria, para que las unidades que faltan remapeen los UID igual
+    que las ya hechas; cualquier otra diferencia en las opciones es un
+    error (ver ColaSQLite.publicar). Con esperar, muestra el progreso hasta
+    que no queden unidades pendientes ni en curso. Devuelve el código de
+    salida.
+    """
+    unidades = repartir(entradas, output_folder, pacientes_por_unidad, clave, ruta_indice)
+    if not unidades:
+        print("ERROR: no hay nada que repartir.")
+        return SALIDA_FALLO
+    cola = abrir_cola(ruta_cola)
+    try:
+        previas = cola.opciones().get("anonimizacion")
+        if clave is None and previas and opciones.get("anonimizacion"):
+            opciones = dict(opciones, anonimizacion=dict(opciones["anonimizacion"],
+                                                         sal=previas["sal"]))
+        try:
+            nuevas = cola.publicar(unidades, opciones, max_intentos, caducidad)
+        except ValueError as e:
+            print(f"ERROR: {e}; usa otra cola o las mismas opciones.")
+            return SALIDA_FALLO
+        print(f"Publicadas {nuevas} unidades nuevas de {len(unidades)} "
+              f"({sum(u['total'] for u in unidades)} archivos) en {ruta_cola}")
+        p = cola.progreso()
+        while esperar and (p["unidades"].get("pendiente") or p["unidades"].get("en_curso")):
+            imprimir_progreso(p)
+            time.sleep(10)
+            p = cola.progreso()
+        if esperar:
+            imprimir_progreso(p)
+    finally:
+        cola.cerrar()
+    return codigo_progreso(p) if esperar else SALIDA_OK
 
-                    # 3) Aplicar máscara solo en sagitales
-                    if plano == "sagital":
-                        img = ds.pixel_array
-                        m   = generar_mascara_personalizada(*img.shape)
-                        rec = aplicar_mascara(img, m)
-                        ds.PixelData = rec.tobytes()
 
-                    # 4) Construir carpeta de destino:
-                    #    OUTPUT/Paciente_XXXX/plano/SerieDescription/
-                    plano_dir = os.path.join(out_p, plano)
-                    serie_dir = os.path.join(plano_dir, serie)
-                    os.makedirs(serie_dir, exist_ok=True)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("entradas", nargs="*", metavar="ENTRADA",
+                        help="carpetas de estudio a procesar")
+    parser.add_argument("--lista", metavar="ARCHIVO",
+                        help="archivo con una carpeta de estudio por línea (se suma a ENTRADA)")
+    parser.add_argument("--salida", default=OUTPUT_FOLDER,
+                        help=f"carpeta de salida (por defecto {OUTPUT_FOLDER}); con varias "
+                             "entradas, cada una va a una subcarpeta con su nombre")
+    parser.add_argument("--resumen-json", metavar="ARCHIVO",
+                        help="escribir en ARCHIVO el resultado de cada entrada y el total (JSON)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="procesos en paralelo, compartidos por todas las entradas "
+                             "(1 = secuencial)")
+    parser.add_argument("--lectura-rapida", action="store_true",
+                        help="clasificar por cabecera y decodificar solo los sagitales")
+    parser.add_argument("--por-serie", action="store_true",
+                        help="recortar los sagitales de cada serie como una pila 3D")
+    parser.add_argument("--reanudar", action="store_true",
+                        help=f"omitir lo ya procesado según {MANIFIESTO} en la salida")
+    parser.add_argument("--indice", metavar="ARCHIVO",
+                        help="guardar el índice de la entrada en ARCHIVO (JSON) o "
+                             "reutilizarlo si ya existe, sin volver a recorrer la entrada")
+    parser.add_argument("--clave-seudonimo", metavar="ARCHIVO",
+                        help="archivo con la clave secreta para seudónimos estables por "
+                             "PatientID (o variable de entorno ANON_CLAVE_SEUDONIMO)")
+    parser.add_argument("--perfil-anonimizacion", metavar="NOMBRE|ARCHIVO", default="minimo",
+                        help=f"reglas de anonimización: {', '.join(PERFILES_ANONIMIZACION)} "
+                             "(PS3.15 básico: UID remapeados, privados eliminados) o un JSON "
+                             "con el perfil base y las reglas a cambiar")
+    parser.add_argument("--desplazar-fechas", type=int, default=0, metavar="DIAS",
+                        help="desplazar las fechas de cada paciente un número fijo de días "
+                             "entre -DIAS y DIAS en lugar de borrarlas (0 = no)")
+    parser.add_argument("--telemetria", action="store_true",
+                        help="medir el tiempo de cada etapa y mostrar una tabla al final")
+    parser.add_argument("--telemetria-jsonl", metavar="ARCHIVO",
+                        help="escribir un registro JSON por archivo y el resumen final "
+                             "en ARCHIVO (implica --telemetria)")
+    parser.add_argument("--perfil", choices=["cprofile", "pyinstrument"],
+                        help="perfilar la ejecución (cprofile incluye los workers)")
+    parser.add_argument("--perfil-salida", metavar="RUTA", default="perfil.out",
+                        help="dónde guardar el perfil (por defecto perfil.out)")
+    parser.add_argument("--decodificador", default="",
+                        help="plugin de pydicom para sintaxis comprimidas (pylibjpeg, "
+                             "gdcm, pillow, pyjpegls...; por defecto el primero disponible)")
+    parser.add_argument("--hilos-codec", type=int, default=1,
+                        help="hilos para decodificar los frames de objetos multi-frame comprimidos")
+    parser.add_argument("--sintaxis-salida", choices=["original", "explicita"], default="original",
+                        help="sagitales comprimidos: volver a codificarlos en su sintaxis si es "
+                             "sin pérdida (original) o guardarlos sin comprimir (explicita)")
+    parser.add_argument("--plantilla-mascara", metavar="NOMBRE|ARCHIVO", default="clasica",
+                        help=f"máscara facial: {', '.join(PLANTILLAS_MASCARA)} o un JSON "
+                             "con la plantilla base y los parámetros en mm a cambiar")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="N",
+                        help="leer y escribir en hilos aparte, con colas de N archivos, "
+                             "mientras se recorta (0 = desactivado)")
+    parser.add_argument("--memoria", type=int, default=0, metavar="MB",
+                        help="memoria para píxeles entre todos los workers: los trabajos "
+                             "esperan a que haya sitio y los objetos que no caben en la parte "
+                             "de un worker se procesan en streaming (0 = sin límite)")
+    parser.add_argument("--deduplicar", choices=["contenido", "uid"],
+                        help="procesar una sola vez los archivos idénticos (contenido) o "
+                             "con el mismo SOPInstanceUID (uid)")
+    parser.add_argument("--duplicados", choices=["omitir", "enlazar"], default="omitir",
+                        help="con --deduplicar, no escribir las copias (omitir) o crearlas "
+                             "como hardlinks del archivo procesado (enlazar)")
+    parser.add_argument("--empaquetar", choices=list(EXTENSIONES_EMPAQUETADO),
+                        help="escribir la salida en archivos comprimidos en lugar de carpetas, "
+                             "sin archivos temporales (tar.zst necesita 'pip install zstandard')")
+    parser.add_argument("--archivo-por", choices=["paciente", "serie"], default="paciente",
+                        help="con --empaquetar, un archivo por paciente (Paciente_XXXX.zip) "
+                             "o por serie (Paciente_XXXX/plano/serie.zip)")
+    distribuido = parser.add_argument_group(
+        "modo distribuido", "un coordinador reparte los pacientes en unidades de trabajo "
+        "en una cola compartida y los nodos las reclaman y procesan")
+    modo = distribuido.add_mutually_exclusive_group()
+    modo.add_argument("--coordinar", metavar="COLA",
+                      help="repartir las entradas en unidades y publicarlas en COLA (SQLite) "
+                           "con las opciones de procesado indicadas, sin procesarlas")
+    modo.add_argument("--trabajar", metavar="COLA",
+                      help="procesar unidades de COLA hasta que no quede ninguna "
+                           "(con --workers procesos)")
+    modo.add_argument("--progreso", metavar="COLA", help="mostrar el avance de COLA y salir")
+    distribuido.add_argument("--pacientes-por-unidad", type=int, default=1, metavar="N",
+                             help="pacientes en cada unidad de trabajo (por defecto 1)")
+    distribuido.add_argument("--max-intentos", type=int, default=3, metavar="N",
+                             help="intentos de cada unidad antes de darla por fallida")
+    distribuido.add_argument("--caducidad", type=float, default=3600, metavar="S",
+                             help="segundos tras los que una unidad en curso se puede volver "
+                                  "a reclamar (nodo caído)")
+    distribuido.add_argument("--esperar", action="store_true",
+                             help="con --coordinar, mostrar el progreso hasta que acabe")
+    parser.add_argument("--inventario", metavar="ARCHIVO",
+                        help="solo leer las cabeceras de las entradas y escribir en ARCHIVO "
+                             "(.csv, o .parquet con pandas) los archivos por paciente, serie, "
+                             "plano, sintaxis y matriz, sin procesar nada (con --workers procesos)")
+    parser.add_argument("--hojas-qa", metavar="CARPETA",
+                        help="al terminar, generar en CARPETA hojas de contacto PNG y un "
+                             "index.html para revisar el recorte (ver hojas_contacto.py)")
+    args = parser.parse_args(argv)
+
+    entradas = list(args.entradas)
+    try:
+        if args.lista:
+            entradas += leer_lista(args.lista)
+        plantilla_mascara = cargar_plantilla(args.plantilla_mascara)
+        perfil_anonimizacion = cargar_perfil_anonimizacion(args.perfil_anonimizacion)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    if args.memoria < 0:
+        parser.error("--memoria no puede ser negativo")
+    if args.progreso:
+        try:
+            cola = abrir_cola(args.progreso, crear=False)
+        except (sqlite3.Error, ValueError) as e:
+            print(f"ERROR: no se puede abrir la cola {args.progreso}: {e}")
+            return SALIDA_FALLO
+        try:
+            p = cola.progreso()
+        finally:
+            cola.cerrar()
+        imprimir_progreso(p)
+        return codigo_progreso(p)
+    if args.trabajar:
+        if args.workers < 1:
+            parser.error("--workers debe ser al menos 1")
+        try:
+            return trabajar(args.trabajar, args.workers, memoria=args.memoria << 20)
+        except KeyboardInterrupt:
+            print("\nInterrumpido.")
+            return SALIDA_INTERRUMPIDO
+
+    # la misma carpeta indicada dos veces se procesa una sola vez
+    entradas = list(dict.fromkeys(os.path.normpath(e) for e in entradas))
+    if not entradas:
+        parser.error("indica al menos una carpeta de entrada o --lista")
+    if args.workers < 1:
+        parser.error("--workers debe ser al menos 1")
+    if args.pipeline < 0:
+        parser.error("--pipeline no puede ser negativo")
+    if args.pacientes_por_unidad < 1 or args.max_intentos < 1:
+        parser.error("--pacientes-por-unidad y --max-intentos deben ser al menos 1")
+    if args.desplazar_fechas < 0:
+        parser.error("--desplazar-fechas no puede ser negativo")
+    if args.inventario:
+        if args.inventario.endswith(".parquet"):
+            try:
+                import pandas
+                pandas.io.parquet.get_engine("auto")
+            except ImportError:
+                parser.error("--inventario .parquet necesita 'pip install pandas pyarrow'")
+        rutas_indice = [ruta_por_entrada(args.indice, salida, len(entradas) > 1)
+                        for salida in salidas_por_entrada(entradas, args.salida)]
+        try:
+            tabla = inventariar(entradas, args.inventario, rutas_indice, args.workers)
+            return SALIDA_FALLO if tabla is None else SALIDA_OK
+        except KeyboardInterrupt:
+            print("\nInterrumpido.")
+            return SALIDA_INTERRUMPIDO
+    empaquetar = None
+    if args.empaquetar:
+        if args.reanudar or args.hojas_qa or args.duplicados == "enlazar":
+            parser.error("--empaquetar no admite --reanudar, --hojas-qa ni --duplicados enlazar")
+        if args.empaquetar == "tar.zst":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                parser.error("--empaquetar tar.zst necesita 'pip install zstandard'")
+        empaquetar = (args.empaquetar, args.archivo_por)
 
-                    # 5) Guardar el DICOM procesado
-                    destino = os.path.join(serie_dir, f)
-                    ds.save_as(destino)
+    clave = None
+    if args.clave_seudonimo:
+        with open(args.clave_seudonimo, "rb") as fk:
+            clave = fk.read().strip()
+    elif os.environ.get("ANON_CLAVE_SEUDONIMO"):
+        clave = os.environ["ANON_CLAVE_SEUDONIMO"].encode("utf-8")
+    anonimizacion = preparar_anonimizacion(perfil_anonimizacion, clave, args.desplazar_fechas)
+    remapea_uids = "U" in perfil_anonimizacion["reglas"].values()
+    if clave is None and (remapea_uids or args.desplazar_fechas):
+        print("AVISO: sin --clave-seudonimo, los UID remapeados y las fechas desplazadas "
+              "cambian en cada ejecución.")
 
-                    print(f"  • [{plano:8}] {serie}/{f} → guardado en {plano}/{serie}")
+    if args.coordinar:
+        # lo que los nodos aplican a cada unidad, igual en todos
+        opciones = {"lectura_rapida": args.lectura_rapida, "por_serie": args.por_serie,
+                    "decodificador": args.decodificador, "hilos_codec": args.hilos_codec,
+                    "sintaxis_salida": args.sintaxis_salida,
+                    "plantilla_mascara": plantilla_mascara, "pipeline": args.pipeline,
+                    "anonimizacion": anonimizacion, "empaquetar": empaquetar}
+        try:
+            return coordinar(args.coordinar, entradas, args.salida, opciones,
+                             args.pacientes_por_unidad, clave, args.indice,
+                             args.max_intentos, args.caducidad, args.esperar)
+        except KeyboardInterrupt:
+            print("\nInterrumpido.")
+            return SALIDA_INTERRUMPIDO
 
-                except Exception as e:
-                    print(f"  ⚠️ Error procesando '{ruta}': {e}")
+    try:
+        codigo = procesar_entradas(entradas, args.salida, workers=args.workers,
+                                   ruta_resumen=args.resumen_json,
+                                   lectura_rapida=args.lectura_rapida,
+                                   por_serie=args.por_serie,
+                                   reanudar=args.reanudar, clave=clave,
+                                   ruta_indice=args.indice,
+                                   telemetria=args.telemetria,
+                                   ruta_telemetria=args.telemetria_jsonl,
+                                   perfil=args.perfil, ruta_perfil=args.perfil_salida,
+                                   decodificador=args.decodificador,
+                                   hilos_codec=args.hilos_codec,
+                                   sintaxis_salida=args.sintaxis_salida,
+                                   plantilla_mascara=plantilla_mascara,
+                                   pipeline=args.pipeline,
+                                   deduplicar=args.deduplicar,
+                                   duplicados=args.duplicados,
+                                   anonimizacion=anonimizacion,
+                                   memoria=args.memoria << 20,
+                                   empaquetar=empaquetar)
+        if args.hojas_qa:
+            # junto a este script; solo se importa si se pide
+            from hojas_contacto import generar_hojas
+            for entrada, salida in zip(entradas, salidas_por_entrada(entradas, args.salida)):
+                if os.path.isdir(salida):
+                    qa = (os.path.join(args.hojas_qa, os.path.basename(salida))
+                          if len(entradas) > 1 else args.hojas_qa)
+                    generar_hojas(salida, qa, originales=entrada, workers=args.workers,
+                                  sal_uid=anonimizacion["sal"] if remapea_uids else None)
+        return codigo
+    except KeyboardInterrupt:
+        print("\nInterrumpido.")
+        return SALIDA_INTERRUMPIDO
 
 
 if __name__ == "__main__":
-    anonimizar_y_recortar_por_plano(INPUT_FOLDER, OUTPUT_FOLDER)
+    sys.exit(main())
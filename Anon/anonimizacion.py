@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+anonimizacion.py
+
+Perfiles de anonimización del anonimizador (Sytem-without-gui-remastered.py):
+carga y validación de los perfiles, su compilación en una tabla por
+etiqueta y su aplicación a la cabecera de cada archivo, con los UID
+remapeados y las fechas desplazadas de forma determinista a partir de una
+sal, para que todos los procesos y nodos obtengan el mismo resultado.
+"""
+
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import secrets
+from functools import lru_cache
+
+import pydicom
+
+
+# Perfiles de anonimización: reglas {atributo: acción} que se compilan una vez
+# en una tabla por etiqueta (ver compilar_anonimizacion). Acciones: X eliminar,
+# Z vaciar, D valor ficticio, U remapear UID, K conservar, P seudónimo del
+# paciente y "=texto" poner ese valor. "siempre" son los atributos que se
+# crean si el archivo no los trae. "minimo" es la anonimización original;
+# "basico" sigue el perfil básico de DICOM PS3.15 (anexo E) en lo que afecta
+# a imágenes, incluidos los atributos dentro de secuencias y los privados.
+PERFILES_ANONIMIZACION = {
+    "minimo": {
+        "reglas": {"PatientName": "P", "PatientID": "P", "OtherPatientIDs": "Z",
+                   "PatientBirthDate": "Z", "PatientSex": "Z"},
+        "siempre": ["PatientName", "PatientID", "OtherPatientIDs", "PatientBirthDate",
+                    "PatientSex"],
+        "eliminar_privados": False,
+    },
+    "basico": {
+        "reglas": {
+            # paciente
+            "PatientName": "P", "PatientID": "P", "PatientBirthDate": "Z",
+            "PatientSex": "Z", "PatientBirthTime": "X", "OtherPatientIDs": "X",
+            "OtherPatientIDsSequence": "X", "OtherPatientNames": "X",
+            "PatientBirthName": "X", "PatientMotherBirthName": "X", "PatientAddress": "X",
+            "PatientTelephoneNumbers": "X", "PatientAge": "X", "PatientSize": "X",
+            "PatientWeight": "X", "MilitaryRank": "X", "BranchOfService": "X",
+            "EthnicGroup": "X", "Occupation": "X", "AdditionalPatientHistory": "X",
+            "PatientComments": "X", "MedicalRecordLocator": "X", "MedicalAlerts": "X",
+            "Allergies": "X", "CountryOfResidence": "X", "RegionOfResidence": "X",
+            "PatientReligiousPreference": "X", "PregnancyStatus": "X", "SmokingStatus": "X",
+            "LastMenstrualDate": "X", "PatientInsurancePlanCodeSequence": "X",
+            "IssuerOfPatientID": "X", "PatientState": "X", "SpecialNeeds": "X",
+            "ResponsiblePerson": "X", "ResponsibleOrganization": "X",
+            "PatientSexNeutered": "X", "ReferencedPatientSequence": "X",
+            "CurrentPatientLocation": "X", "PatientInstitutionResidence": "X",
+            "PersonAddress": "X", "PersonTelephoneNumbers": "X",
+            # estudio, visita y petición
+            "StudyDate": "Z", "StudyTime": "Z", "AccessionNumber": "Z", "StudyID": "Z",
+            "ReferringPhysicianName": "Z", "ReferringPhysicianAddress": "X",
+            "ReferringPhysicianTelephoneNumbers": "X",
+            "ReferringPhysicianIdentificationSequence": "X", "ConsultingPhysicianName": "X",
+            "StudyDescription": "X", "StudyComments": "X", "PhysiciansOfRecord": "X",
+            "PhysiciansOfRecordIdentificationSequence": "X",
+            "NameOfPhysiciansReadingStudy": "X",
+            "PhysiciansReadingStudyIdentificationSequence": "X",
+            "ReferencedStudySequence": "X", "ReferencedPerformedProcedureStepSequence": "X",
+            "AdmittingDiagnosesDescription": "X", "AdmissionID": "X",
+            "IssuerOfAdmissionID": "X", "AdmittingDate": "X", "AdmittingTime": "X",
+            "DischargeDiagnosisDescription": "X", "VisitComments": "X",
+            "ServiceEpisodeID": "X", "ServiceEpisodeDescription": "X",
+            "RequestingPhysician": "X", "RequestedProcedureDescription": "X",
+            "RequestedProcedureID": "X", "ReasonForStudy": "X",
+            "RequestAttributesSequence": "X", "ScheduledProcedureStepDescription": "X",
+            "ScheduledPerformingPhysicianName": "X", "ScheduledStationName": "X",
+            # equipo, centro y personal
+            "InstitutionName": "X", "InstitutionAddress": "X",
+            "InstitutionCodeSequence": "X", "InstitutionalDepartmentName": "X",
+            "StationName": "X", "PerformedStationName": "X", "PerformedLocation": "X",
+            "DeviceSerialNumber": "X", "PlateID": "X", "DetectorID": "X", "GantryID": "X",
+            "CassetteID": "X", "OperatorsName": "X", "OperatorIdentificationSequence": "X",
+            "PerformingPhysicianName": "X", "PerformingPhysicianIdentificationSequence": "X",
+            "ActualHumanPerformersSequence": "X", "HumanPerformerName": "X",
+            "HumanPerformerOrganization": "X", "InterpretationAuthor": "X",
+            "PerformedProcedureStepID": "X", "PerformedProcedureStepDescription": "X",
+            "PerformedProcedureStepStartDate": "X", "PerformedProcedureStepStartTime": "X",
+            # serie, adquisición e instancia
+            "SeriesDate": "X", "SeriesTime": "X", "AcquisitionDate": "X",
+            "AcquisitionTime": "X", "AcquisitionDateTime": "X", "ContentDate": "Z",
+            "ContentTime": "Z", "InstanceCreationDate": "X", "InstanceCreationTime": "X",
+            "TimezoneOffsetFromUTC": "X", "ProtocolName": "X", "SeriesDescription": "X",
+            "ImageComments": "X", "FrameComments": "X", "DerivationDescription": "X",
+            "AcquisitionComments": "X", "ContentCreatorName": "Z", "PersonName": "D",
+            "VerifyingObserverName": "D", "VerifyingOrganization": "D",
+            "ContentSequence": "X", "ModifiedAttributesSequence": "X",
+            "OriginalAttributesSequence": "X", "DigitalSignatureUID": "X",
+            # identificadores únicos
+            "StudyInstanceUID": "U", "SeriesInstanceUID": "U", "SOPInstanceUID": "U",
+            "MediaStorageSOPInstanceUID": "U", "FrameOfReferenceUID": "U",
+            "SynchronizationFrameOfReferenceUID": "U", "ReferencedSOPInstanceUID": "U",
+            "ReferencedFrameOfReferenceUID": "U", "RelatedFrameOfReferenceUID": "U",
+            "IrradiationEventUID": "U", "InstanceCreatorUID": "U",
+            "StorageMediaFileSetUID": "U", "TransactionUID": "U", "ConcatenationUID": "U",
+            "DimensionOrganizationUID": "U", "UID": "U", "RequestedSOPInstanceUID": "U",
+            "FiducialUID": "U", "TargetUID": "U",
+            # constancia de la anonimización
+            "PatientIdentityRemoved": "=YES",
+            "DeidentificationMethod": "=DICOM PS3.15 perfil basico",
+        },
+        "siempre": ["PatientName", "PatientID", "PatientIdentityRemoved",
+                    "DeidentificationMethod"],
+        "eliminar_privados": True,
+    },
+}
+
+
+# valores de la acción D según el VR (los demás VR se vacían)
+VALORES_FICTICIOS = {"PN": "ANONIMO", "LO": "ANONIMO", "SH": "ANONIMO", "CS": "ANONIMO",
+                     "LT": "ANONIMO", "ST": "ANONIMO", "UT": "ANONIMO", "DA": "19000101",
+                     "TM": "000000", "DT": "19000101000000", "AS": "000Y", "IS": "0",
+                     "DS": "0"}
+
+
+def etiqueta_regla(nombre):
+    """Etiqueta (int) de una regla: palabra clave DICOM, "GGGGEEEE" o "(GGGG,EEEE)"."""
+    tag = pydicom.datadict.tag_for_keyword(nombre)
+    if tag is not None:
+        return tag
+    try:
+        return int(nombre.strip("()").replace(",", ""), 16)
+    except ValueError:
+        raise ValueError(f"atributo DICOM desconocido en el perfil: '{nombre}'") from None
+
+
+def cargar_perfil_anonimizacion(nombre):
+    """
+    Reglas de anonimización para un nombre de PERFILES_ANONIMIZACION o un
+    JSON con {"perfil": base} (por defecto "basico"), "reglas" que se suman
+    o sustituyen a las de la base, "siempre" y "eliminar_privados".
+    ValueError si no existe, trae claves desconocidas o reglas no válidas.
+    """
+    if nombre in PERFILES_ANONIMIZACION:
+        perfil = json.loads(json.dumps(PERFILES_ANONIMIZACION[nombre]))
+    elif not os.path.isfile(nombre):
+        raise ValueError(f"perfil de anonimización desconocido: '{nombre}' "
+                         f"(disponibles: {', '.join(PERFILES_ANONIMIZACION)})")
+    else:
+        with open(nombre, encoding="utf-8") as fp:
+            config = json.load(fp)
+        base = config.pop("perfil", "basico")
+        if base not in PERFILES_ANONIMIZACION:
+            raise ValueError(f"{nombre}: perfil base desconocido '{base}'")
+        perfil = json.loads(json.dumps(PERFILES_ANONIMIZACION[base]))
+        sobrantes = set(config) - set(perfil)
+        if sobrantes:
+            raise ValueError(f"{nombre}: claves desconocidas {sorted(sobrantes)}")
+        perfil["reglas"].update(config.get("reglas", {}))
+        perfil["siempre"] = config.get("siempre", perfil["siempre"])
+        perfil["eliminar_privados"] = bool(config.get("eliminar_privados",
+                                                      perfil["eliminar_privados"]))
+    compilar_anonimizacion(perfil)  # valida reglas y atributos
+    return perfil
+
+
+def preparar_anonimizacion(perfil, clave=None, desplazar_fechas=0):
+    """
+    Perfil listo para repartir a los procesos: las reglas de perfil más la
+    sal de los UID y del desplazamiento de fechas y el rango de este en
+    días (0 = no desplazar). Con clave, la sal se deriva de ella y los UID y
+    fechas son los mismos en todas las ejecuciones; sin ella es aleatoria y
+    solo son coherentes dentro de esta ejecución.
+    """
+    if clave is not None:
+        sal = hmac.new(clave, b"uids", hashlib.sha256).hexdigest()
+    else:
+        sal = secrets.token_hex(32)
+    return dict(perfil, sal=sal, desplazar_fechas=desplazar_fechas)
+
+
+def compilar_anonimizacion(anonimizacion):
+    # una vez por proceso y perfil: el mismo perfil llega en cada unidad de trabajo
+    return _compilar_anonimizacion(json.dumps(anonimizacion, sort_keys=True))
+
+
+@lru_cache(maxsize=8)
+def _compilar_anonimizacion(texto):
+    """
+    Tabla de acciones por etiqueta para anonimizar_cabecera: {tag: acción},
+    con las acciones de fecha (DA, DT) cambiadas a S (desplazar) si hay
+    desplazamiento, salvo las del paciente (grupo 0010: nacimiento, última
+    menstruación...), que desplazadas seguirían identificándolo; los
+    atributos "siempre" con su VR y si hace falta
+    recorrer el dataset (si no, basta con asignar los "siempre").
+    """
+    anonimizacion = json.loads(texto)
+    dias = int(anonimizacion.get("desplazar_fechas") or 0)
+    tabla = {}
+    for nombre, accion in anonimizacion["reglas"].items():
+        if accion not in ("X", "Z", "D", "U", "K", "P") and not accion.startswith("="):
+            raise ValueError(f"acción de anonimización no válida para {nombre}: '{accion}'")
+        tag = etiqueta_regla(nombre)
+        if tag >> 16 & 1 and accion not in ("X", "K", "Z"):
+            # en Implicit VR el VR de un privado es desconocido (UN): solo admite vaciarlo
+            raise ValueError(f"'{nombre}' es privado: solo admite las acciones X, K o Z")
+        if (dias and accion in ("X", "Z", "D") and vr_de(tag) in ("DA", "DT")
+                and tag >> 16 != 0x0010):
+            accion = "S"
+        tabla[tag] = accion
+    siempre = []
+    for nombre in anonimizacion["siempre"]:
+        tag = etiqueta_regla(nombre)
+        if tabla.get(tag, "X") in ("X", "K") or vr_de(tag) is None:
+            raise ValueError(f"'{nombre}' no se puede crear: necesita una regla que le dé "
+                             "valor y ser un atributo estándar")
+        siempre.append((tag, vr_de(tag), tabla[tag]))
+    nombres_siempre = {tag for tag, _, _ in siempre}
+    return {"tabla": {t: a for t, a in tabla.items() if t >> 16 != 0x0002},
+            "meta": {t: a for t, a in tabla.items() if t >> 16 == 0x0002},
+            "siempre": siempre,
+            "eliminar_privados": anonimizacion["eliminar_privados"],
+            "recorrer": (anonimizacion["eliminar_privados"]
+                         or any(t not in nombres_siempre for t in tabla)),
+            # tras los píxeles solo pueden quedar privados (7FE1...) o relleno
+            "cola": anonimizacion["eliminar_privados"] or any(t > 0x7FE00010 for t in tabla),
+            "sal": bytes.fromhex(anonimizacion.get("sal") or ""),
+            "dias": dias}
+
+
+@lru_cache(maxsize=None)
+def vr_de(tag):
+    # VR del diccionario (None si el atributo no es estándar)
+    try:
+        return pydicom.datadict.dictionary_VR(tag)
+    except KeyError:
+        return None
+
+
+@lru_cache(maxsize=1 << 16)
+def remapear_uid(uid, sal):
+    """
+    UID nuevo para uid: 2.25.<entero de 128 bits del HMAC-SHA256 de uid con
+    sal>. Es determinista, así que todos los procesos y nodos con la misma
+    sal asignan el mismo UID sin compartir ninguna tabla; la caché evita
+    recalcular los de estudio y serie, que se repiten en cada archivo.
+    """
+    h = hmac.new(sal, uid.encode("ascii"), hashlib.sha256).digest()
+    return f"2.25.{int.from_bytes(h[:16], 'big')}"
+
+
+@lru_cache(maxsize=4096)
+def dias_paciente(tag_p, sal, rango):
+    # desplazamiento fijo por paciente en [-rango, rango] días: mantiene los intervalos
+    h = hmac.new(sal, tag_p.encode("utf-8"), hashlib.sha256).digest()
+    return int.from_bytes(h[:4], "big") % (2 * rango + 1) - rango
+
+
+def desplazar_fecha(valor, dias):
+    # DA (AAAAMMDD) o DT (AAAAMMDD + hora y zona, que se conservan); lo que no
+    # tenga una fecha completa se vacía
+    texto = str(valor)
+    try:
+        fecha = datetime.datetime.strptime(texto[:8], "%Y%m%d")
+    except ValueError:
+        return ""
+    return (fecha + datetime.timedelta(days=dias)).strftime("%Y%m%d") + texto[8:]
+
+
+def valores_texto(ds, tag):
+    # valores de un UID o una fecha, que son ASCII: se leen de los bytes del
+    # elemento sin dejar que pydicom lo convierta y valide
+    elem = ds.get_item(tag)
+    if isinstance(elem.value, bytes):
+        texto = elem.value.decode("ascii", "replace").strip("\0 ")
+        return texto.split("\\") if texto else []
+    if elem.value is None or elem.value == "":
+        return []
+    return [str(v) for v in (elem.value if elem.VM > 1 else [elem.value])]
+
+
+def aplicar_accion(ds, tag, accion, tag_p, perfil):
+    if accion == "X":
+        del ds[tag]
+        return
+    if accion == "K":
+        return
+    # el elemento se sustituye sin convertir el original (ver valores_texto),
+    # salvo un privado en Implicit VR: su VR sale del diccionario privado o es UN
+    vr = ds.get_item(tag).VR or vr_de(tag) or ds[tag].VR
+    if accion in ("U", "S"):
+        if accion == "U":
+            nuevos = [remapear_uid(v, perfil["sal"]) for v in valores_texto(ds, tag)]
+        else:
+            dias = dias_paciente(tag_p, perfil["sal"], perfil["dias"])
+            nuevos = [desplazar_fecha(v, dias) for v in valores_texto(ds, tag)]
+        valor = nuevos[0] if len(nuevos) == 1 else nuevos
+    elif accion == "Z":
+        valor = [] if vr == "SQ" else None
+    elif accion == "P":
+        valor = tag_p
+    elif accion == "D":
+        valor = VALORES_FICTICIOS.get(vr)
+    else:
+        valor = accion[1:]
+    ds[tag] = pydicom.DataElement(tag, vr, valor)
+
+
+def aplicar_reglas(ds, tag_p, perfil):
+    """
+    Una pasada por los elementos de ds: cada etiqueta se busca en la tabla
+    compilada (sin convertir los elementos que no tienen regla); los
+    privados sin regla se eliminan si así lo dice el perfil y en las
+    secuencias sin regla se entra en cada item.
+    """
+    tabla = perfil["tabla"]
+    for tag in list(ds.keys()):
+        accion = tabla.get(tag)
+        if accion is not None:
+            aplicar_accion(ds, tag, accion, tag_p, perfil)
+        elif tag >> 16 & 1:
+            if perfil["eliminar_privados"]:
+                del ds[tag]
+        elif vr_de(tag) == "SQ":
+            for item in ds[tag].value:
+                aplicar_reglas(item, tag_p, perfil)
+
+
+def anonimizar(ds, tag_p, perfil):
+    """Aplica a ds el perfil compilado (ver compilar_anonimizacion) para el paciente tag_p."""
+    if perfil["recorrer"]:
+        aplicar_reglas(ds, tag_p, perfil)
+    for tag, vr, accion in perfil["siempre"]:
+        if tag not in ds:
+            ds.add_new(tag, vr, None)
+        elif perfil["recorrer"]:
+            continue  # ya aplicada en la pasada
+        aplicar_accion(ds, tag, accion, tag_p, perfil)
+    meta = getattr(ds, "file_meta", None)
+    if meta is not None:
+        for tag, accion in perfil["meta"].items():
+            if tag in meta:
+                aplicar_accion(meta, tag, accion, tag_p, perfil)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cola_trabajo.py
+
+Cola de unidades de trabajo del modo distribuido del anonimizador
+(Sytem-without-gui-remastered.py: --coordinar, --trabajar y --progreso).
+"""
+
+import json
+import pathlib
+import sqlite3
+import time
+
+
+class ColaSQLite:
+    """
+    Cola de unidades de trabajo para el modo distribuido, en un archivo
+    SQLite compartido por el coordinador y los nodos. Cada unidad pasa por
+    pendiente → en_curso → hecha, o vuelve a pendiente si falla, hasta
+    max_intentos intentos (entonces queda fallida). Una unidad en_curso
+    cuyo nodo no responde en caducidad segundos se puede volver a reclamar.
+
+    Otra cola (p. ej. sobre un servicio de mensajes) solo tiene que ofrecer
+    publicar, reclamar, completar, fallar, opciones y progreso; abrir_cola
+    elige la implementación. Cada unidad se identifica por su salida y los
+    Paciente_XXXX que contiene, de modo que volver a publicar las mismas
+    unidades (otro --coordinar sobre la misma cola) no las duplica. Sin
+    crear, la cola tiene que existir: un nodo con una ruta mal escrita
+    falla en lugar de encontrar una cola nueva y vacía.
+    """
+
+    def __init__(self, ruta, crear=True):
+        # isolation_level=None: las transacciones se abren a mano (BEGIN IMMEDIATE)
+        if not crear:
+            self.con = sqlite3.connect(pathlib.Path(ruta).absolute().as_uri() + "?mode=rw",
+                                       uri=True, timeout=60, isolation_level=None)
+            if self.con.execute("SELECT 1 FROM sqlite_master "
+                                "WHERE name = 'unidades'").fetchone() is None:
+                self.con.close()
+                raise ValueError(f"{ruta} no es una cola de trabajo")
+            return
+        self.con = sqlite3.connect(ruta, timeout=60, isolation_level=None)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS unidades (
+                id       INTEGER PRIMARY KEY,
+                clave    TEXT UNIQUE,
+                datos    TEXT,
+                total    INTEGER,
+                estado   TEXT DEFAULT 'pendiente',
+                intentos INTEGER DEFAULT 0,
+                nodo     TEXT,
+                inicio   REAL,
+                fin      REAL,
+                archivos INTEGER DEFAULT 0,
+                errores  INTEGER DEFAULT 0,
+                bytes    INTEGER DEFAULT 0,
+                error    TEXT
+            )""")
+        self.con.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)")
+
+    def publicar(self, unidades, opciones, max_intentos=3, caducidad=3600):
+        """
+        Publica las unidades que aún no están en la cola; devuelve cuántas
+        eran nuevas. Las opciones de la primera publicación no se cambian
+        (con ellas se procesaron las unidades ya hechas): ValueError si
+        difieren de las de antes. max_intentos y caducidad sí se actualizan.
+        """
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            previas = self._meta("opciones", None)
+            if previas is not None and previas != json.loads(json.dumps(opciones)):
+                raise ValueError("la cola ya tiene unidades publicadas con otras opciones")
+            self.con.execute("INSERT OR IGNORE INTO meta VALUES ('opciones', ?)",
+                             (json.dumps(opciones),))
+            self.con.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                ("max_intentos", str(max_intentos)), ("caducidad", str(caducidad))])
+            antes = self.con.total_changes
+            self.con.executemany(
+                "INSERT OR IGNORE INTO unidades (clave, datos, total) VALUES (?, ?, ?)",
+                [(json.dumps([u["salida"], [p["tag"] for p in u["pacientes"]]]), json.dumps(u),
+                  u["total"]) for u in unidades])
+            nuevas = self.con.total_changes - antes
+            self.con.execute("COMMIT")
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+        return nuevas
+
+    def _meta(self, clave, defecto):
+        fila = self.con.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+        return json.loads(fila[0]) if fila else defecto
+
+    def opciones(self):
+        return self._meta("opciones", {})
+
+    def reclamar(self, nodo):
+        """La siguiente unidad disponible, como (id, datos), o None si no queda ninguna."""
+        max_intentos = self._meta("max_intentos", 3)
+        caducidad = self._meta("caducidad", 3600)
+        ahora = time.time()
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            # las caducadas sin intentos restantes ya no se reclaman
+            self.con.execute("UPDATE unidades SET estado = 'fallida', error = 'caducada' "
+                             "WHERE estado = 'en_curso' AND inicio < ? AND intentos >= ?",
+                             (ahora - caducidad, max_intentos))
+            fila = self.con.execute(
+                "SELECT id, datos FROM unidades WHERE estado = 'pendiente' "
+                "OR (estado = 'en_curso' AND inicio < ?) ORDER BY id LIMIT 1",
+                (ahora - caducidad,)).fetchone()
+            if fila is not None:
+                self.con.execute("UPDATE unidades SET estado = 'en_curso', nodo = ?, inicio = ?, "
+                                 "intentos = intentos + 1 WHERE id = ?", (nodo, ahora, fila[0]))
+            self.con.execute("COMMIT")
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+        return None if fila is None else (fila[0], json.loads(fila[1]))
+
+    def completar(self, id_unidad, resultado):
+        self.con.execute("UPDATE unidades SET estado = 'hecha', fin = ?, archivos = ?, "
+                         "errores = ?, bytes = ?, error = NULL WHERE id = ?",
+                         (time.time(), resultado["archivos"], resultado["errores"],
+                          resultado["bytes"], id_unidad))
+
+    def fallar(self, id_unidad, error):
+        self.con.execute("UPDATE unidades SET estado = CASE WHEN intentos >= ? THEN 'fallida' "
+                         "ELSE 'pendiente' END, fin = ?, error = ? WHERE id = ?",
+                         (self._meta("max_intentos", 3), time.time(), error, id_unidad))
+
+    def progreso(self):
+        """Unidades por estado, archivos, bytes, avance por nodo y unidades fallidas."""
+        estados = dict(self.con.execute("SELECT estado, COUNT(*) FROM unidades GROUP BY estado"))
+        total, archivos, errores, nbytes, t0, t1 = self.con.execute(
+            "SELECT COALESCE(SUM(total), 0), COALESCE(SUM(archivos), 0), "
+            "COALESCE(SUM(errores), 0), COALESCE(SUM(bytes), 0), MIN(inicio), MAX(fin) "
+            "FROM unidades").fetchone()
+        nodos = {nodo: {"unidades": n, "archivos": a, "bytes": b}
+                 for nodo, n, a, b in self.con.execute(
+                     "SELECT nodo, COUNT(*), SUM(archivos), SUM(bytes) FROM unidades "
+                     "WHERE estado = 'hecha' GROUP BY nodo")}
+        fallidas = self.con.execute("SELECT id, nodo, intentos, error FROM unidades "
+                                    "WHERE estado = 'fallida' ORDER BY id").fetchall()
+        return {"unidades": estados, "total": total, "archivos": archivos, "errores": errores,
+                "bytes": nbytes, "segundos": (t1 - t0) if t0 and t1 else 0.0,
+                "nodos": nodos, "fallidas": fallidas}
+
+    def cerrar(self):
+        self.con.close()
+
+
+def abrir_cola(ruta, crear=True):
+    # de momento, la única implementación es SQLite
+    return ColaSQLite(ruta, crear)
@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+comun_dicom.py
+
+Piezas comunes del anonimizador por línea de comandos
+(Sytem-without-gui-remastered.py) y de la interfaz gráfica (Final-GUI.py):
+clasificación por plano, máscara facial, acceso a los píxeles nativos,
+índice de la entrada y manifiesto de archivos procesados. Ambos las importan
+de aquí para que no haya dos implementaciones que mantener a la par.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+from functools import lru_cache
+
+import numpy as np
+import pydicom
+from pydicom.pixels import get_encoder, pack_bits
+from pydicom.pixels.utils import get_expected_length
+from pydicom.uid import (DeflatedExplicitVRLittleEndian, ExplicitVRBigEndian,
+                         ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEG2000Lossless,
+                         JPEGLSLossless, RLELossless)
+
+TAMANO_BLOQUE = 1 << 20  # bytes por bloque al copiar o calcular hashes
+MANIFIESTO    = "manifiesto.sqlite"  # dentro de la carpeta de salida
+
+# sintaxis comprimidas que se vuelven a codificar tras el recorte (sin pérdida)
+SINTAXIS_SIN_PERDIDA = {RLELossless, JPEGLSLossless, JPEG2000Lossless}
+
+# Plantillas de la máscara facial, en mm medidos desde el punto más craneal y
+# el más anterior del corte: se anula lo que queda a más de inferior_mm por
+# debajo y a menos de pendiente * (mm por debajo) + margen_mm por detrás del
+# borde anterior. "clasica" es el recorte original en cortes de 1 mm/píxel.
+PLANTILLAS_MASCARA = {
+    "clasica":      {"inferior_mm": 150, "pendiente": 0.5, "margen_mm": 0},
+    "conservadora": {"inferior_mm": 170, "pendiente": 0.4, "margen_mm": 0},
+    "amplia":       {"inferior_mm": 130, "pendiente": 0.6, "margen_mm": 10},
+}
+# orientación supuesta si el DICOM no la trae: filas hacia atrás, columnas hacia abajo
+SAGITAL_ESTANDAR = (0.0, 1.0, 0.0, 0.0, 0.0, -1.0)
+
+PLANOS = np.array(["sagital", "coronal", "axial", "oblicuo", "desconocido"])
+
+
+def aplicar_mascara(imagen, mascara):
+    # pone a cero, sobre la propia imagen, los píxeles fuera de la máscara
+    # (también sobre pilas (N, filas, cols): la máscara se aplica a cada corte)
+    imagen[..., ~mascara] = 0
+    return imagen
+
+
+def orientaciones(ds):
+    """
+    ImageOrientationPatient como array (frames, 6), o (1, 6) si es común a
+    todos los frames. En los objetos enhanced se toma de los grupos
+    funcionales por frame y, si faltan, de los compartidos. None si no hay.
+    """
+    iop = ds.get("ImageOrientationPatient")
+    if iop is not None:
+        return np.array(iop, float).reshape(1, 6)
+
+    comun = None
+    compartidos = ds.get("SharedFunctionalGroupsSequence")
+    if compartidos and "PlaneOrientationSequence" in compartidos[0]:
+        comun = compartidos[0].PlaneOrientationSequence[0].get("ImageOrientationPatient")
+
+    por_frame = ds.get("PerFrameFunctionalGroupsSequence")
+    if por_frame and any("PlaneOrientationSequence" in g for g in por_frame):
+        filas = []
+        for g in por_frame:
+            po = g.get("PlaneOrientationSequence")
+            v = po[0].get("ImageOrientationPatient") if po else comun
+            filas.append(v if v is not None else [0] * 6)
+        return np.array(filas, float)
+    if comun is not None:
+        return np.array(comun, float).reshape(1, 6)
+    return None
+
+
+def clasificar_orientaciones(iop, umbral=0.8):
+    """Plano de cada fila de un array (N, 6) de orientaciones, de una sola vez."""
+    normal = np.cross(iop[:, :3], iop[:, 3:])
+    norm = np.linalg.norm(normal, axis=1)
+    a = np.abs(normal) / np.where(norm == 0, 1, norm)[:, None]
+    maximo = a.max(axis=1)
+    unico = (a == maximo[:, None]).sum(axis=1) == 1
+    idx = np.where((maximo > umbral) & unico, a.argmax(axis=1), 3)
+    idx[norm == 0] = 4
+    return PLANOS[idx]
+
+
+def clasificar_plano(ds, umbral=0.8):
+    """
+    Plano del DICOM según su orientación. Si los frames de un multi-frame
+    no coinciden, devuelve "mixto" (ver recortar_frames).
+    """
+    iop = orientaciones(ds)
+    if iop is None:
+        return "desconocido"
+    planos = np.unique(clasificar_orientaciones(iop, umbral))
+    return str(planos[0]) if len(planos) == 1 else "mixto"
+
+
+def geometria(ds):
+    """
+    Clave de geometría del corte para la máscara: (espaciado entre filas,
+    espaciado entre columnas) en mm más la orientación de filas y columnas,
+    redondeada. Sin PixelSpacing se suponen 1 mm; sin orientación,
+    SAGITAL_ESTANDAR. En un "mixto" vale la de su primer frame sagital.
+    """
+    espaciado = ds.get("PixelSpacing")
+    if espaciado is None:
+        compartidos = ds.get("SharedFunctionalGroupsSequence")
+        if compartidos and "PixelMeasuresSequence" in compartidos[0]:
+            espaciado = compartidos[0].PixelMeasuresSequence[0].get("PixelSpacing")
+    espaciado = (float(espaciado[0]), float(espaciado[1])) if espaciado else (1.0, 1.0)
+
+    iop = orientaciones(ds)
+    if iop is None:
+        return espaciado + SAGITAL_ESTANDAR
+    sagitales = clasificar_orientaciones(iop) == "sagital"
+    fila = iop[sagitales.argmax()] if sagitales.any() else iop[0]
+    return espaciado + tuple(round(float(v), 3) for v in fila)
+
+
+@lru_cache(maxsize=32)
+def generar_mascara(filas, cols, geometria, plantilla):
+    """
+    Máscara facial (True = se conserva) para un corte de filas x cols con la
+    geometría dada (ver geometria) y plantilla = (inferior_mm, pendiente,
+    margen_mm). Se cachea por geometría: una serie la calcula una sola vez.
+    """
+    dr, dc = geometria[:2]
+    dir_fila = np.array(geometria[2:5])     # avance de una columna a la siguiente
+    dir_col = np.array(geometria[5:8])      # avance de una fila a la siguiente
+    r = np.arange(filas)[:, None] * dr
+    c = np.arange(cols)[None, :] * dc
+    # coordenadas LPS de cada píxel respecto al primero: +y posterior, +z craneal
+    y = c * dir_fila[1] + r * dir_col[1]
+    z = c * dir_fila[2] + r * dir_col[2]
+    inferior = z.max() - z
+    # se anula un píxel solo si queda entero por delante de la línea de corte
+    anterior = y - y.min() + (abs(dir_fila[1]) * dc + abs(dir_col[1]) * dr) / 2
+    inferior_mm, pendiente, margen_mm = plantilla
+    m = ~((inferior > inferior_mm) & (anterior < pendiente * inferior + margen_mm))
+    m.flags.writeable = False  # compartida entre llamadas
+    return m
+
+
+def mascara_para(ds, filas, cols, plantilla):
+    """Máscara de plantilla (un valor de PLANTILLAS_MASCARA) para la geometría de ds."""
+    clave = (plantilla["inferior_mm"], plantilla["pendiente"], plantilla["margen_mm"])
+    return generar_mascara(filas, cols, geometria(ds), clave)
+
+
+def ejes_imagen(ds, img):
+    """
+    Vista de img (sin copiar) con filas y columnas como dos últimos ejes. Los
+    píxeles de color decodificados llevan las muestras al final ([frames,]
+    filas, cols, muestras) y se ven como ([frames,] muestras, filas, cols),
+    igual que la vista de vista_pixeles con PlanarConfiguration 1.
+    """
+    muestras = ds.get("SamplesPerPixel", 1)
+    if muestras > 1 and img.shape[-1] == muestras and img.shape[-3:-1] == (ds.Rows, ds.Columns):
+        return np.moveaxis(img, -1, -3)
+    return img
+
+
+def recortar_frames(ds, img, plano, plantilla):
+    """
+    Aplica la máscara de plantilla a img (un corte o frames, filas, cols,
+    también de color, ver ejes_imagen) en una sola operación; en un objeto
+    "mixto" solo a los frames sagitales.
+    """
+    vista = ejes_imagen(ds, img)
+    m = mascara_para(ds, *vista.shape[-2:], plantilla)
+    if plano == "mixto":
+        sagitales = clasificar_orientaciones(orientaciones(ds)) == "sagital"
+        m = ~(sagitales[:, None, None] & ~m)
+        if vista.ndim == 4:  # (frames, muestras, filas, cols)
+            m = np.broadcast_to(m[:, None], vista.shape)
+    aplicar_mascara(vista, m)
+    return img
+
+
+# sintaxis sin comprimir según original_encoding (VR implícita, little endian)
+SINTAXIS_POR_CODIFICACION = {(True, True): ImplicitVRLittleEndian,
+                             (False, True): ExplicitVRLittleEndian,
+                             (False, False): ExplicitVRBigEndian}
+
+
+def sintaxis(ds):
+    """
+    Sintaxis de transferencia de ds. Si la cabecera de archivo no la trae
+    (DICOM sin grupo 0002), la de la codificación con que se ha leído.
+    """
+    ts = getattr(ds.get("file_meta"), "TransferSyntaxUID", None)
+    if ts is None:
+        ts = SINTAXIS_POR_CODIFICACION.get(getattr(ds, "original_encoding", None))
+    return ts
+
+
+def vista_pixeles(ds, ts=None):
+    """
+    Vista escribible (frames, filas, cols) sobre el PixelData nativo de ds,
+    sin decodificar: PixelData se copia una vez a un bytearray (que ds guarda
+    como memoryview) y el array se crea con np.frombuffer con el dtype y el
+    orden de bytes almacenados, de modo que lo que se escribe en el array
+    queda ya en ds. ts es la sintaxis de ds, si ya se conoce. None si el
+    formato no lo permite (comprimido, 1 bit, YBR_FULL_422, color
+    entrelazado...).
+    """
+    ts = ts or sintaxis(ds)
+    if ts is None or ts.is_compressed or "PixelData" not in ds:
+        return None
+    bits = ds.get("BitsAllocated")
+    muestras = ds.get("SamplesPerPixel", 1)
+    if (bits not in (8, 16, 32) or ds.get("PhotometricInterpretation") == "YBR_FULL_422"
+            or (muestras > 1 and ds.get("PlanarConfiguration", 0) != 1)):
+        return None
+
+    forma = (muestras, ds.Rows, ds.Columns) if muestras > 1 else (ds.Rows, ds.Columns)
+    frames = int(ds.get("NumberOfFrames") or 1)
+    if frames > 1:
+        forma = (frames,) + forma
+    dtype = np.dtype(f"{'i' if ds.get('PixelRepresentation', 0) else 'u'}{bits // 8}")
+    dtype = dtype.newbyteorder("<" if ts.is_little_endian else ">")
+    if len(ds.PixelData) < dtype.itemsize * int(np.prod(forma)):
+        return None
+
+    buf = bytearray(ds.PixelData)
+    # un bytearray se tomaría como lista de valores; pydicom escribe el memoryview tal cual
+    ds["PixelData"] = pydicom.DataElement(0x7FE00010, ds["PixelData"].VR, memoryview(buf),
+                                          validation_mode=pydicom.config.IGNORE)
+    return np.frombuffer(buf, dtype, count=int(np.prod(forma))).reshape(forma)
+
+
+def bytes_nativos(ds, img, ts):
+    """
+    PixelData sin comprimir para img, decodificado con pixel_array, en la
+    disposición que declara la cabecera de ds: bits empaquetados si
+    BitsAllocated es 1, el orden de bytes de ts y, en color, muestras
+    entrelazadas (PlanarConfiguration 0) en RGB, porque pydicom entrega así
+    los datos YBR; la cabecera se actualiza si cambia. ValueError si img no
+    se puede guardar con BitsAllocated.
+    """
+    bits = ds.BitsAllocated
+    if bits == 1:
+        return pack_bits(img)
+    if img.dtype.kind not in "ui" or img.dtype.itemsize * 8 != bits:
+        raise ValueError(f"no se pueden guardar píxeles {img.dtype} con BitsAllocated {bits}")
+    if ds.get("SamplesPerPixel", 1) > 1:
+        if ds.PhotometricInterpretation.startswith("YBR"):
+            ds.PhotometricInterpretation = "RGB"
+        ds.PlanarConfiguration = 0
+    orden = "<" if ts.is_little_endian else ">"
+    return img.astype(img.dtype.newbyteorder(orden), copy=False).tobytes()
+
+
+def escribir_pixeles(ds, img, salida="original"):
+    """
+    Sustituye los píxeles de ds por img. En sintaxis sin comprimir no hay
+    nada que hacer si img es la vista de vista_pixeles y, si no, se guardan
+    sus bytes en la disposición de la cabecera (ver bytes_nativos); en las
+    comprimidas se vuelve a codificar en la sintaxis original si es sin
+    pérdida y hay codificador (RLE siempre lo tiene) y, si no, o con
+    salida == "explicita", se pasa a Explicit VR Little Endian actualizando
+    la cabecera (fotometría, frames, bits).
+    """
+    ts = sintaxis(ds)
+    if ts is None:
+        raise ValueError("sintaxis de transferencia desconocida: no se pueden guardar los píxeles")
+    if not ts.is_compressed:
+        buf = ds.PixelData
+        if not (isinstance(buf, memoryview)
+                and np.may_share_memory(img, np.frombuffer(buf, np.uint8))):
+            ds.PixelData = bytes_nativos(ds, img, ts)
+        return
+
+    # pydicom entrega en RGB los datos YBR al decodificar
+    fotometrica = ds.PhotometricInterpretation
+    if fotometrica.startswith("YBR"):
+        fotometrica = "RGB"
+    if salida == "original" and ts in SINTAXIS_SIN_PERDIDA and get_encoder(ts).is_available:
+        ds.PhotometricInterpretation = fotometrica
+        ds.compress(ts, img, generate_instance_uid=False)
+    else:
+        ds.set_pixel_data(img, fotometrica, ds.BitsStored, generate_instance_uid=False)
+
+
+def leer_cabecera_pixeles(fp, ds):
+    """
+    (bytes, longitud) de la cabecera del elemento de píxeles que empieza en
+    la posición actual de fp, que queda tras ella; longitud 0xFFFFFFFF si
+    está encapsulado. None si la codificación de ds es desconocida.
+    struct.error si el archivo se acaba antes.
+    """
+    implicito, little = ds.original_encoding
+    if implicito is None:
+        return None
+    orden = "<" if little else ">"
+    cabecera = fp.read(8)
+    if implicito:
+        return cabecera, struct.unpack(orden + "I", cabecera[4:8])[0]
+    if cabecera[4:6] in (b"OB", b"OW", b"OD", b"OF", b"OL", b"OV", b"UN"):
+        extra = fp.read(4)
+        return cabecera + extra, struct.unpack(orden + "I", extra)[0]
+    return cabecera, struct.unpack(orden + "H", cabecera[6:8])[0]
+
+
+def pixeles_incompletos(fp, ds, tamano):
+    """
+    Por qué el elemento de píxeles que empieza en la posición actual de fp
+    (de tamano bytes) está incompleto: el archivo se acaba antes de la
+    longitud declarada o de sus fragmentos, o PixelData declara menos bytes
+    de los que indica la cabecera (Rows × Columns × frames × muestras ×
+    bits). None si está entero o no se puede saber; fp vuelve a su posición.
+    """
+    inicio = fp.tell()
+    try:
+        leida = leer_cabecera_pixeles(fp, ds)
+        if leida is None:
+            return None
+        cabecera, longitud = leida
+        if longitud == 0xFFFFFFFF:
+            # encapsulado: cada fragmento tiene que caber en el archivo
+            while True:
+                item = fp.read(8)
+                if len(item) < 8:
+                    return "el archivo se acaba antes del final de los fragmentos"
+                grupo, elemento, n = struct.unpack("<HHI", item)
+                if (grupo, elemento) == (0xFFFE, 0xE0DD):
+                    return None
+                if fp.tell() + n > tamano:
+                    return "el archivo se acaba dentro de un fragmento"
+                fp.seek(n, 1)
+        if fp.tell() + longitud > tamano:
+            return (f"el elemento de píxeles declara {longitud} bytes y el archivo "
+                    f"solo tiene {tamano - fp.tell()}")
+        orden = "<" if ds.original_encoding[1] else ">"
+        if struct.unpack(orden + "HH", cabecera[:4]) != (0x7FE0, 0x0010):
+            return None
+        try:
+            n = (int(ds.Rows) * int(ds.Columns) * int(ds.get("SamplesPerPixel") or 1)
+                 * int(ds.get("NumberOfFrames") or 1))
+            esperados = (n * int(ds.BitsAllocated) + 7) // 8
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if ds.get("PhotometricInterpretation") == "YBR_FULL_422":
+            esperados = esperados // 3 * 2  # crominancia a media resolución horizontal
+        if longitud < esperados:
+            return f"PixelData tiene {longitud} bytes y la cabecera indica {esperados}"
+        return None
+    except struct.error:
+        return "el archivo se acaba en la cabecera del elemento de píxeles"
+    finally:
+        fp.seek(inicio)
+
+
+def tiene_pixeles(ds, ts=None):
+    """
+    Si ds, ya leído entero, trae una imagen, sin decodificarla: False si no
+    tiene elemento de píxeles o le faltan los elementos de imagen de la
+    cabecera (los casos en que pixel_array da AttributeError). En sintaxis
+    nativas, ValueError si PixelData tiene menos bytes de los que indica la
+    cabecera, igual que al decodificarlo. ts es la sintaxis de ds, si ya se
+    conoce.
+    """
+    if not any(k in ds for k in ("PixelData", "FloatPixelData", "DoubleFloatPixelData")):
+        return False
+    try:
+        esperado = get_expected_length(ds)
+    except AttributeError:
+        return False
+    ts = ts or sintaxis(ds)
+    if ("PixelData" in ds and ts is not None and not ts.is_compressed
+            and len(ds.PixelData) < esperado):
+        raise ValueError(f"PixelData tiene {len(ds.PixelData)} bytes y la cabecera "
+                         f"indica {esperado}")
+    return True
+
+
+def leer_cabecera(fp, tamano):
+    """
+    Lee de fp (de tamano bytes) la cabecera DICOM, sin los píxeles, para
+    decidir el plano sin decodificar. Devuelve (ds, con_pixeles), con fp al
+    inicio del elemento de píxeles si lo hay; con_pixeles es None si no se
+    puede saber así (en Deflate las posiciones de fp no corresponden al
+    dataset) y hay que leer el archivo entero. ValueError si los píxeles
+    están incompletos (ver pixeles_incompletos).
+    """
+    ds = pydicom.dcmread(fp, force=True, stop_before_pixels=True)
+    if getattr(ds.get("file_meta"), "TransferSyntaxUID", None) == DeflatedExplicitVRLittleEndian:
+        return ds, None
+    con_pixeles = fp.tell() < tamano
+    incompleto = con_pixeles and pixeles_incompletos(fp, ds, tamano)
+    if incompleto:
+        raise ValueError(f"píxeles incompletos: {incompleto}")
+    return ds, con_pixeles
+
+
+def _indexar_carpeta(raiz, rel, series, carpetas):
+    # recorrido en el mismo orden que os.walk (descendente, sin seguir enlaces)
+    archivos, subcarpetas = [], []
+    carpetas[rel] = os.stat(os.path.join(raiz, rel)).st_mtime
+    with os.scandir(os.path.join(raiz, rel)) as it:
+        for e in it:
+            if e.is_dir():
+                if not e.is_symlink():
+                    subcarpetas.append(e.name)
+            elif not e.name.startswith('.'):
+                st = e.stat()
+                archivos.append([e.name, st.st_size, st.st_mtime])
+    if archivos:
+        series.append({"ruta": rel, "archivos": archivos})
+    for d in subcarpetas:
+        _indexar_carpeta(raiz, os.path.join(rel, d), series, carpetas)
+
+
+def indexar_entrada(input_folder):
+    """
+    Recorre input_folder una sola vez (os.scandir) y devuelve el índice de
+    trabajo: pacientes en el orden de os.listdir y, por paciente, sus
+    carpetas de serie con [nombre, tamaño, mtime] de cada archivo. Las rutas
+    son relativas a input_folder para poder reutilizar el índice guardado;
+    "carpetas" guarda el mtime de cada carpeta recorrida para saber si el
+    índice sigue vigente.
+    """
+    pacientes = [d for d in os.listdir(input_folder)
+                 if os.path.isdir(os.path.join(input_folder, d))]
+    if not pacientes:
+        pacientes = [""]  # usar la raíz como un único paciente
+
+    carpetas = {"": os.stat(input_folder).st_mtime}
+    indice = {"raiz": os.path.abspath(input_folder), "pacientes": [], "carpetas": carpetas}
+    for pac in pacientes:
+        series = []
+        _indexar_carpeta(input_folder, pac, series, carpetas)
+        indice["pacientes"].append({"carpeta": pac, "series": series})
+    return indice
+
+
+def motivo_reindexar(indice, input_folder):
+    """
+    Por qué un índice guardado no sirve para input_folder: es de otra
+    entrada o alguna de sus carpetas ha cambiado (se han añadido, quitado o
+    renombrado archivos o carpetas). None si sigue vigente. Los archivos
+    modificados sin cambiar de nombre no cambian la carpeta y no se detectan.
+    """
+    if indice.get("raiz") != os.path.abspath(input_folder):
+        return f"es de otra entrada ({indice.get('raiz')})"
+    if "carpetas" not in indice:
+        return "no guarda las fechas de sus carpetas"
+    for rel, mtime in indice["carpetas"].items():
+        try:
+            actual = os.stat(os.path.join(input_folder, rel)).st_mtime
+        except OSError:
+            return f"incluye la carpeta '{rel}', que ya no existe"
+        if actual != mtime:
+            return f"es anterior a cambios en la carpeta '{rel or '.'}'"
+    return None
+
+
+def cargar_o_indexar(input_folder, ruta_indice=None):
+    # con ruta_indice se reutiliza la instantánea guardada si sigue vigente, o se crea
+    if ruta_indice and os.path.exists(ruta_indice):
+        with open(ruta_indice, encoding="utf-8") as fi:
+            indice = json.load(fi)
+        motivo = motivo_reindexar(indice, input_folder)
+        if motivo is None:
+            return indice
+        print(f"AVISO: el índice {ruta_indice} {motivo}; se vuelve a recorrer la entrada.")
+    indice = indexar_entrada(input_folder)
+    if ruta_indice:
+        with open(ruta_indice, "w", encoding="utf-8") as fi:
+            json.dump(indice, fi)
+    return indice
+
+
+def totales_indice(indice):
+    n, nbytes = 0, 0
+    for paciente in indice["pacientes"]:
+        for serie in paciente["series"]:
+            n += len(serie["archivos"])
+            nbytes += sum(a[1] for a in serie["archivos"])
+    return n, nbytes
+
+
+def hash_archivo(ruta):
+    h = hashlib.blake2b(digest_size=16)
+    with open(ruta, "rb") as fp:
+        for bloque in iter(lambda: fp.read(TAMANO_BLOQUE), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+class Manifiesto:
+    """
+    Registro persistente (SQLite en la carpeta de salida) de cada archivo de
+    entrada procesado: tamaño, mtime, hash de contenido, destino, plano y
+    estado. Permite reanudar una ejecución interrumpida y, en ejecuciones
+    incrementales, procesar solo los archivos nuevos o modificados. Guarda
+    también el Paciente_XXXX de cada carpeta de paciente, para que una
+    carpeta nueva no desplace la numeración de las ya procesadas.
+
+    Lo escribe un solo hilo a la vez (el proceso principal del anonimizador
+    o el hilo de trabajo de la interfaz); los workers devuelven sus
+    registros como parte de su resultado.
+    """
+
+    def __init__(self, output_folder):
+        self.con = sqlite3.connect(os.path.join(output_folder, MANIFIESTO),
+                                   check_same_thread=False)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS archivos (
+                ruta    TEXT PRIMARY KEY,
+                tamano  INTEGER,
+                mtime   REAL,
+                hash    TEXT,
+                destino TEXT,
+                plano   TEXT,
+                estado  TEXT
+            )""")
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS pacientes (
+                carpeta TEXT PRIMARY KEY,
+                tag     TEXT UNIQUE
+            )""")
+        self.tags = dict(self.con.execute("SELECT carpeta, tag FROM pacientes"))
+        self.hechos = {
+            ruta: (tamano, mtime, h, destino)
+            for ruta, tamano, mtime, h, destino in self.con.execute(
+                "SELECT ruta, tamano, mtime, hash, destino FROM archivos "
+                "WHERE estado = 'ok'")
+        }
+
+    def pendientes(self, root, archivos):
+        """
+        Devuelve los nombres de los archivos de root ([nombre, tamaño, mtime]
+        del índice) que no constan como ya procesados sin cambios. El tamaño
+        y el mtime se toman del disco, no del índice: modificar un archivo
+        no cambia el mtime de su carpeta y un índice guardado no lo vería.
+        """
+        quedan = []
+        for f, _, _ in archivos:
+            ruta = os.path.abspath(os.path.join(root, f))
+            previo = self.hechos.get(ruta)
+            if previo is not None and os.path.exists(previo[3]):
+                try:
+                    st = os.stat(ruta)
+                except OSError:
+                    quedan.append(f)  # ya no está: su error se informa al procesarlo
+                    continue
+                tamano, mtime = st.st_size, st.st_mtime
+                if (tamano, mtime) == previo[:2]:
+                    continue
+                # mtime distinto (p. ej. tras una copia): decide el contenido
+                if tamano == previo[0] and hash_archivo(ruta) == previo[2]:
+                    self.con.execute("UPDATE archivos SET mtime = ? WHERE ruta = ?",
+                                     (mtime, ruta))
+                    continue
+            quedan.append(f)
+        return quedan
+
+    def etiqueta(self, carpeta, propuesta):
+        """
+        Paciente_XXXX de la carpeta de paciente: el de la ejecución anterior
+        o, si es nueva, propuesta, salvo que ya lo tenga otra carpeta (una
+        carpeta nueva ha cambiado el orden); entonces el siguiente número libre.
+        Solo para los identificadores por posición: los seudónimos con clave
+        ya son estables y dos carpetas del mismo PatientID deben compartirlo.
+        """
+        carpeta = os.path.abspath(carpeta)
+        tag = self.tags.get(carpeta)
+        if tag is None:
+            usados = set(self.tags.values())
+            tag = propuesta
+            if tag in usados:
+                # un seudónimo (12 hexadecimales) puede ser todo dígitos: no es un número
+                numeros = [int(t[9:]) for t in usados if t[9:].isdigit() and len(t[9:]) < 12]
+                tag = f"Paciente_{max(numeros, default=0) + 1:04d}"
+            self.tags[carpeta] = tag
+            self.con.execute("INSERT INTO pacientes VALUES (?, ?)", (carpeta, tag))
+            self.con.commit()
+        return tag
+
+    def registrar(self, registros):
+        self.con.executemany(
+            "INSERT OR REPLACE INTO archivos VALUES (?, ?, ?, ?, ?, ?, ?)", registros)
+        self.con.commit()
+
+    def cerrar(self):
+        self.con.commit()
+        self.con.close()
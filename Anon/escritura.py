@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+escritura.py
+
+Escritura de la salida del anonimizador (Sytem-without-gui-remastered.py):
+el Escritor, que guarda en un hilo propio los archivos ya serializados
+cuando hay pipeline, y el Empaquetador, que los escribe como miembros de
+archivos zip, tar o tar.zst en lugar de en carpetas.
+"""
+
+import io
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from comun_dicom import TAMANO_BLOQUE
+from telemetria import medir
+
+INDICE_MIEMBROS = "indice.csv"       # dentro de cada archivo comprimido de la salida
+EXTENSIONES_EMPAQUETADO = {"zip": ".zip", "tar": ".tar", "tar.zst": ".tar.zst"}
+
+
+class Escritor:
+    """
+    Etapa de escritura del pipeline: un hilo propio guarda en disco los
+    archivos ya serializados en memoria mientras el proceso lee y recorta los
+    siguientes. Como mucho hay profundidad archivos en cola; encolar otro
+    espera a que se libere un hueco (contrapresión). El proceso principal
+    agrupa las escrituras de cada archivo con marcar y recoge los archivos
+    terminados, en orden, con terminados. Con empaquetador, los archivos van
+    a sus archivos comprimidos (ver escribir_salida); la espera por un hueco
+    cuenta en telemetria como etapa "espera_escritura".
+    """
+
+    def __init__(self, profundidad, empaquetador=None, telemetria=None):
+        self.empaquetador = empaquetador
+        self.telemetria = telemetria
+        self.hilo = ThreadPoolExecutor(max_workers=1)
+        self.huecos = threading.Semaphore(profundidad)
+        self.actuales = []         # escrituras del archivo en curso
+        self.pendientes = deque()  # (escrituras, contexto) por archivo
+
+    def encolar(self, destino, partes):
+        with medir(self.telemetria, "espera_escritura"):
+            self.huecos.acquire()
+        futuro = self.hilo.submit(self._escribir, destino, partes)
+        futuro.add_done_callback(lambda _: self.huecos.release())
+        self.actuales.append(futuro)
+
+    def _escribir(self, destino, partes):
+        inicio = time.perf_counter()
+        n = escribir_salida(destino, partes, sum(memoryview(p).nbytes for p in partes),
+                            self.empaquetador)
+        return time.perf_counter() - inicio, n
+
+    def marcar(self, contexto):
+        self.pendientes.append((self.actuales, contexto))
+        self.actuales = []
+
+    def terminados(self, esperar=False):
+        """
+        (contexto, error, segundos, bytes) de cada archivo marcado cuyas
+        escrituras han acabado, en el orden en que se marcaron; con esperar,
+        de todos, esperando a los que falten.
+        """
+        while self.pendientes:
+            futuros, contexto = self.pendientes[0]
+            if not esperar and not all(f.done() for f in futuros):
+                return
+            self.pendientes.popleft()
+            error, segundos, n_bytes = None, 0.0, 0
+            for f in futuros:
+                try:
+                    s, n = f.result()
+                except Exception as e:
+                    error = e
+                else:
+                    segundos += s
+                    n_bytes += n
+            yield contexto, error, segundos, n_bytes
+
+    def cerrar(self):
+        self.hilo.shutdown()
+
+
+class Empaquetador:
+    """
+    Salida en archivos comprimidos en lugar de carpetas, para un paciente:
+    lo que iría a out_p/plano/serie/archivo se añade, sin archivos
+    temporales, como miembro plano/serie/archivo de out_p.zip (por
+    "paciente") o como miembro archivo de out_p/plano/serie.zip (por
+    "serie"), con extensión .tar o .tar.zst según el formato. Cada archivo
+    lleva al final un miembro INDICE_MIEMBROS con miembro, bytes, plano y
+    serie. Los miembros se escriben de uno en uno (con pipeline, desde el
+    hilo del Escritor y desde el proceso).
+    """
+
+    def __init__(self, formato="zip", por="paciente"):
+        if formato == "tar.zst":
+            import zstandard  # noqa: F401  (solo se necesita para este formato)
+        self.formato = formato
+        self.por = por
+        self.abiertos = {}     # ruta del archivo -> (objeto, filas del índice)
+        self.comprimidos = []  # compresores zstd, que se cierran tras su tar
+        self.cerrojo = threading.Lock()
+
+    def _abrir(self, ruta):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        if self.formato == "zip":
+            return zipfile.ZipFile(ruta, "w", zipfile.ZIP_DEFLATED, compresslevel=1)
+        if self.formato == "tar":
+            return tarfile.open(ruta, "w")
+        import zstandard
+        comprimido = zstandard.ZstdCompressor(level=3).stream_writer(open(ruta, "wb"))
+        self.comprimidos.append(comprimido)
+        return tarfile.open(fileobj=comprimido, mode="w|")
+
+    def escribir(self, destino, trozos, tamano):
+        serie_dir, nombre = os.path.split(destino)
+        plano_dir, serie = os.path.split(serie_dir)
+        out_p, plano = os.path.split(plano_dir)
+        ext = EXTENSIONES_EMPAQUETADO[self.formato]
+        if self.por == "paciente":
+            ruta, miembro = out_p + ext, f"{plano}/{serie}/{nombre}"
+        else:
+            ruta, miembro = serie_dir + ext, nombre
+        with self.cerrojo:
+            if ruta not in self.abiertos:
+                self.abiertos[ruta] = (self._abrir(ruta), [])
+            archivo, filas = self.abiertos[ruta]
+            if self.formato == "zip":
+                info = zipfile.ZipInfo(miembro, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = tamano
+                with archivo.open(info, "w") as out:
+                    for trozo in trozos:
+                        if hasattr(trozo, "read"):
+                            shutil.copyfileobj(trozo, out, TAMANO_BLOQUE)
+                        else:
+                            out.write(trozo)
+            else:
+                info = tarfile.TarInfo(miembro)
+                info.size = tamano
+                info.mtime = time.time()
+                # tarfile espera lecturas completas, no las parciales de un RawIOBase
+                archivo.addfile(info, io.BufferedReader(LectorTrozos(trozos), TAMANO_BLOQUE))
+            filas.append((miembro, tamano, plano, serie))
+        return tamano
+
+    def cerrar(self):
+        """Escribe el índice de cada archivo y los cierra."""
+        for archivo, filas in self.abiertos.values():
+            texto = "miembro,bytes,plano,serie\n" + "".join(
+                f"{m},{n},{p},{s}\n" for m, n, p, s in filas)
+            datos = texto.encode("utf-8")
+            if self.formato == "zip":
+                archivo.writestr(INDICE_MIEMBROS, datos)
+            else:
+                info = tarfile.TarInfo(INDICE_MIEMBROS)
+                info.size = len(datos)
+                info.mtime = time.time()
+                archivo.addfile(info, io.BytesIO(datos))
+            archivo.close()
+        for comprimido in self.comprimidos:
+            comprimido.close()  # cierra también el archivo en disco
+        self.abiertos.clear()
+        self.comprimidos.clear()
+
+
+class LectorTrozos(io.RawIOBase):
+    """Lectura secuencial de trozos (bytes o archivos abiertos) como un solo archivo."""
+
+    def __init__(self, trozos):
+        self.trozos = iter(trozos)
+        self.actual = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self.actual is None:
+                trozo = next(self.trozos, None)
+                if trozo is None:
+                    return 0
+                self.actual = trozo if hasattr(trozo, "read") else io.BytesIO(trozo)
+            n = self.actual.readinto(b)
+            if n:
+                return n
+            self.actual = None
+
+
+def escribir_salida(destino, trozos, tamano, empaquetador=None):
+    """
+    Escribe en destino los trozos (bytes, memoryview o archivos abiertos,
+    que se copian hasta el final) uno tras otro, en disco o, con
+    empaquetador, como miembro de su archivo comprimido (ver Empaquetador).
+    tamano es el total de bytes. Devuelve los bytes escritos.
+    """
+    if empaquetador is not None:
+        return empaquetador.escribir(destino, trozos, tamano)
+    with open(destino, "wb") as out:
+        for trozo in trozos:
+            if hasattr(trozo, "read"):
+                shutil.copyfileobj(trozo, out, TAMANO_BLOQUE)
+            else:
+                out.write(trozo)
+        return out.tell()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+hojas_contacto.py
+
+Genera hojas de contacto PNG para revisar la salida del anonimizador:
+
+- Por serie, una hoja con cortes repartidos a lo largo de la serie.
+- En las series sagitales (y mixtas), el corte central a mayor tamaño, antes
+  y después del recorte si se encuentran los originales.
+- Por paciente, una hoja con el corte central de cada una de sus series.
+
+Crea además un index.html con todas ellas. Es incremental: solo se vuelven a
+generar las hojas de las series que han cambiado desde la última vez.
+
+    python Anon/hojas_contacto.py SALIDA --qa QA
+    python Anon/hojas_contacto.py SALIDA --qa QA --originales ENTRADA --workers 8
+
+Los originales se emparejan por el manifiesto de la salida (ejecuciones con
+--reanudar) o, si no lo hay, por SOPInstanceUID dentro de ENTRADA (con
+--clave-seudonimo si el anonimizador remapeó los UID).
+"""
+
+import argparse
+import hashlib
+import hmac
+import html
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+
+try:
+    import pydicom
+    import numpy as np
+    from matplotlib.image import imread, imsave
+    from pydicom.pixels import pixel_array
+except ImportError:
+    print("Instala primero las dependencias con:\n    pip install pydicom numpy matplotlib")
+    sys.exit(1)
+
+
+MANIFIESTO = "manifiesto.sqlite"  # el del anonimizador, en la carpeta de salida
+ESTADO     = "estado.json"        # firmas de las series ya generadas, en la carpeta QA
+LADO       = 128  # píxeles (aprox.) de cada miniatura
+LADO_CENTRAL = 384  # píxeles del corte central antes/después
+CORTES     = 12   # cortes por hoja de serie
+COLUMNAS   = 6
+HILOS_CABECERAS = 8
+PLANOS_RECORTADOS = ("sagital", "mixto")
+
+_originales = {}  # clave o SOPInstanceUID -> ruta original; ver _iniciar
+
+
+def listar_series(salida):
+    """
+    (paciente, plano, serie, carpeta, archivos) de cada carpeta de serie de
+    la salida (Paciente/plano/serie), con archivos [(nombre, tamaño, mtime)].
+    Se omiten las de plano sin_pixel.
+    """
+    series = []
+    for paciente in sorted(os.listdir(salida)):
+        dir_p = os.path.join(salida, paciente)
+        if not os.path.isdir(dir_p):
+            continue
+        for plano in sorted(os.listdir(dir_p)):
+            dir_plano = os.path.join(dir_p, plano)
+            if plano == "sin_pixel" or not os.path.isdir(dir_plano):
+                continue
+            for serie in sorted(os.listdir(dir_plano)):
+                carpeta = os.path.join(dir_plano, serie)
+                if not os.path.isdir(carpeta):
+                    continue
+                archivos = []
+                for e in sorted(os.scandir(carpeta), key=lambda e: e.name):
+                    if e.is_file():
+                        st = e.stat()
+                        archivos.append((e.name, st.st_size, st.st_mtime_ns))
+                if archivos:
+                    series.append((paciente, plano, serie, carpeta, archivos))
+    return series
+
+
+def firma(*partes):
+    return hashlib.blake2b(json.dumps(partes).encode(), digest_size=16).hexdigest()
+
+
+def _leer_cabecera(ruta):
+    try:
+        return pydicom.dcmread(ruta, force=True, stop_before_pixels=True)
+    except Exception:
+        return None
+
+
+def originales_por_manifiesto(salida):
+    """
+    Destino → original según el manifiesto de la salida. La clave son los
+    cuatro últimos componentes del destino (Paciente/plano/serie/archivo),
+    que no dependen de la ruta con la que se indicó la salida.
+    """
+    ruta = os.path.join(salida, MANIFIESTO)
+    if not os.path.exists(ruta):
+        return {}
+    con = sqlite3.connect(ruta)
+    try:
+        filas = con.execute("SELECT ruta, destino FROM archivos "
+                            "WHERE estado = 'ok' AND destino IS NOT NULL").fetchall()
+    finally:
+        con.close()
+    return {"/".join(os.path.normpath(destino).split(os.sep)[-4:]): original
+            for original, destino in filas}
+
+
+def remapear_uid(uid, sal):
+    # el mismo remapeo que el anonimizador (perfiles con UID remapeados)
+    h = hmac.new(sal, uid.encode("ascii"), hashlib.sha256).digest()
+    return f"2.25.{int.from_bytes(h[:16], 'big')}"
+
+
+def originales_por_uid(entrada, sal_uid=None):
+    """
+    SOPInstanceUID → ruta de los DICOM con imagen bajo entrada (solo
+    cabeceras). Con sal_uid (hex) la clave es el UID tal como lo remapeó el
+    anonimizador.
+    """
+    rutas = [os.path.join(raiz, f) for raiz, _, archivos in os.walk(entrada) for f in archivos]
+    sal = bytes.fromhex(sal_uid) if sal_uid else None
+    mapa = {}
+    with ThreadPoolExecutor(max_workers=HILOS_CABECERAS) as pool:
+        for ruta, ds in zip(rutas, pool.map(_leer_cabecera, rutas)):
+            if ds is not None and "Rows" in ds and "SOPInstanceUID" in ds:
+                uid = str(ds.SOPInstanceUID)
+                mapa[remapear_uid(uid, sal) if sal else uid] = ruta
+    return mapa
+
+
+def cortes_de_serie(carpeta, archivos):
+    """
+    Cortes de la serie ordenados por InstanceNumber y nombre: (ruta, frame,
+    SOPInstanceUID), con un corte por frame en los multi-frame.
+    """
+    cortes = []
+    for nombre, _, _ in archivos:
+        ruta = os.path.join(carpeta, nombre)
+        ds = _leer_cabecera(ruta)
+        if ds is None or "Rows" not in ds:
+            continue
+        inst = ds.get("InstanceNumber")
+        n_frames = int(ds.get("NumberOfFrames") or 1)
+        uid = str(ds.get("SOPInstanceUID", ""))
+        for frame in (range(n_frames) if n_frames > 1 else [None]):
+            cortes.append(((inst is None, inst or 0, nombre, frame or 0), ruta, frame, uid))
+    cortes.sort(key=lambda c: c[0])
+    return [c[1:] for c in cortes]
+
+
+def leer_corte(ruta, frame):
+    """Píxeles de un corte; en los multi-frame solo se lee y decodifica su frame."""
+    try:
+        return pixel_array(ruta, index=frame)
+    except Exception:
+        # p. ej. sin preámbulo DICOM: se lee entero con force
+        img = pydicom.dcmread(ruta, force=True).pixel_array
+        return img if frame is None else img[frame]
+
+
+def miniatura(img, lado):
+    """Reduce img a unos lado píxeles (submuestreo) y la pasa a uint8 con ventana p1–p99.5."""
+    if img.ndim == 3:  # color: se revisa en gris
+        img = img.mean(axis=-1)
+    paso = max(1, -(-max(img.shape) // lado))  # techo: ningún lado supera lado
+    img = img[::paso, ::paso].astype(np.float32)
+    bajo, alto = np.percentile(img, (1, 99.5))
+    if alto <= bajo:
+        return np.zeros(img.shape, np.uint8)
+    return (np.clip((img - bajo) / (alto - bajo), 0, 1) * 255).astype(np.uint8)
+
+
+def mosaico(teselas, columnas, lado, separacion=4):
+    """Coloca las teselas (uint8, como mucho lado x lado) en una rejilla."""
+    columnas = max(1, min(columnas, len(teselas)))
+    filas = (len(teselas) + columnas - 1) // columnas
+    celda = lado + separacion
+    hoja = np.zeros((filas * celda - separacion, columnas * celda - separacion), np.uint8)
+    for k, t in enumerate(teselas):
+        f, c = divmod(k, columnas)
+        hoja[f * celda:f * celda + t.shape[0], c * celda:c * celda + t.shape[1]] = t
+    return hoja
+
+
+def guardar_png(ruta, img):
+    imsave(ruta, img, cmap="gray", vmin=0, vmax=255)
+
+
+def _iniciar(originales):
+    global _originales
+    _originales = originales
+
+
+def original_de(paciente, plano, serie, ruta, uid):
+    return (_originales.get("/".join((paciente, plano, serie, os.path.basename(ruta))))
+            or _originales.get(uid))
+
+
+def hoja_serie(paciente, plano, serie, carpeta, archivos, destino, cortes=CORTES,
+               columnas=COLUMNAS, lado=LADO):
+    """
+    Genera las hojas de una serie en destino (prefijo de ruta, sin
+    extensión): destino.png con cortes repartidos, destino_medio.png con el
+    corte central y, en sagitales y mixtos, destino_central.png con el corte
+    central antes | después. Devuelve si se encontró el original.
+    """
+    lista = cortes_de_serie(carpeta, archivos)
+    if not lista:
+        raise RuntimeError("la serie no tiene cortes con imagen")
+    elegidos = sorted(set(np.linspace(0, len(lista) - 1, min(cortes, len(lista)))
+                          .round().astype(int)))
+    teselas = [miniatura(leer_corte(*lista[i][:2]), lado) for i in elegidos]
+    guardar_png(destino + ".png", mosaico(teselas, columnas, lado))
+
+    ruta, frame, uid = lista[len(lista) // 2]
+    despues = leer_corte(ruta, frame)
+    guardar_png(destino + "_medio.png", miniatura(despues, lado))
+    con_original = False
+    if plano in PLANOS_RECORTADOS:
+        imagenes = [miniatura(despues, LADO_CENTRAL)]
+        original = original_de(paciente, plano, serie, ruta, uid)
+        if original is not None:
+            try:
+                antes = miniatura(leer_corte(original, frame), LADO_CENTRAL)
+            except Exception:
+                pass
+            else:
+                imagenes.insert(0, antes)
+                con_original = True
+        guardar_png(destino + "_central.png",
+                    mosaico(imagenes, 2, max(max(i.shape) for i in imagenes)))
+    return con_original
+
+
+def leer_medio(ruta):
+    # imread devuelve RGBA en [0, 1]
+    return (imread(ruta)[..., 0] * 255).round().astype(np.uint8)
+
+
+def escribir_indice(qa, pacientes):
+    partes = ["<!DOCTYPE html>", '<html lang="es"><head><meta charset="utf-8">',
+              "<title>Revisión del anonimizado</title>",
+              "<style>body{font-family:sans-serif;background:#111;color:#ddd}"
+              "figure{display:inline-block;margin:6px;vertical-align:top}"
+              "figcaption{font-size:12px}a{color:#9cf}img{image-rendering:pixelated}</style>",
+              "</head><body><h1>Revisión del anonimizado</h1>"]
+    for paciente, series in pacientes.items():
+        p = html.escape(paciente)
+        partes.append(f'<h2 id="{p}">{p}</h2>')
+        partes.append(f'<p><img src="{quote(paciente)}/paciente.png" '
+                      f'alt="corte central de cada serie de {p}"></p>')
+        for s in series:
+            base = quote(f"{paciente}/{s['hoja']}")
+            pie = html.escape(f"{s['plano']} / {s['serie']} ({s['archivos']} archivos)")
+            partes.append(f'<figure><a href="{base}.png"><img src="{base}_medio.png" '
+                          f'alt="{pie}"></a><figcaption>{pie}')
+            if s["plano"] in PLANOS_RECORTADOS:
+                texto = "antes | después" if s["con_original"] else "después (sin original)"
+                partes.append(f'<br><a href="{base}_central.png">corte central: {texto}</a>')
+            partes.append("</figcaption></figure>")
+    partes.append("</body></html>")
+    with open(os.path.join(qa, "index.html"), "w", encoding="utf-8") as fp:
+        fp.write("\n".join(partes))
+
+
+def generar_hojas(salida, qa, originales=None, workers=1, cortes=CORTES, lado=LADO,
+                  sal_uid=None):
+    """
+    Genera (o actualiza) las hojas de contacto de salida en la carpeta qa y
+    su index.html, repartiendo las series entre workers procesos. Las series
+    cuya firma (archivos, tamaños, mtimes y parámetros) coincide con la de la
+    ejecución anterior no se vuelven a generar. originales es la carpeta de
+    entrada del anonimizador, para los cortes centrales antes/después;
+    sal_uid, la sal con la que remapeó los UID, si lo hizo.
+    Devuelve (series generadas, series sin cambios, series con error).
+    """
+    os.makedirs(qa, exist_ok=True)
+    ruta_estado = os.path.join(qa, ESTADO)
+    estado = {}
+    if os.path.exists(ruta_estado):
+        with open(ruta_estado, encoding="utf-8") as fp:
+            estado = json.load(fp)
+
+    mapa = originales_por_manifiesto(salida)
+    if not mapa and originales:
+        print(f"Emparejando originales por SOPInstanceUID en {originales} …")
+        mapa = originales_por_uid(originales, sal_uid)
+
+    series = listar_series(salida)
+    nuevo, trabajos, pacientes = {}, [], {}
+    for paciente, plano, serie, carpeta, archivos in series:
+        clave = f"{paciente}/{plano}/{serie}"
+        hoja = f"{plano}__{serie}"
+        f = firma(archivos, cortes, lado, bool(mapa))
+        previo = estado.get(clave)
+        info = {"plano": plano, "serie": serie, "hoja": hoja, "archivos": len(archivos),
+                "con_original": previo["con_original"] if previo else False}
+        pacientes.setdefault(paciente, []).append(info)
+        if (previo is not None and previo["firma"] == f
+                and os.path.exists(os.path.join(qa, paciente, hoja + "_medio.png"))):
+            nuevo[clave] = previo
+            continue
+        os.makedirs(os.path.join(qa, paciente), exist_ok=True)
+        trabajos.append((clave, f, info, (paciente, plano, serie, carpeta, archivos,
+                                          os.path.join(qa, paciente, hoja), cortes,
+                                          COLUMNAS, lado)))
+
+    cambiados = set()
+    errores = 0
+    with ProcessPoolExecutor(max_workers=max(1, workers), initializer=_iniciar,
+                             initargs=(mapa,)) as pool:
+        futuros = {pool.submit(hoja_serie, *args): (clave, f, info)
+                   for clave, f, info, args in trabajos}
+        for fut in as_completed(futuros):
+            clave, f, info = futuros[fut]
+            try:
+                info["con_original"] = fut.result()
+            except Exception as e:
+                errores += 1
+                print(f"  ⚠️ Error generando la hoja de {clave}: {e}")
+                continue
+            nuevo[clave] = {"firma": f, "con_original": info["con_original"]}
+            cambiados.add(clave.split("/")[0])
+            print(f"  • hoja de {clave}")
+
+    # hoja de paciente: corte central de cada serie, si alguna ha cambiado
+    for paciente, lista in pacientes.items():
+        ruta = os.path.join(qa, paciente, "paciente.png")
+        if paciente not in cambiados and os.path.exists(ruta):
+            continue
+        medios = [os.path.join(qa, paciente, s["hoja"] + "_medio.png") for s in lista]
+        teselas = [leer_medio(m) for m in medios if os.path.exists(m)]
+        if teselas:
+            guardar_png(ruta, mosaico(teselas, COLUMNAS, lado))
+
+    with open(ruta_estado, "w", encoding="utf-8") as fp:
+        json.dump(nuevo, fp, indent=1)
+    escribir_indice(qa, pacientes)
+    generadas = len(trabajos) - errores
+    print(f"Hojas QA: {generadas} series generadas, {len(series) - len(trabajos)} sin cambios, "
+          f"{errores} con error → {os.path.join(qa, 'index.html')}")
+    return generadas, len(series) - len(trabajos), errores
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("salida", help="carpeta de salida del anonimizador")
+    parser.add_argument("--qa", required=True, metavar="CARPETA",
+                        help="dónde escribir las hojas PNG y el index.html")
+    parser.add_argument("--originales", metavar="ENTRADA",
+                        help="carpeta de entrada del anonimizador, para comparar antes/después")
+    parser.add_argument("--clave-seudonimo", metavar="ARCHIVO",
+                        help="clave con la que el anonimizador remapeó los UID (perfiles "
+                             "con UID remapeados), para emparejar por SOPInstanceUID")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="procesos en paralelo (por defecto, uno por núcleo)")
+    parser.add_argument("--cortes", type=int, default=CORTES,
+                        help=f"cortes por hoja de serie (por defecto {CORTES})")
+    parser.add_argument("--lado", type=int, default=LADO,
+                        help=f"tamaño aproximado de cada miniatura (por defecto {LADO})")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.salida):
+        parser.error(f"'{args.salida}' no existe o no es carpeta")
+    sal_uid = None
+    if args.clave_seudonimo:
+        with open(args.clave_seudonimo, "rb") as fk:
+            # la misma derivación que preparar_anonimizacion en el anonimizador
+            sal_uid = hmac.new(fk.read().strip(), b"uids", hashlib.sha256).hexdigest()
+    _, _, errores = generar_hojas(args.salida, args.qa, args.originales, args.workers,
+                                  args.cortes, args.lado, sal_uid)
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inventario.py
+
+Inventario de las entradas del anonimizador (Sytem-without-gui-remastered.py
+--inventario) sin procesarlas: solo se leen las cabeceras, en bloques
+repartidos entre procesos, y se cuentan los archivos por serie, plano,
+sintaxis y matriz.
+"""
+
+import csv
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+
+from comun_dicom import cargar_o_indexar, clasificar_plano, leer_cabecera, sintaxis
+
+BLOQUE_INVENTARIO = 512  # archivos por trabajo de --inventario
+COLUMNAS_INVENTARIO = ["entrada", "paciente", "serie", "serie_uid", "modalidad", "plano",
+                       "sintaxis", "matriz", "archivos", "frames", "bytes", "sin_pixeles"]
+
+
+def inventariar_bloque(root, archivos):
+    """
+    Lee solo la cabecera de los archivos [nombre, tamaño, mtime] de la
+    carpeta root (ver comun_dicom.leer_cabecera) y los cuenta por serie_uid,
+    modalidad, plano (ver clasificar_plano), sintaxis y matriz: devuelve
+    {clave: [archivos, frames, bytes, sin_pixeles]}. Los que no tienen
+    píxeles cuentan con plano "sin_pixel", igual que al procesarlos, y los
+    que no se pueden leer o no son DICOM con plano "ilegible".
+    """
+    grupos = {}
+    for nombre, tamano, _ in archivos:
+        try:
+            with open(os.path.join(root, nombre), "rb") as fp:
+                ds, imagen = leer_cabecera(fp, os.fstat(fp.fileno()).st_size)
+            if ("SOPClassUID" not in ds
+                    and getattr(ds.get("file_meta"), "TransferSyntaxUID", None) is None):
+                raise ValueError("no es un DICOM")  # force lo "lee" igualmente
+            if imagen is None:
+                imagen = "Rows" in ds  # Deflate: sin descomprimir, por la cabecera
+            clave = (str(ds.get("SeriesInstanceUID", "")), str(ds.get("Modality", "")),
+                     clasificar_plano(ds) if imagen else "sin_pixel", str(sintaxis(ds) or ""),
+                     f"{ds.Rows}x{ds.Columns}" if imagen else "")
+            frames = int(ds.get("NumberOfFrames") or 1) if imagen else 0
+        except Exception:
+            clave, imagen, frames = ("", "", "ilegible", "", ""), False, 0
+        g = grupos.setdefault(clave, [0, 0, 0, 0])
+        g[0] += 1
+        g[1] += frames
+        g[2] += tamano
+        g[3] += not imagen
+    return grupos
+
+
+def inventariar(entradas, ruta_salida, rutas_indice=None, workers=1):
+    """
+    Inventario de las entradas sin procesarlas: las cabeceras de todos los
+    archivos se leen en bloques de BLOQUE_INVENTARIO (en workers procesos si
+    workers > 1, ver inventariar_bloque) y se escribe en ruta_salida una
+    fila por entrada, paciente, carpeta de serie, serie_uid, modalidad,
+    plano, sintaxis y matriz (COLUMNAS_INVENTARIO), en CSV o, si acaba en
+    .parquet, en Parquet con pandas. Muestra los totales por entrada.
+    rutas_indice da, por entrada, dónde guardar su índice para reutilizarlo
+    como al procesar (ver cargar_o_indexar). Devuelve las filas escritas, o
+    None si alguna entrada no existe.
+    """
+    inicio = time.perf_counter()
+    trabajos, contexto = [], []
+    for entrada, ruta_indice in zip(entradas, rutas_indice or [None] * len(entradas)):
+        if not os.path.isdir(entrada):
+            print(f"ERROR: '{entrada}' no existe o no es carpeta.")
+            return None
+        indice = cargar_o_indexar(entrada, ruta_indice)
+        for paciente in indice["pacientes"]:
+            for serie in paciente["series"]:
+                root = os.path.join(entrada, serie["ruta"]) if serie["ruta"] else entrada
+                for i in range(0, len(serie["archivos"]), BLOQUE_INVENTARIO):
+                    trabajos.append((root, serie["archivos"][i:i + BLOQUE_INVENTARIO]))
+                    contexto.append((entrada, paciente["carpeta"], serie["ruta"]))
+    print(f"Inventario: {sum(len(t[1]) for t in trabajos)} archivos en {len(entradas)} entradas")
+
+    filas = {}  # (entrada, paciente, serie, serie_uid, ...) -> contadores, en orden del índice
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        resultados = pool.map(inventariar_bloque, *zip(*trabajos)) if trabajos else []
+    else:
+        pool = None
+        resultados = (inventariar_bloque(*t) for t in trabajos)
+    try:
+        for ctx, grupos in zip(contexto, resultados):
+            for clave, cuentas in grupos.items():
+                f = filas.setdefault(ctx + clave, [0, 0, 0, 0])
+                for k, v in enumerate(cuentas):
+                    f[k] += v
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    tabla = [list(clave) + cuentas for clave, cuentas in filas.items()]
+    if ruta_salida.endswith(".parquet"):
+        import pandas
+        pandas.DataFrame(tabla, columns=COLUMNAS_INVENTARIO).to_parquet(ruta_salida, index=False)
+    else:
+        with open(ruta_salida, "w", encoding="utf-8", newline="") as fp:
+            escritor = csv.writer(fp)
+            escritor.writerow(COLUMNAS_INVENTARIO)
+            escritor.writerows(tabla)
+
+    for entrada in entradas:
+        de_entrada = [f for f in tabla if f[0] == entrada]
+        planos, sintaxis_ = Counter(), Counter()
+        for f in de_entrada:
+            planos[f[5]] += f[8]
+            if f[6]:
+                sintaxis_[pydicom.uid.UID(f[6]).name] += f[8]
+        series = {(f[1], f[3]) for f in de_entrada if f[3]}
+        print(f"\n{entrada}: {len({f[1] for f in de_entrada})} pacientes, {len(series)} series, "
+              f"{sum(f[8] for f in de_entrada)} archivos "
+              f"({sum(f[10] for f in de_entrada) / 1e6:.1f} MB), "
+              f"{sum(f[11] for f in de_entrada)} sin píxeles")
+        print("  planos: " + ", ".join(f"{p} {n}" for p, n in planos.most_common()))
+        print("  sintaxis: " + ", ".join(f"{t} {n}" for t, n in sintaxis_.most_common()))
+    segundos = time.perf_counter() - inicio
+    n = sum(f[8] for f in tabla)
+    print(f"\nInventario en {ruta_salida}: {len(tabla)} filas, {n} archivos en {segundos:.1f} s "
+          f"({n / segundos * 60 if segundos else 0:.0f} archivos/min)")
+    return tabla
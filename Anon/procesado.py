@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+procesado.py
+
+Procesado de las unidades de trabajo del anonimizador
+(Sytem-without-gui-remastered.py) en cada proceso: lectura, anonimización,
+clasificación por plano, recorte de los sagitales y escritura de los
+archivos de una carpeta de serie (ver procesar_directorio). Las opciones de
+la unidad y su estado (telemetría, escritor, empaquetador, carpetas ya
+creadas) van en un Contexto que se pasa explícitamente a cada función.
+"""
+
+import cProfile
+import io
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+from pydicom.pixels import get_decoder
+
+import comun_dicom as comun
+from anonimizacion import PERFILES_ANONIMIZACION, anonimizar, compilar_anonimizacion
+from comun_dicom import (PLANTILLAS_MASCARA, TAMANO_BLOQUE, aplicar_mascara,
+                         clasificar_orientaciones, clasificar_plano, ejes_imagen, geometria,
+                         hash_archivo, leer_cabecera, leer_cabecera_pixeles, mascara_para,
+                         orientaciones, recortar_frames, sintaxis, tiene_pixeles, vista_pixeles)
+from escritura import Escritor, Empaquetador, escribir_salida
+from telemetria import Telemetria, medir
+
+# con pipeline, los archivos mayores no se leen por adelantado en memoria
+MAX_LECTURA_ANTICIPADA = 64 << 20
+# memoria que ocupa procesar un objeto respecto a sus píxeles decodificados
+# (array decodificado, recorte o codificación y serialización de la salida)
+FACTOR_MEMORIA = 3
+
+_perfilador = None  # cProfile del proceso, acumulado entre sus unidades de trabajo
+
+
+class Contexto:
+    """
+    Opciones y estado de una unidad de trabajo (ver procesar_directorio):
+    el perfil de anonimización ya compilado, la plantilla de la máscara, el
+    tratamiento de las sintaxis comprimidas, el límite de memoria por
+    objeto, la Telemetria (None = sin instrumentar), el Escritor del
+    pipeline (None = escritura síncrona), el Empaquetador (None = salida en
+    carpetas) y las carpetas de salida ya creadas.
+    """
+
+    def __init__(self, anonimizacion=None, plantilla=None, decodificador="", hilos_codec=1,
+                 sintaxis_salida="original", limite_memoria=0, telemetria=None,
+                 empaquetador=None):
+        self.anonimizacion = compilar_anonimizacion(
+            anonimizacion or PERFILES_ANONIMIZACION["minimo"])
+        self.plantilla = plantilla or PLANTILLAS_MASCARA["clasica"]
+        self.decodificador = decodificador
+        self.hilos_codec = hilos_codec
+        self.sintaxis_salida = sintaxis_salida
+        self.limite_memoria = limite_memoria
+        self.telemetria = telemetria
+        self.escritor = None
+        self.empaquetador = empaquetador
+        self.carpetas = set()
+
+    def etapa(self, nombre):
+        return medir(self.telemetria, nombre)
+
+    def contar(self, contador, valor=1):
+        if self.telemetria is not None:
+            self.telemetria.sumar(contador, valor)
+
+
+def anonimizar_cabecera(ctx, ds, tag_p):
+    """Aplica a ds el perfil de anonimización de ctx (ver anonimizacion.anonimizar)."""
+    with ctx.etapa("anonimizacion"):
+        anonimizar(ds, tag_p, ctx.anonimizacion)
+
+
+def leer_descripcion_serie(root, dicoms):
+    # solo hace falta la cabecera del primer archivo de la carpeta
+    try:
+        ds0 = pydicom.dcmread(os.path.join(root, dicoms[0]), force=True,
+                              stop_before_pixels=True)
+        return ds0.get("SeriesDescription", "SinDescripcion").replace(" ", "_")
+    except Exception:
+        return "SinDescripcion"
+
+
+def ruta_destino(ctx, out_p, plano, serie, ruta):
+    # OUTPUT/Paciente_XXXX/plano/SerieDescription/archivo
+    serie_dir = os.path.join(out_p, plano, serie)
+    if ctx.empaquetador is None and serie_dir not in ctx.carpetas:
+        with ctx.etapa("makedirs"):
+            os.makedirs(serie_dir, exist_ok=True)
+        ctx.carpetas.add(serie_dir)
+    return os.path.join(serie_dir, os.path.basename(ruta))
+
+
+def leer_por_adelantado(root, dicoms, cola, maximo=MAX_LECTURA_ANTICIPADA):
+    """
+    Etapa de lectura del pipeline (en un hilo aparte): deja en cola, acotada
+    y en el orden de dicoms, (contenido, segundos) de cada archivo. Los que
+    superan maximo bytes o no se pueden leer van con contenido None y se
+    leen del disco al procesarlos.
+    """
+    for f in dicoms:
+        ruta = os.path.join(root, f)
+        inicio = time.perf_counter()
+        datos = None
+        try:
+            if os.path.getsize(ruta) <= maximo:
+                with open(ruta, "rb") as fp:
+                    datos = fp.read()
+        except OSError:
+            pass
+        cola.put((datos, time.perf_counter() - inicio))
+
+
+def guardar(ctx, ds, destino):
+    if ctx.escritor is not None or ctx.empaquetador is not None:
+        with ctx.etapa("serializacion"):
+            buf = io.BytesIO()
+            ds.save_as(buf)
+        if ctx.escritor is not None:
+            ctx.escritor.encolar(destino, [buf.getbuffer()])
+            return
+        with ctx.etapa("escritura"):
+            ctx.contar("bytes_escritos", escribir_salida(destino, [buf.getbuffer()],
+                                                         buf.getbuffer().nbytes,
+                                                         ctx.empaquetador))
+        return
+    with ctx.etapa("escritura"):
+        ds.save_as(destino)
+    if ctx.telemetria is not None:
+        ctx.contar("bytes_escritos", os.path.getsize(destino))
+
+
+def pixeles(ctx, ds):
+    """
+    Devuelve los píxeles de ds como array, para recortarlos; el resto de
+    planos se clasifica por la cabecera sin llamarla (ver cargar_archivo). Los
+    nativos no se decodifican: se devuelve una vista escribible sobre
+    PixelData (ver vista_pixeles). En
+    sintaxis comprimidas se decodifican una vez con el plugin de
+    ctx.decodificador (o el primero disponible, si ese no admite la
+    sintaxis) y, en objetos multi-frame, en ctx.hilos_codec hilos.
+    """
+    ts = sintaxis(ds)
+    with ctx.etapa("decodificacion"):
+        img = vista_pixeles(ds, ts)
+        if img is not None:
+            return img
+        if ts is None or not ts.is_compressed:
+            img = ds.pixel_array
+        else:
+            decoder = get_decoder(ts)
+            plugin = ctx.decodificador
+            if plugin not in decoder.available_plugins:
+                plugin = ""
+            n_frames = int(ds.get("NumberOfFrames") or 1)
+            if ctx.hilos_codec > 1 and n_frames > 1:
+                def frame(i):
+                    return decoder.as_array(ds, index=i, decoding_plugin=plugin)[0]
+
+                with ThreadPoolExecutor(max_workers=ctx.hilos_codec) as pool:
+                    img = np.stack(list(pool.map(frame, range(n_frames))))
+            else:
+                ds.pixel_array_options(decoding_plugin=plugin)
+                img = ds.pixel_array
+    ctx.contar("decodificaciones")
+    return img
+
+
+def escribir_pixeles(ctx, ds, img):
+    """
+    Sustituye los píxeles de ds por img (ver comun_dicom.escribir_pixeles)
+    según ctx.sintaxis_salida; la codificación cuenta en la etapa "codificacion".
+    """
+    ts = sintaxis(ds)
+    if ts is None or not ts.is_compressed:
+        comun.escribir_pixeles(ds, img)
+        return
+    with ctx.etapa("codificacion"):
+        comun.escribir_pixeles(ds, img, ctx.sintaxis_salida)
+
+
+def reescribir_en_streaming(ctx, fp, ds, destino, tag_p, datos=None):
+    """
+    Escribe en destino la cabecera ds (leída de fp con stop_before_pixels)
+    ya anonimizada y copia por bloques el resto de fp a continuación, de modo
+    que el elemento de píxeles (7FE0,0010) pasa sin cargarse en memoria.
+    Si fp se leyó por adelantado (datos es su contenido) y hay pipeline, el
+    resto se encola al Escritor como vista sobre datos, sin copiarlo.
+    """
+    anonimizar_cabecera(ctx, ds, tag_p)
+    if ctx.escritor is not None and datos is not None:
+        with ctx.etapa("serializacion"):
+            cabecera = io.BytesIO()
+            ds.save_as(cabecera)
+        ctx.escritor.encolar(destino, [cabecera.getbuffer(), memoryview(datos)[fp.tell():]])
+        return
+    if ctx.empaquetador is not None:
+        with ctx.etapa("serializacion"):
+            cabecera = io.BytesIO()
+            ds.save_as(cabecera)
+        pos = fp.tell()
+        resto = fp.seek(0, io.SEEK_END) - pos
+        fp.seek(pos)
+        with ctx.etapa("escritura"):
+            ctx.contar("bytes_escritos", escribir_salida(
+                destino, [cabecera.getbuffer(), fp], cabecera.getbuffer().nbytes + resto,
+                ctx.empaquetador))
+        return
+    with ctx.etapa("escritura"), open(destino, "wb") as out:
+        ds.save_as(out)
+        shutil.copyfileobj(fp, out, TAMANO_BLOQUE)
+        ctx.contar("bytes_escritos", out.tell())
+
+
+def elementos_tras_pixeles(fp, ds, tamano):
+    """
+    True si en fp, tras el elemento de píxeles que empieza en la posición
+    actual, quedan más elementos (grupos privados 7FE1, relleno...). Solo se
+    leen las cabeceras del elemento y de sus fragmentos; fp vuelve a su
+    posición. Si no se puede saber, True.
+    """
+    inicio = fp.tell()
+    try:
+        leida = leer_cabecera_pixeles(fp, ds)
+        if leida is None:
+            return True
+        longitud = leida[1]
+        if longitud != 0xFFFFFFFF:
+            fp.seek(longitud, 1)
+        else:
+            # encapsulado: fragmentos hasta el delimitador (FFFE,E0DD)
+            while True:
+                item = fp.read(8)
+                if len(item) < 8:
+                    break
+                grupo, elemento, n = struct.unpack("<HHI", item)
+                if (grupo, elemento) == (0xFFFE, 0xE0DD):
+                    break
+                fp.seek(n, 1)
+        return fp.tell() < tamano
+    except struct.error:
+        return True
+    finally:
+        fp.seek(inicio)
+
+
+def tamano_decodificado(ds):
+    """Bytes de los píxeles de ds decodificados, según su cabecera (0 si no es una imagen)."""
+    try:
+        return (int(ds.Rows) * int(ds.Columns) * int(ds.get("SamplesPerPixel") or 1)
+                * ((int(ds.BitsAllocated) + 7) // 8) * int(ds.get("NumberOfFrames") or 1))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def recortar_en_streaming(ctx, fp, ds, destino, tag_p, plano):
+    """
+    Como reescribir_en_streaming, pero aplicando la máscara a los píxeles
+    frame a frame según se copian, de modo que en memoria solo hay un frame.
+    Solo para píxeles sin comprimir de una muestra y 8, 16 o 32 bits; si no,
+    devuelve False sin escribir nada y fp queda donde estaba.
+    """
+    ts = sintaxis(ds)
+    bits = ds.get("BitsAllocated")
+    if (ts is None or ts.is_compressed or bits not in (8, 16, 32)
+            or ds.get("SamplesPerPixel", 1) != 1):
+        return False
+    filas, cols = ds.Rows, ds.Columns
+    n_frames = int(ds.get("NumberOfFrames") or 1)
+    dtype = np.dtype(f"{'i' if ds.get('PixelRepresentation', 0) else 'u'}{bits // 8}")
+    dtype = dtype.newbyteorder("<" if ts.is_little_endian else ">")
+    por_frame = filas * cols * dtype.itemsize
+    inicio = fp.tell()
+    try:
+        leida = leer_cabecera_pixeles(fp, ds)
+    except struct.error:
+        leida = None
+    if leida is None or leida[1] == 0xFFFFFFFF or leida[1] < n_frames * por_frame:
+        fp.seek(inicio)
+        return False
+
+    with ctx.etapa("mascara"):
+        m = mascara_para(ds, filas, cols, ctx.plantilla)
+        sagitales = (clasificar_orientaciones(orientaciones(ds)) == "sagital"
+                     if plano == "mixto" else None)
+    anonimizar_cabecera(ctx, ds, tag_p)
+    cabecera = io.BytesIO()
+    ds.save_as(cabecera)
+    pos = fp.tell()
+    resto = fp.seek(0, io.SEEK_END) - pos
+    fp.seek(pos)
+
+    def trozos():
+        yield cabecera.getbuffer()
+        yield leida[0]
+        frame = bytearray(por_frame)
+        for i in range(n_frames):
+            fp.readinto(frame)
+            if sagitales is None or sagitales[i]:
+                aplicar_mascara(np.frombuffer(frame, dtype).reshape(filas, cols), m)
+            yield frame
+        # lo que quede del elemento y lo que venga detrás, tal cual
+        yield fp
+
+    with ctx.etapa("escritura"):
+        ctx.contar("bytes_escritos", escribir_salida(
+            destino, trozos(), cabecera.getbuffer().nbytes + len(leida[0]) + resto,
+            ctx.empaquetador))
+    return True
+
+
+def cargar_archivo(ctx, ruta, serie, tag_p, out_p, lectura_rapida=False, datos=None):
+    """
+    Lee y anonimiza un DICOM y detecta su plano. Devuelve (plano, ds, img),
+    con img los píxeles decodificados (None si no se han decodificado).
+    datos es el contenido del archivo si ya se ha leído (ver
+    leer_por_adelantado); si es None se lee de ruta.
+
+    Con lectura_rapida el plano se decide solo con la cabecera y los píxeles
+    solo se decodifican en los sagitales; el resto se reescribe en streaming
+    con sus bytes de píxel intactos (ver reescribir_en_streaming) y se
+    devuelve ds = None porque ya está guardado. Si el perfil de
+    anonimización alcanza a elementos posteriores a los píxeles y el
+    archivo los tiene, se lee entero en lugar de copiarlos.
+
+    Con límite de memoria (ver procesar_directorio) se lee primero la
+    cabecera y, si los píxeles decodificados por FACTOR_MEMORIA lo superan,
+    el objeto va por el camino de streaming aunque no haya lectura_rapida:
+    se copia sin decodificar o, si es sagital, se recorta frame a frame
+    (ver recortar_en_streaming). En ambos casos, ValueError si los píxeles
+    están incompletos (ver comun_dicom.leer_cabecera).
+    """
+    plano = None
+    if lectura_rapida or ctx.limite_memoria:
+        with (io.BytesIO(datos) if datos is not None else open(ruta, "rb")) as fp:
+            tamano = len(datos) if datos is not None else os.fstat(fp.fileno()).st_size
+            with ctx.etapa("lectura"):
+                ds, con_pixeles = leer_cabecera(fp, tamano)
+            if con_pixeles is not None:
+                # fp queda al inicio del elemento de píxeles, si existe
+                grande = bool(ctx.limite_memoria and con_pixeles and
+                              FACTOR_MEMORIA * tamano_decodificado(ds) > ctx.limite_memoria)
+                if lectura_rapida or grande:
+                    with ctx.etapa("clasificacion"):
+                        plano = clasificar_plano(ds) if con_pixeles else "sin_pixel"
+                    # lo que venga tras los píxeles se copiaría sin anonimizar
+                    cola = (con_pixeles and ctx.anonimizacion["cola"]
+                            and elementos_tras_pixeles(fp, ds, tamano))
+                    if plano not in ("sagital", "mixto") and not cola:
+                        ctx.contar("bytes_leidos", tamano)
+                        ctx.contar("streaming_por_memoria", int(grande))
+                        destino = ruta_destino(ctx, out_p, plano, serie, ruta)
+                        reescribir_en_streaming(ctx, fp, ds, destino, tag_p, datos)
+                        return plano, None, None
+                    destino = ruta_destino(ctx, out_p, plano, serie, ruta)
+                    if grande and not cola and recortar_en_streaming(ctx, fp, ds, destino,
+                                                                     tag_p, plano):
+                        ctx.contar("bytes_leidos", tamano)
+                        ctx.contar("streaming_por_memoria")
+                        return plano, None, None
+
+    with ctx.etapa("lectura"):
+        ds = pydicom.dcmread(io.BytesIO(datos) if datos is not None else ruta, force=True)
+    if ctx.telemetria is not None:
+        ctx.contar("bytes_leidos", len(datos) if datos is not None else os.path.getsize(ruta))
+
+    # 1) Anonimizar
+    anonimizar_cabecera(ctx, ds, tag_p)
+
+    # 2) Detectar plano por la cabecera; solo los sagitales se decodifican
+    img = None
+    if plano is None:
+        plano = "sin_pixel"
+        if tiene_pixeles(ds):
+            with ctx.etapa("clasificacion"):
+                plano = clasificar_plano(ds)
+    if plano in ("sagital", "mixto"):
+        img = pixeles(ctx, ds)
+    return plano, ds, img
+
+
+def procesar_archivo(ctx, ruta, serie, tag_p, out_p, lectura_rapida=False, datos=None):
+    """Anonimiza un DICOM, lo recorta si es sagital y lo guarda. Devuelve el plano."""
+    plano, ds, img = cargar_archivo(ctx, ruta, serie, tag_p, out_p, lectura_rapida, datos)
+    if ds is None:
+        return plano
+
+    # 3) Aplicar máscara solo en sagitales (o en los frames sagitales)
+    if plano in ("sagital", "mixto"):
+        with ctx.etapa("mascara"):
+            rec = recortar_frames(ds, img, plano, ctx.plantilla)
+        escribir_pixeles(ctx, ds, rec)
+
+    # 4) Construir carpeta de destino:
+    #    OUTPUT/Paciente_XXXX/plano/SerieDescription/
+    destino = ruta_destino(ctx, out_p, plano, serie, ruta)
+
+    # 5) Guardar el DICOM procesado
+    guardar(ctx, ds, destino)
+    return plano
+
+
+def recortar_pila_sagital(ctx, datasets, imagenes):
+    """
+    Aplica la máscara facial de una sola vez a cortes sagitales de la misma
+    serie y geometría (comparten máscara), apilados en un array (N, filas,
+    cols), también de color (ver ejes_imagen). Si todas son vistas sobre su
+    PixelData (ver vista_pixeles) se recortan in situ, sin copiarlas a la pila.
+    """
+    ds0 = datasets[0]
+    if all(isinstance(ds.PixelData, memoryview) for ds in datasets):
+        with ctx.etapa("mascara"):
+            m = mascara_para(ds0, ds0.Rows, ds0.Columns, ctx.plantilla)
+            for img in imagenes:
+                aplicar_mascara(ejes_imagen(ds0, img), m)
+        return
+
+    pila = np.stack(imagenes)
+    with ctx.etapa("mascara"):
+        m = mascara_para(ds0, ds0.Rows, ds0.Columns, ctx.plantilla)
+        aplicar_mascara(ejes_imagen(ds0, pila), m)
+    for ds, corte in zip(datasets, pila):
+        escribir_pixeles(ctx, ds, corte)
+
+
+def _procesar_directorio(ctx, root, dicoms, tag_p, out_p, lectura_rapida, por_serie, registrar,
+                         pipeline):
+    inicio = time.perf_counter()
+    n_ok, n_bytes = 0, 0
+    registros = []
+    pilas = {}
+    en_pilas = 0  # bytes de píxeles esperando en pilas
+
+    lecturas = None
+    if pipeline:
+        lecturas = queue.Queue(maxsize=pipeline)
+        maximo = MAX_LECTURA_ANTICIPADA
+        if ctx.limite_memoria:
+            # la cola no puede ocupar más que el límite de un objeto
+            maximo = min(maximo, ctx.limite_memoria // pipeline)
+        threading.Thread(target=leer_por_adelantado, args=(root, dicoms, lecturas, maximo),
+                         daemon=True).start()
+
+    # Leer la serie para usar su descripción
+    serie = leer_descripcion_serie(root, dicoms)
+
+    def terminado(ruta, plano, error=None):
+        nonlocal n_ok, n_bytes
+        if ctx.telemetria is not None:
+            ctx.telemetria.fin_archivo(plano, error)
+        st = os.stat(ruta)
+        if error is None:
+            n_ok += 1
+            n_bytes += st.st_size
+            print(f"  • [{plano:8}] {serie}/{os.path.basename(ruta)} → guardado en {plano}/{serie}")
+        else:
+            print(f"  ⚠️ Error procesando '{ruta}': {error}")
+        if registrar:
+            destino = os.path.join(out_p, plano, serie, os.path.basename(ruta)) if plano else None
+            registros.append((os.path.abspath(ruta), st.st_size, st.st_mtime,
+                              hash_archivo(ruta), destino, plano,
+                              "ok" if error is None else "error"))
+
+    def recoger_escritos(esperar=False):
+        for (ruta, plano, registro), error, segundos, n in ctx.escritor.terminados(esperar):
+            if ctx.telemetria is not None:
+                ctx.telemetria.reanudar(registro)
+                if error is None and n:
+                    ctx.telemetria.tiempo("escritura", segundos)
+                    ctx.contar("bytes_escritos", n)
+            terminado(ruta, plano if error is None else None, error)
+
+    def guardado(ruta, plano):
+        # con pipeline, el archivo termina cuando el escritor lo ha guardado
+        if ctx.escritor is None:
+            terminado(ruta, plano)
+            return
+        registro = ctx.telemetria.suspender() if ctx.telemetria is not None else None
+        ctx.escritor.marcar((ruta, plano, registro))
+        recoger_escritos()
+
+    def vaciar_pilas():
+        nonlocal en_pilas
+        for grupo in pilas.values():
+            try:
+                recortar_pila_sagital(ctx, [g[1] for g in grupo], [g[2] for g in grupo])
+            except Exception as e:
+                for ruta, _, _, registro in grupo:
+                    if ctx.telemetria is not None:
+                        ctx.telemetria.reanudar(registro)
+                    terminado(ruta, None, e)
+                continue
+            for ruta, ds, _, registro in grupo:
+                if ctx.telemetria is not None:
+                    ctx.telemetria.reanudar(registro)
+                try:
+                    guardar(ctx, ds, ruta_destino(ctx, out_p, "sagital", serie, ruta))
+                    guardado(ruta, "sagital")
+                except Exception as e:
+                    terminado(ruta, None, e)
+        pilas.clear()
+        en_pilas = 0
+
+    for f in dicoms:
+        ruta = os.path.join(root, f)
+        datos = None
+        if lecturas is not None:
+            with ctx.etapa("espera_lectura"):
+                datos, segundos = lecturas.get()
+        if ctx.telemetria is not None:
+            ctx.telemetria.inicio_archivo(ruta)
+            if lecturas is not None:
+                ctx.telemetria.tiempo("prelectura", segundos)
+        try:
+            if por_serie:
+                plano, ds, img = cargar_archivo(ctx, ruta, serie, tag_p, out_p, lectura_rapida,
+                                                datos)
+                if plano == "sagital" and ds is not None:
+                    clave = (ds.get("SeriesInstanceUID"), img.shape, img.dtype.str,
+                             geometria(ds))
+                    registro = ctx.telemetria.suspender() if ctx.telemetria is not None else None
+                    pilas.setdefault(clave, []).append((ruta, ds, img, registro))
+                    # con límite de memoria las pilas se recortan por tramos
+                    en_pilas += img.nbytes
+                    if ctx.limite_memoria and FACTOR_MEMORIA * en_pilas > ctx.limite_memoria:
+                        vaciar_pilas()
+                    continue
+                if plano == "mixto" and ds is not None:
+                    with ctx.etapa("mascara"):
+                        escribir_pixeles(ctx, ds, recortar_frames(ds, img, plano, ctx.plantilla))
+                if ds is not None:
+                    guardar(ctx, ds, ruta_destino(ctx, out_p, plano, serie, ruta))
+            else:
+                plano = procesar_archivo(ctx, ruta, serie, tag_p, out_p, lectura_rapida, datos)
+            guardado(ruta, plano)
+        except Exception as e:
+            terminado(ruta, None, e)
+
+    vaciar_pilas()
+    if ctx.escritor is not None:
+        recoger_escritos(esperar=True)
+    return os.getpid(), n_ok, n_bytes, time.perf_counter() - inicio, registros
+
+
+def procesar_directorio(root, dicoms, tag_p, out_p, lectura_rapida=False,
+                        por_serie=False, registrar=False, telemetria=False,
+                        por_archivo=False, ruta_perfil=None, decodificador="",
+                        hilos_codec=1, sintaxis_salida="original",
+                        plantilla_mascara=None, pipeline=0, anonimizacion=None,
+                        memoria_objeto=0, empaquetador=None):
+    """
+    Procesa todos los DICOMs de una carpeta de serie. Es la unidad de trabajo
+    que se reparte entre procesos; devuelve (pid, archivos, bytes, segundos,
+    registros, telemetria). Las opciones se reúnen en un Contexto que se
+    pasa a cada función del procesado.
+
+    Con por_serie los cortes sagitales se agrupan por SeriesInstanceUID y
+    tamaño de matriz y se recortan como una pila 3D antes de guardarlos.
+    Con registrar, registros contiene una fila del Manifiesto por archivo.
+    Con telemetria se devuelven los tiempos por etapa (Telemetria.exportar),
+    con por_archivo incluyendo un registro por archivo. Con ruta_perfil el
+    trabajo se perfila con cProfile y el acumulado del proceso se vuelca en
+    ruta_perfil.<pid>.
+    decodificador, hilos_codec y sintaxis_salida configuran el tratamiento
+    de las sintaxis comprimidas (ver pixeles y escribir_pixeles).
+    plantilla_mascara son los parámetros de la máscara (por defecto
+    PLANTILLAS_MASCARA["clasica"]).
+    Con pipeline > 0, la lectura y la escritura van en hilos propios unidas al
+    proceso por colas de pipeline archivos (ver leer_por_adelantado y
+    Escritor), de modo que el disco y la CPU trabajan a la vez.
+    anonimizacion es el perfil de preparar_anonimizacion (por defecto el
+    "minimo"); se compila una sola vez por proceso.
+    Con memoria_objeto (bytes) ningún objeto se decodifica entero si su
+    memoria estimada lo supera (ver cargar_archivo), las pilas de por_serie
+    se recortan por tramos que no lo superen y la lectura anticipada del
+    pipeline tampoco lo supera.
+    empaquetador es el Empaquetador en el que se escribe la salida, si va en
+    archivos comprimidos (ver procesar_empaquetado).
+    """
+    global _perfilador
+    ctx = Contexto(anonimizacion, plantilla_mascara, decodificador, hilos_codec,
+                   sintaxis_salida, memoria_objeto,
+                   Telemetria(por_archivo) if telemetria else None, empaquetador)
+    if ruta_perfil:
+        if _perfilador is None:
+            _perfilador = cProfile.Profile()
+        _perfilador.enable()
+    if pipeline:
+        ctx.escritor = Escritor(pipeline, empaquetador, ctx.telemetria)
+    try:
+        resultado = _procesar_directorio(ctx, root, dicoms, tag_p, out_p, lectura_rapida,
+                                         por_serie, registrar, pipeline)
+    finally:
+        if ctx.escritor is not None:
+            ctx.escritor.cerrar()
+        if ruta_perfil:
+            _perfilador.disable()
+            _perfilador.dump_stats(f"{ruta_perfil}.{os.getpid()}")
+    datos = ctx.telemetria.exportar() if ctx.telemetria is not None else None
+    return resultado + (datos,)
+
+
+def procesar_empaquetado(trabajos, empaquetar, **opciones):
+    """
+    Procesa con procesar_directorio los trabajos (root, dicoms, tag_p, out_p)
+    de un paciente escribiendo en archivos comprimidos en lugar de carpetas
+    (ver Empaquetador), que se cierran al terminar; empaquetar es
+    (formato, por). Devuelve la lista de resultados.
+    """
+    empaquetador = Empaquetador(*empaquetar)
+    try:
+        return [procesar_directorio(*t, empaquetador=empaquetador, **opciones)
+                for t in trabajos]
+    finally:
+        empaquetador.cerrar()
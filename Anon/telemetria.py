@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+telemetria.py
+
+Telemetría del anonimizador (Sytem-without-gui-remastered.py): tiempos por
+etapa en histogramas que se combinan entre procesos, contadores de bytes y
+de decodificaciones, y la tabla que se imprime al final. Las funciones del
+procesado miden con medir sobre la Telemetria de su unidad de trabajo (ver
+procesado.Contexto).
+"""
+
+import bisect
+import time
+from contextlib import contextmanager
+
+# límites (s) de los cubos del histograma de tiempos: 0.1 ms … ~13 s
+LIMITES_HISTOGRAMA = [1e-4 * 2 ** i for i in range(18)]
+
+
+class Telemetria:
+    """
+    Tiempos por etapa del pipeline (lectura, decodificacion, clasificacion,
+    mascara, makedirs, escritura y, con pipeline, prelectura, serializacion
+    y las esperas en las colas) y contadores de bytes leídos/escritos, de
+    decodificaciones de píxeles y de objetos que, por el límite de memoria,
+    se recortaron o copiaron en streaming, agregados por etapa en histogramas que se
+    pueden combinar entre procesos y, con por_archivo, también por archivo.
+    """
+
+    def __init__(self, por_archivo=False):
+        self.por_archivo = por_archivo
+        self.etapas = {}  # etapa -> [n, total, máximo, histograma]
+        self.contadores = {"bytes_leidos": 0, "bytes_escritos": 0, "decodificaciones": 0,
+                           "streaming_por_memoria": 0}
+        self.archivos = []
+        self.actual = None
+
+    def inicio_archivo(self, ruta):
+        self.actual = {"tipo": "archivo", "archivo": ruta, "etapas": {},
+                       "bytes_leidos": 0, "bytes_escritos": 0, "decodificaciones": 0,
+                       "streaming_por_memoria": 0}
+
+    def fin_archivo(self, plano, error=None):
+        if self.por_archivo and self.actual is not None:
+            self.actual["plano"] = plano
+            if error is not None:
+                self.actual["error"] = str(error)
+            self.archivos.append(self.actual)
+        self.actual = None
+
+    def suspender(self):
+        # aparta el registro del archivo actual (p. ej. un sagital que espera a su pila)
+        actual, self.actual = self.actual, None
+        return actual
+
+    def reanudar(self, registro):
+        self.actual = registro
+
+    def sumar(self, contador, valor=1):
+        self.contadores[contador] += valor
+        if self.actual is not None:
+            self.actual[contador] += valor
+
+    def tiempo(self, nombre, segundos):
+        e = self.etapas.setdefault(nombre, [0, 0.0, 0.0, [0] * (len(LIMITES_HISTOGRAMA) + 1)])
+        e[0] += 1
+        e[1] += segundos
+        e[2] = max(e[2], segundos)
+        e[3][bisect.bisect_left(LIMITES_HISTOGRAMA, segundos)] += 1
+        if self.actual is not None:
+            self.actual["etapas"][nombre] = self.actual["etapas"].get(nombre, 0.0) + segundos
+
+    def exportar(self):
+        # lo que un worker devuelve al proceso principal
+        return {"etapas": self.etapas, "contadores": self.contadores,
+                "archivos": self.archivos}
+
+    def combinar(self, datos):
+        for nombre, (n, total, maximo, hist) in datos["etapas"].items():
+            e = self.etapas.setdefault(nombre, [0, 0.0, 0.0, [0] * len(hist)])
+            e[0] += n
+            e[1] += total
+            e[2] = max(e[2], maximo)
+            e[3] = [a + b for a, b in zip(e[3], hist)]
+        for clave, valor in datos["contadores"].items():
+            self.contadores[clave] += valor
+
+    def resumen(self):
+        """Por etapa: n, total, media, p50, p95 (cota superior del cubo) y máximo."""
+        def percentil(hist, n, q):
+            acumulado = 0
+            for i, c in enumerate(hist):
+                acumulado += c
+                if acumulado >= q * n:
+                    return LIMITES_HISTOGRAMA[i] if i < len(LIMITES_HISTOGRAMA) else float("inf")
+            return float("inf")
+
+        etapas = {}
+        for nombre, (n, total, maximo, hist) in self.etapas.items():
+            etapas[nombre] = {"n": n, "total_s": total, "media_s": total / n,
+                              "p50_s": min(percentil(hist, n, 0.5), maximo),
+                              "p95_s": min(percentil(hist, n, 0.95), maximo),
+                              "max_s": maximo, "histograma": hist}
+        return {"tipo": "resumen", "etapas": etapas, "contadores": self.contadores,
+                "limites_histograma_s": LIMITES_HISTOGRAMA}
+
+
+@contextmanager
+def medir(telemetria, nombre):
+    # suma a telemetria el tiempo del bloque como etapa nombre; sin telemetria no mide
+    if telemetria is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        telemetria.tiempo(nombre, time.perf_counter() - inicio)
+
+
+def imprimir_telemetria(resumen):
+    print(f"\n{'etapa':<16}{'n':>8}{'total s':>10}{'media ms':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'máx ms':>10}")
+    for nombre, e in sorted(resumen["etapas"].items(), key=lambda x: -x[1]["total_s"]):
+        print(f"{nombre:<16}{e['n']:>8}{e['total_s']:>10.2f}{e['media_s'] * 1e3:>10.2f}"
+              f"{e['p50_s'] * 1e3:>10.2f}{e['p95_s'] * 1e3:>10.2f}{e['max_s'] * 1e3:>10.2f}")
+    c = resumen["contadores"]
+    print(f"Leídos {c['bytes_leidos'] / 1e6:.1f} MB, escritos {c['bytes_escritos'] / 1e6:.1f} MB, "
+          f"{c['decodificaciones']} decodificaciones de píxeles")
+    if c["streaming_por_memoria"]:
+        print(f"{c['streaming_por_memoria']} objetos en streaming por el límite de memoria")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_anonimizador.py
+
+Mide el rendimiento de anonimizar_y_recortar_por_plano sobre un árbol de
+DICOMs sintéticos (ver generar_sinteticos.py): la ejecución completa y cada
+etapa por separado (lectura, decodificación, clasificar_plano, máscara y
+save_as), en archivos/s, MB/s y pico de memoria (RSS).
+
+    python benchmarks/bench_anonimizador.py --pacientes 4 --cortes 20
+    python benchmarks/bench_anonimizador.py --entrada ARBOL --workers 4 --lectura-rapida
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import pydicom
+except ImportError:
+    print("Instala primero las dependencias con:\n    pip install pydicom numpy")
+    sys.exit(1)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generar_sinteticos import generar_arbol  # noqa: E402
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(RAIZ, "Anon", "Sytem-without-gui-remastered.py")
+
+
+def cargar_anonimizador():
+    # el script no es importable por nombre (lleva guiones); se registra como
+    # "anonimizador" para que el pool de procesos pueda serializar sus funciones;
+    # su carpeta va en sys.path para que encuentre comun_dicom
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    spec = importlib.util.spec_from_file_location("anonimizador", SCRIPT)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules["anonimizador"] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+# A nivel de módulo: los procesos hijos (spawn) lo vuelven a cargar al importar este archivo
+anon = cargar_anonimizador()
+import comun_dicom as comun  # noqa: E402  (en la carpeta del script, ya en sys.path)
+
+
+def pico_rss_mb(quien="self"):
+    if resource is None:
+        return None
+    r = resource.getrusage(resource.RUSAGE_SELF if quien == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss está en KiB en Linux y en bytes en macOS
+    return r.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def medida(nombre, segundos, archivos, nbytes, rss=None):
+    return {
+        "etapa": nombre,
+        "segundos": segundos,
+        "archivos": archivos,
+        "archivos_por_s": archivos / segundos if segundos else 0.0,
+        "mb_por_s": nbytes / 1e6 / segundos if segundos else 0.0,
+        "pico_rss_mb": rss,
+    }
+
+
+def _ejecucion_completa(entrada, salida, opciones, cola):
+    # en un proceso aparte para que su pico de RSS no se mezcle con el de las etapas
+    with open(os.devnull, "w") as nulo:
+        os.dup2(nulo.fileno(), sys.stdout.fileno())
+        inicio = time.perf_counter()
+        anon.anonimizar_y_recortar_por_plano(entrada, salida, **opciones)
+        cola.put((time.perf_counter() - inicio, pico_rss_mb("self")))
+
+
+def medir_completo(entrada, salida, opciones, n_archivos, n_bytes):
+    cola = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_ejecucion_completa,
+                                args=(entrada, salida, opciones, cola))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError(f"la ejecución completa terminó con código {p.exitcode}")
+    segundos, rss = cola.get()
+    hijos = pico_rss_mb("children")
+    if hijos is not None:
+        rss = max(rss, hijos)
+    return medida("completo", segundos, n_archivos, n_bytes, rss)
+
+
+def medir_etapas(salida_tmp, rutas):
+    """Cada etapa del pipeline, por separado, sobre todos los archivos de rutas."""
+    n_bytes = sum(os.path.getsize(r) for r in rutas)
+    resultados = []
+
+    t = time.perf_counter()
+    datasets = [pydicom.dcmread(r, force=True) for r in rutas]
+    resultados.append(medida("lectura", time.perf_counter() - t, len(rutas), n_bytes))
+
+    t = time.perf_counter()
+    con_pixeles, bytes_pix = [], 0
+    for ds in datasets:
+        try:
+            img = ds.pixel_array
+        except Exception:
+            continue
+        con_pixeles.append((ds, img))
+        bytes_pix += img.nbytes
+    resultados.append(medida("decodificacion", time.perf_counter() - t,
+                             len(con_pixeles), bytes_pix))
+
+    t = time.perf_counter()
+    planos = [comun.clasificar_plano(ds) for ds, _ in con_pixeles]
+    resultados.append(medida("clasificar_plano", time.perf_counter() - t,
+                             len(planos), 0))
+
+    sagitales = [(ds, img) for (ds, img), plano in zip(con_pixeles, planos) if plano == "sagital"]
+    t = time.perf_counter()
+    for ds, img in sagitales:
+        m = comun.mascara_para(ds, *img.shape[-2:], comun.PLANTILLAS_MASCARA["clasica"])
+        comun.aplicar_mascara(img, m)
+    resultados.append(medida("mascara", time.perf_counter() - t, len(sagitales),
+                             sum(img.nbytes for _, img in sagitales)))
+
+    t = time.perf_counter()
+    for i, ds in enumerate(datasets):
+        ds.save_as(os.path.join(salida_tmp, f"{i:06d}.dcm"))
+    resultados.append(medida("save_as", time.perf_counter() - t, len(datasets), n_bytes))
+
+    resultados[-1]["pico_rss_mb"] = pico_rss_mb("self")
+    return resultados
+
+
+def imprimir(resultados):
+    print(f"{'etapa':<18}{'s':>9}{'archivos':>10}{'arch/s':>10}{'MB/s':>10}{'RSS MB':>10}")
+    for r in resultados:
+        rss = f"{r['pico_rss_mb']:.0f}" if r["pico_rss_mb"] is not None else "-"
+        print(f"{r['etapa']:<18}{r['segundos']:>9.2f}{r['archivos']:>10}"
+              f"{r['archivos_por_s']:>10.1f}{r['mb_por_s']:>10.1f}{rss:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entrada", help="árbol ya generado (por defecto se genera uno temporal)")
+    parser.add_argument("--pacientes", type=int, default=4)
+    parser.add_argument("--cortes", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--lectura-rapida", action="store_true")
+    parser.add_argument("--por-serie", action="store_true")
+    parser.add_argument("--sin-etapas", action="store_true",
+                        help="medir solo la ejecución completa")
+    parser.add_argument("--json", action="store_true", help="salida en JSON")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_anon_")
+    try:
+        entrada = args.entrada
+        if entrada is None:
+            entrada = os.path.join(tmp, "entrada")
+            generar_arbol(entrada, args.pacientes, args.cortes, args.frames)
+
+        indice = comun.indexar_entrada(entrada)
+        n_archivos, n_bytes = comun.totales_indice(indice)
+        rutas = [os.path.join(entrada, serie["ruta"], a[0])
+                 for paciente in indice["pacientes"]
+                 for serie in paciente["series"] for a in serie["archivos"]]
+
+        opciones = {"workers": args.workers, "lectura_rapida": args.lectura_rapida,
+                    "por_serie": args.por_serie}
+        resultados = [medir_completo(entrada, os.path.join(tmp, "salida"), opciones,
+                                     n_archivos, n_bytes)]
+        if not args.sin_etapas:
+            os.makedirs(os.path.join(tmp, "etapas"))
+            resultados += medir_etapas(os.path.join(tmp, "etapas"), rutas)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"archivos": n_archivos, "bytes": n_bytes, "opciones": opciones,
+                          "resultados": resultados}, indent=2))
+    else:
+        print(f"{n_archivos} archivos, {n_bytes / 1e6:.1f} MB, opciones: {opciones}")
+        imprimir(resultados)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+generar_sinteticos.py
+
+Genera un árbol de pacientes con DICOMs sintéticos para medir el rendimiento
+del anonimizador sin datos reales. Cada paciente tiene series axiales,
+coronales, sagitales y oblicuas con distintos tamaños de matriz, un objeto
+multi-frame y un archivo sin datos de píxel.
+
+    python benchmarks/generar_sinteticos.py DESTINO --pacientes 4 --cortes 20
+"""
+
+import argparse
+import os
+import sys
+
+try:
+    import numpy as np
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+except ImportError:
+    print("Instala primero las dependencias con:\n    pip install pydicom numpy")
+    sys.exit(1)
+
+
+# ImageOrientationPatient de cada plano
+ORIENTACIONES = {
+    "axial":   [1, 0, 0, 0, 1, 0],
+    "coronal": [1, 0, 0, 0, 0, -1],
+    "sagital": [0, 1, 0, 0, 0, -1],
+    "oblicuo": [1, 0, 0, 0, 0.7071, 0.7071],
+}
+
+# (filas, columnas) que se van alternando entre series
+MATRICES = [(256, 256), (512, 512), (320, 260)]
+
+
+def nuevo_dataset(paciente, serie_uid, descripcion, iop):
+    """Cabecera MR mínima con los atributos que usa el anonimizador."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "MR"
+    ds.PatientName = f"Sintetico^{paciente}"
+    ds.PatientID = f"SIN{paciente:05d}"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.SeriesInstanceUID = serie_uid
+    ds.SeriesDescription = descripcion
+    ds.ImageOrientationPatient = iop
+    ds.ImagePositionPatient = [0, 0, 0]
+    ds.PixelSpacing = [1, 1]
+    return ds
+
+
+def poner_pixeles(ds, rng, filas, cols, frames=1):
+    ds.Rows, ds.Columns = filas, cols
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+    ds.PixelRepresentation = 0
+    forma = (filas, cols)
+    if frames > 1:
+        ds.NumberOfFrames = frames
+        forma = (frames, filas, cols)
+    ds.PixelData = rng.integers(0, 4096, forma, dtype=np.uint16).tobytes()
+
+
+def generar_arbol(destino, pacientes=4, cortes=20, frames=64, semilla=0):
+    """
+    Crea destino/PacienteNN/<serie>/IMnnnn y devuelve el número de archivos.
+    Los valores de píxel son ruido reproducible a partir de semilla.
+    """
+    rng = np.random.default_rng(semilla)
+    n = 0
+    for p in range(pacientes):
+        for i, (plano, iop) in enumerate(ORIENTACIONES.items()):
+            filas, cols = MATRICES[(p + i) % len(MATRICES)]
+            carpeta = os.path.join(destino, f"Paciente{p:02d}", f"{plano}_{filas}x{cols}")
+            os.makedirs(carpeta, exist_ok=True)
+            uid = generate_uid()
+            for k in range(cortes):
+                ds = nuevo_dataset(p, uid, f"T1 {plano}", iop)
+                ds.InstanceNumber = k + 1
+                poner_pixeles(ds, rng, filas, cols)
+                ds.save_as(os.path.join(carpeta, f"IM{k:04d}"), enforce_file_format=True)
+                n += 1
+
+        # objeto multi-frame (axial) y archivo sin píxeles
+        carpeta = os.path.join(destino, f"Paciente{p:02d}", "otros")
+        os.makedirs(carpeta, exist_ok=True)
+        ds = nuevo_dataset(p, generate_uid(), "T1 multiframe", ORIENTACIONES["axial"])
+        poner_pixeles(ds, rng, 256, 256, frames=frames)
+        ds.save_as(os.path.join(carpeta, "MF0000"), enforce_file_format=True)
+        ds = nuevo_dataset(p, generate_uid(), "Informe", ORIENTACIONES["axial"])
+        ds.save_as(os.path.join(carpeta, "SR0000"), enforce_file_format=True)
+        n += 2
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("destino")
+    parser.add_argument("--pacientes", type=int, default=4)
+    parser.add_argument("--cortes", type=int, default=20, help="cortes por serie")
+    parser.add_argument("--frames", type=int, default=64, help="frames del objeto multi-frame")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+    n = generar_arbol(args.destino, args.pacientes, args.cortes, args.frames, args.semilla)
+    print(f"{n} archivos generados en {args.destino}")
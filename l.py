@@ -3,67 +3,276 @@
 """
 visualizar_dicoms_individuales.py
 
-Lee todos los ficheros DICOM de la carpeta especificada (aunque no tengan extensión),
-y los muestra uno a uno con Matplotlib.
+Visor de revisión de los ficheros DICOM de una carpeta (aunque no tengan
+extensión). Primero se leen solo las cabeceras; los píxeles se decodifican
+al mostrar cada corte, con una caché LRU y lectura anticipada de los cortes
+vecinos. Se muestran en una sola ventana con un deslizador (flechas ←/→,
+RePág/AvPág) o, con --mosaico, como páginas de miniaturas.
+
+    python l.py CARPETA
+    python l.py CARPETA --mosaico
 """
 
+import argparse
 import os
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import pydicom
     import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+    from pydicom.pixels import pixel_array
 except ImportError:
-    print("Instala primero las dependencias con:\n    pip install pydicom matplotlib")
+    print("Instala primero las dependencias con:\n    pip install pydicom numpy matplotlib")
     sys.exit(1)
 
 
-# ←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←
-#  AQUI DEFINE TU CARPETA
-FOLDER_PATH = '/Users/patricksext/PycharmProjects/PythonProject/salida/Paciente_0001 (raíz)/SinDesc'
-# ←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←←
+HILOS_CABECERAS = 8   # lecturas de cabecera en paralelo (útil en carpetas de red)
+CACHE_CORTES    = 32  # cortes decodificados que se guardan en memoria
+ANTICIPAR       = 4   # cortes vecinos que se decodifican por adelantado a cada lado
 
 
-def cargar_dicom_de_carpeta(folder_path):
-    """Lee todos los archivos de folder_path como DICOM (force=True)."""
-    datasets = []
-    for fname in sorted(os.listdir(folder_path)):
-        full_path = os.path.join(folder_path, fname)
-        if not os.path.isfile(full_path):
-            continue
-        try:
-            ds = pydicom.dcmread(full_path, force=True)
-            if hasattr(ds, 'pixel_array'):
-                datasets.append((fname, ds))
-        except Exception:
-            # No es un DICOM válido o está corrupto
+def _leer_cabecera(ruta):
+    try:
+        return pydicom.dcmread(ruta, force=True, stop_before_pixels=True)
+    except Exception:
+        # No es un DICOM válido o está corrupto
+        return None
+
+
+def indexar_carpeta(folder_path, filtro=None):
+    """
+    Lee solo las cabeceras de los archivos de folder_path y devuelve la lista
+    de cortes a mostrar: (ruta, nombre, frame, InstanceNumber), con un corte
+    por frame en los objetos multi-frame (frame None si solo tiene uno),
+    ordenada por InstanceNumber y nombre. filtro(ds), si se indica, decide
+    qué cabeceras se incluyen.
+    """
+    nombres = [f for f in sorted(os.listdir(folder_path))
+               if os.path.isfile(os.path.join(folder_path, f))]
+    rutas = [os.path.join(folder_path, f) for f in nombres]
+    with ThreadPoolExecutor(max_workers=HILOS_CABECERAS) as pool:
+        cabeceras = list(pool.map(_leer_cabecera, rutas))
+
+    cortes = []
+    for ruta, fname, ds in zip(rutas, nombres, cabeceras):
+        # con stop_before_pixels no está PixelData: las imágenes tienen Rows
+        if ds is None or "Rows" not in ds or (filtro is not None and not filtro(ds)):
             continue
-    if not datasets:
+        inst = ds.get("InstanceNumber")
+        n_frames = int(ds.get("NumberOfFrames") or 1)
+        frames = range(n_frames) if n_frames > 1 else [None]
+        cortes += [(ruta, fname, frame, inst) for frame in frames]
+    if not cortes:
         raise RuntimeError(f"No se encontró ningún DICOM válido en '{folder_path}'.")
-    return datasets
-
-
-def mostrar_dicoms_individuales(datasets):
-    """Muestra cada DICOM por separado con Matplotlib."""
-    for idx, (fname, ds) in enumerate(datasets, start=1):
-        img = ds.pixel_array
-        plt.figure(figsize=(6, 6))
-        plt.imshow(img, cmap='gray')
-        title = getattr(ds, 'InstanceNumber', idx)
-        plt.title(f"{idx}/{len(datasets)} – {fname}  (InstanceNumber={title})")
-        plt.axis('off')
-        plt.tight_layout()
-        plt.show()
-        # Si prefieres pausa automática, descomenta la siguiente línea:
-        # plt.pause(1)
-
-
-def main():
-    print(f"Cargando DICOM de {FOLDER_PATH} …")
-    datasets = cargar_dicom_de_carpeta(FOLDER_PATH)
-
-    print(f"Mostrando {len(datasets)} imágenes DICOM …")
-    mostrar_dicoms_individuales(datasets)
+    cortes.sort(key=lambda c: (c[3] is None, c[3] or 0, c[1], c[2] or 0))
+    return cortes
+
+
+def decodificar(corte):
+    """Píxeles de un corte; en los multi-frame solo se lee y decodifica su frame."""
+    ruta, _, frame, _ = corte
+    try:
+        return pixel_array(ruta, index=frame)
+    except Exception:
+        # p. ej. sin preámbulo DICOM: se lee entero con force
+        img = pydicom.dcmread(ruta, force=True).pixel_array
+        return img if frame is None else img[frame]
+
+
+class CacheCortes:
+    """
+    Caché LRU de cortes decodificados, con un pool de hilos que decodifica
+    por adelantado los vecinos del corte que se está viendo. Nunca hay más de
+    capacidad cortes en memoria, más los que se estén decodificando.
+    """
+
+    def __init__(self, cortes, capacidad=CACHE_CORTES, anticipar=ANTICIPAR):
+        self.cortes = cortes
+        self.capacidad = max(capacidad, 1)
+        self.anticipar_n = anticipar
+        self.imagenes = OrderedDict()  # índice -> array, del menos al más reciente
+        self.en_curso = {}             # índice -> futuro de su decodificación
+        self.cerrojo = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=2)
+
+    def _guardar(self, i, img):
+        with self.cerrojo:
+            self.en_curso.pop(i, None)
+            self.imagenes[i] = img
+            self.imagenes.move_to_end(i)
+            while len(self.imagenes) > self.capacidad:
+                self.imagenes.popitem(last=False)
+
+    def _decodificar(self, i):
+        img = decodificar(self.cortes[i])
+        self._guardar(i, img)
+        return img
+
+    def obtener(self, i):
+        with self.cerrojo:
+            img = self.imagenes.get(i)
+            if img is not None:
+                self.imagenes.move_to_end(i)
+                return img
+            futuro = self.en_curso.get(i)
+        if futuro is not None:
+            return futuro.result()
+        return self._decodificar(i)
+
+    def anticipar(self, indices):
+        """Encola la decodificación de los índices que no estén ya en caché."""
+        with self.cerrojo:
+            for i in indices:
+                if 0 <= i < len(self.cortes) and i not in self.imagenes and i not in self.en_curso:
+                    self.en_curso[i] = self.pool.submit(self._decodificar, i)
+
+    def vecinos(self, i):
+        # primero los más cercanos, alternando hacia delante y hacia atrás
+        for d in range(1, self.anticipar_n + 1):
+            yield i + d
+            yield i - d
+
+    def cerrar(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _titulo(cortes, i):
+    _, fname, frame, inst = cortes[i]
+    texto = f"{i + 1}/{len(cortes)} – {fname}  (InstanceNumber={inst if inst is not None else '-'})"
+    return texto if frame is None else f"{texto}  frame {frame + 1}"
+
+
+def _contraste(img):
+    if img.ndim == 2:
+        return float(img.min()), float(img.max())
+    return None  # color: matplotlib usa los valores tal cual
+
+
+def mostrar_visor(cortes, cache):
+    """Todos los cortes en una ventana, con deslizador y teclado."""
+    fig, ax = plt.subplots(figsize=(7, 7.5))
+    fig.subplots_adjust(bottom=0.1)
+    img = cache.obtener(0)
+    im = ax.imshow(img, cmap="gray", clim=_contraste(img))
+    ax.axis("off")
+    ax.set_title(_titulo(cortes, 0))
+    eje = fig.add_axes([0.15, 0.03, 0.7, 0.03])
+    deslizador = Slider(eje, "Corte", 1, len(cortes), valinit=1, valstep=1,
+                        valfmt="%d")
+
+    def mostrar(valor):
+        i = int(valor) - 1
+        img = cache.obtener(i)
+        im.set_data(img)
+        clim = _contraste(img)
+        if clim is not None:
+            im.set_clim(*clim)
+        ax.set_title(_titulo(cortes, i))
+        fig.canvas.draw_idle()
+        cache.anticipar(cache.vecinos(i))
+
+    def tecla(evento):
+        pasos = {"right": 1, "left": -1, "up": 1, "down": -1,
+                 "pagedown": 10, "pageup": -10, "home": -len(cortes), "end": len(cortes)}
+        if evento.key in pasos:
+            i = int(deslizador.val) + pasos[evento.key]
+            deslizador.set_val(min(max(i, 1), len(cortes)))
+
+    deslizador.on_changed(mostrar)
+    fig.canvas.mpl_connect("key_press_event", tecla)
+    cache.anticipar(cache.vecinos(0))
+    plt.show()
+
+
+def mostrar_mosaico(cortes, cache, filas=4, columnas=6, lado=128):
+    """
+    Páginas de filas x columnas miniaturas (reducidas a unos lado píxeles)
+    en una ventana; ←/→ cambian de página y la siguiente se decodifica
+    mientras se revisa la actual.
+    """
+    por_pagina = filas * columnas
+    n_paginas = (len(cortes) + por_pagina - 1) // por_pagina
+    fig, ejes = plt.subplots(filas, columnas, figsize=(columnas * 2, filas * 2 + 0.5),
+                             squeeze=False)
+    estado = {"pagina": 0}
+
+    def miniatura(i):
+        img = cache.obtener(i)
+        paso = max(1, max(img.shape[:2]) // lado)
+        return img[::paso, ::paso]
+
+    def dibujar():
+        p = estado["pagina"]
+        indices = range(p * por_pagina, min((p + 1) * por_pagina, len(cortes)))
+        cache.anticipar(indices)
+        for k, ax in enumerate(ejes.flat):
+            ax.clear()
+            ax.axis("off")
+            if k < len(indices):
+                i = indices[k]
+                img = miniatura(i)
+                ax.imshow(img, cmap="gray", clim=_contraste(img))
+                ax.set_title(f"{i + 1} – {cortes[i][1]}", fontsize=7)
+        fig.suptitle(f"Página {p + 1}/{n_paginas} ({len(cortes)} cortes)")
+        fig.canvas.draw_idle()
+        siguiente = range((p + 1) * por_pagina, min((p + 2) * por_pagina, len(cortes)))
+        cache.anticipar(siguiente)
+
+    def tecla(evento):
+        pasos = {"right": 1, "pagedown": 1, "left": -1, "pageup": -1}
+        if evento.key in pasos:
+            p = min(max(estado["pagina"] + pasos[evento.key], 0), n_paginas - 1)
+            if p != estado["pagina"]:
+                estado["pagina"] = p
+                dibujar()
+
+    fig.canvas.mpl_connect("key_press_event", tecla)
+    dibujar()
+    plt.show()
+
+
+def argumentos(descripcion, ayuda_carpeta, argv=None):
+    parser = argparse.ArgumentParser(description=descripcion,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("carpeta", help=ayuda_carpeta)
+    parser.add_argument("--mosaico", action="store_true",
+                        help="mostrar páginas de miniaturas en lugar de un corte con deslizador")
+    parser.add_argument("--cache", type=int, default=CACHE_CORTES, metavar="N",
+                        help=f"cortes decodificados en memoria (por defecto {CACHE_CORTES})")
+    parser.add_argument("--anticipar", type=int, default=ANTICIPAR, metavar="N",
+                        help=f"vecinos a cada lado que se decodifican por adelantado "
+                             f"(por defecto {ANTICIPAR})")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.carpeta):
+        parser.error(f"'{args.carpeta}' no existe o no es carpeta")
+    return args
+
+
+def visualizar(cortes, args):
+    # el mosaico necesita al menos dos páginas de miniaturas en caché
+    capacidad = max(args.cache, 48) if args.mosaico else args.cache
+    cache = CacheCortes(cortes, capacidad, args.anticipar)
+    try:
+        if args.mosaico:
+            mostrar_mosaico(cortes, cache)
+        else:
+            mostrar_visor(cortes, cache)
+    finally:
+        cache.cerrar()
+
+
+def main(argv=None):
+    args = argumentos(__doc__, "carpeta con los DICOM a mostrar", argv)
+
+    print(f"Indexando cabeceras DICOM de {args.carpeta} …")
+    cortes = indexar_carpeta(args.carpeta)
+
+    print(f"Mostrando {len(cortes)} imágenes DICOM …")
+    visualizar(cortes, args)
 
 
 if __name__ == '__main__':
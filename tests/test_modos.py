@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+test_modos.py
+
+Regresión del anonimizador (Anon/Sytem-without-gui-remastered.py) sobre un
+árbol sintético (ver benchmarks/generar_sinteticos.py): cada modo de
+ejecución (workers, pipeline, por_serie, lectura_rapida, memoria,
+empaquetar, perfiles de anonimización, reanudar) debe escribir
+exactamente los mismos bytes que la ejecución secuencial por defecto.
+
+    python -m pytest tests
+"""
+
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+pytest.importorskip("pydicom")
+pytest.importorskip("numpy")
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(RAIZ, "Anon", "Sytem-without-gui-remastered.py")
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+from generar_sinteticos import generar_arbol  # noqa: E402
+
+CLAVE = b"clave de prueba"
+# auxiliares del empaquetado y de reanudar, que no son salida de los DICOM
+AUXILIARES = ("indice.csv", "manifiesto.sqlite")
+
+
+def cargar_anonimizador():
+    # como en benchmarks/bench_anonimizador.py: el script lleva guiones en el nombre
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    spec = importlib.util.spec_from_file_location("anonimizador", SCRIPT)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules["anonimizador"] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+anon = cargar_anonimizador()
+
+
+def contenido(carpeta):
+    """
+    {ruta relativa: bytes} de todo lo escrito en carpeta; los miembros de
+    los archivos .zip y .tar van como <archivo sin extensión>/<miembro>,
+    para comparar la salida empaquetada con la de carpetas.
+    """
+    archivos = {}
+    for root, _, nombres in os.walk(carpeta):
+        for nombre in nombres:
+            ruta = os.path.join(root, nombre)
+            rel = os.path.relpath(ruta, carpeta)
+            if nombre in AUXILIARES:
+                continue
+            if nombre.endswith(".zip"):
+                with zipfile.ZipFile(ruta) as z:
+                    for miembro in z.namelist():
+                        if miembro not in AUXILIARES:
+                            archivos[os.path.join(rel[:-4], miembro)] = z.read(miembro)
+            elif nombre.endswith(".tar"):
+                with tarfile.open(ruta) as t:
+                    for miembro in t.getmembers():
+                        if miembro.isfile() and miembro.name not in AUXILIARES:
+                            archivos[os.path.join(rel[:-4], miembro.name)] = (
+                                t.extractfile(miembro).read())
+            else:
+                with open(ruta, "rb") as fp:
+                    archivos[rel] = fp.read()
+    return archivos
+
+
+def ejecutar(entrada, salida, **opciones):
+    with contextlib.redirect_stdout(io.StringIO()):
+        resumen = anon.anonimizar_y_recortar_por_plano(entrada, str(salida), **opciones)
+    assert resumen is not None
+    assert resumen["errores"] == 0
+    return resumen
+
+
+def comparar(esperado, obtenido):
+    assert sorted(obtenido) == sorted(esperado)
+    distintos = [ruta for ruta in esperado if obtenido[ruta] != esperado[ruta]]
+    assert distintos == []
+
+
+@pytest.fixture(scope="module")
+def entrada(tmp_path_factory):
+    carpeta = tmp_path_factory.mktemp("entrada")
+    generar_arbol(str(carpeta), pacientes=2, cortes=6, frames=8)
+    return str(carpeta)
+
+
+@pytest.fixture(scope="module")
+def referencia(entrada, tmp_path_factory):
+    salida = tmp_path_factory.mktemp("referencia")
+    ejecutar(entrada, salida)
+    return contenido(salida)
+
+
+@pytest.fixture(scope="module")
+def basico():
+    return anon.preparar_anonimizacion(anon.cargar_perfil_anonimizacion("basico"), CLAVE, 30)
+
+
+@pytest.fixture(scope="module")
+def referencia_basico(entrada, basico, tmp_path_factory):
+    salida = tmp_path_factory.mktemp("referencia_basico")
+    ejecutar(entrada, salida, clave=CLAVE, anonimizacion=basico)
+    return contenido(salida)
+
+
+MODOS = {
+    "workers": dict(workers=2),
+    "pipeline": dict(pipeline=4),
+    "por_serie": dict(por_serie=True),
+    "lectura_rapida": dict(lectura_rapida=True),
+    "memoria": dict(memoria=1 << 20),
+    "memoria_workers": dict(memoria=2 << 20, workers=2, por_serie=True),
+    "zip_paciente": dict(empaquetar=("zip", "paciente")),
+    "tar_serie": dict(empaquetar=("tar", "serie"), workers=2),
+    "combinado": dict(workers=2, pipeline=2, lectura_rapida=True, por_serie=True,
+                      memoria=4 << 20),
+}
+
+
+@pytest.mark.parametrize("modo", MODOS)
+def test_modo_igual_a_secuencial(modo, entrada, referencia, tmp_path):
+    ejecutar(entrada, tmp_path / "salida", **MODOS[modo])
+    comparar(referencia, contenido(tmp_path / "salida"))
+
+
+@pytest.mark.parametrize("modo", ["workers", "pipeline", "lectura_rapida", "memoria",
+                                  "zip_paciente", "combinado"])
+def test_perfil_basico_igual_a_secuencial(modo, entrada, basico, referencia_basico, tmp_path):
+    ejecutar(entrada, tmp_path / "salida", clave=CLAVE, anonimizacion=basico, **MODOS[modo])
+    comparar(referencia_basico, contenido(tmp_path / "salida"))
+
+
+def test_perfil_basico_cambia_la_salida(referencia, referencia_basico):
+    assert set(referencia) != set(referencia_basico)
+
+
+def test_reanudar(entrada, referencia, tmp_path):
+    primera = ejecutar(entrada, tmp_path / "salida", reanudar=True)
+    segunda = ejecutar(entrada, tmp_path / "salida", reanudar=True)
+    assert segunda["archivos"] == 0
+    assert segunda["omitidos"] == primera["archivos"]
+    comparar(referencia, contenido(tmp_path / "salida"))